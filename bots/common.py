@@ -1,15 +1,29 @@
 from fuzzyname import FuzzyName as Name
-from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, CRUNCHBASE_DIR, POPPLER_PATH, BRAVE_PATH, CRUNCHBASE_KEY
+from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_HEALTH_CHECK_SECONDS, DB_BATCH_SIZE, DB_BATCH_SECONDS, CRUNCHBASE_DIR, POPPLER_PATH, BRAVE_PATH, CRUNCHBASE_KEY, CRUNCHBASE_CSV_WORKERS
+from concurrent.futures import ProcessPoolExecutor
 from uuid import uuid5, NAMESPACE_DNS
+import atexit
+import weakref
 import copy
+import tarfile
+import gzip
+import hashlib
+import itertools
+from collections import deque
+import shutil
+from array import array
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 from dateutil import parser as date_parser
 from enum import Enum
 import re, psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from contextlib import contextmanager
 from psycopg2.extras import execute_values
-import csv, numpy as np
+import csv, io, numpy as np
+import multiprocessing
 import scrapy, os, json, logging, requests
 
 USER_AGENTS = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36']
@@ -235,46 +249,24 @@ def is_organization(name):
 
 def get_category_group_list():
     filename = f'{CRUNCHBASE_DIR}/bulk_export/category_groups.csv'
-    with open(filename, 'r', encoding='utf-8') as fp:
-
-        i = 0
-        category_group_set = []
-        for line in fp.readlines():
-            if i == 0:
-                header = split_csv(line)
-                category_name = 'category_groups_list' #'name'
-                category_name_idx = header.index(category_name)
-            else:
-                category = split_csv(line)[category_name_idx].split(',')
-                category_group_set.extend(category)
-            i += 1
-        return sorted(set(category_group_set))
+    store = CrunchbaseColumnarStore.open(filename, CATEGORY_GROUPS_DICTIONARY_COLUMNS)
+    return sorted(store.get_vocabulary('category_groups_list'))
+
 def get_category_list():
     filename = f'{CRUNCHBASE_DIR}/bulk_export/category_groups.csv'
-    with open(filename, 'r', encoding='utf-8') as fp:
-
-        i = 0
-        category_set = set()
-        for line in fp.readlines():
-            if i == 0:
-                header = split_csv(line)
-                category_name = 'name'  # 'name'
-                category_name_idx = header.index(category_name)
-            else:
-                category = split_csv(line)[category_name_idx].strip('"').strip('\n').strip()
-                category_set.add(category)
-            i += 1
-        return sorted(category_set)
+    store = CrunchbaseColumnarStore.open(filename, CATEGORY_GROUPS_DICTIONARY_COLUMNS)
+    return sorted(store.get_vocabulary('name'))
+
+GUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
 
 def is_guid(string):
-    pattern = r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'
-    return re.match(pattern, string) is not None
+    return GUID_PATTERN.match(string) is not None
 
-# the organisations file is not a perfect csv file. it has some line breaks that need to be handled. we just ignore line breaks
+# the organisations file is not a perfect csv file. some quoted fields contain line breaks, so the file is never read line
+# by line. csv.reader runs over the file object itself and keeps such line breaks inside their field.
 from datetime import datetime, timedelta
 
-def get_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_filter, country_code_filter,
-                                          from_filter=datetime.min, to_filter=datetime.max):
+def get_crunchbase_csv_filter(uuids_filter, category_groups_list_filter, country_code_filter):
     filter = {}
 
     assert type(uuids_filter) == list or uuids_filter == '*'
@@ -284,246 +276,862 @@ def get_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_fil
     if uuids_filter != '*': filter['uuid'] = uuids_filter
     if category_groups_list_filter != '*': filter['category_groups_list'] = category_groups_list_filter
     if country_code_filter != '*': filter['country_code'] = country_code_filter
+    return filter
 
-    logger.info(f"Fetching organizations from Crunchbase CSV with filters {str(filter)}")
+def parse_founded_on(founded_on_str):
+    # the bulk export writes ISO dates. fromisoformat is an order of magnitude faster than dateutil, which stays as fallback
+    try:
+        return datetime.fromisoformat(founded_on_str)
+    except ValueError:
+        return date_parser.parse(founded_on_str)
+
+def is_organization_row_matched(values, header_len, filter_idx, founded_on_idx, from_filter=datetime.min, to_filter=datetime.max):
+    if not (values and len(values) == header_len and is_guid(values[0])):
+        return False
+
+    for key_idx, filter_value_list in filter_idx:
+        value = values[key_idx].strip('"').strip()
+        if not any(filter_value in value for filter_value in filter_value_list):
+            return False
+
+    is_date_filtered = not (from_filter == datetime.min and to_filter == datetime.max)
+    founded_on_str = values[founded_on_idx].strip('"').strip()
+    if founded_on_str:
+        return not is_date_filtered or from_filter <= parse_founded_on(founded_on_str) <= to_filter  # Apply date range filter
+    return not is_date_filtered
+
+def iter_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_filter, country_code_filter,
+                                           from_filter=datetime.min, to_filter=datetime.max, progress=True):
+    '''
+    Streams organizations.csv once and yields every organization matching the filters as a dictionary with empty values
+    set to None. Column positions are resolved once from the header, so memory stays flat whatever the file size.
+    '''
+    filter = get_crunchbase_csv_filter(uuids_filter, category_groups_list_filter, country_code_filter)
+
+    logger.info(f"Streaming organizations from Crunchbase CSV with filters {str(filter)}")
     filename = f'{CRUNCHBASE_DIR}/bulk_export/organizations.csv'
+    file_size = max(os.path.getsize(filename), 1)
     prev_progress = 0
-    with open(filename, 'r', encoding='utf-8') as fp:
-        i = 0
-        values = []
-        organizations_list = []
-        lines_total = len(fp.readlines()) - 1  # Subtract 1 to exclude the header line
-        fp.seek(0)  # Reset file pointer to the beginning
-
-        for line in fp.readlines():
+    csv.field_size_limit(2**31 - 1)  # descriptions can be longer than the default field limit
+    with open(filename, 'r', encoding='utf-8', newline='') as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        header_len = len(header)
+        filter_idx = [(header.index(filter_key), filter_value_list) for filter_key, filter_value_list in filter.items()]
+        founded_on_idx = header.index('founded_on')
+
+        for i, values in enumerate(reader, start=1):
             try:
-                if i == 0:
-                    header = split_csv(line)
-                else:
-                    values = split_csv(line)
-
-                    if values and is_guid(values[0]) and (len(values) == len(header)):
-                        if len(filter):
-                            matched = np.zeros(len(filter))
-                            j = 0
-                            for filter_key, filter_value_list in filter.items():
-                                key_idx = header.index(filter_key)
-                                if len(values) == len(header):
-                                    value = values[key_idx].strip('"').strip('\n').strip()
-                                    for filter_value in filter_value_list:
-                                        if filter_value in value:
-                                            matched[j] = 1
-                                            j += 1
-                                            break
-                                    else:
-                                        j += 1
-                                        continue
-                                else:
-                                    break
-                        else:
-                            matched = 0
-
-                        if len(filter) == np.sum(matched):
-
-                            founded_on_idx = header.index('founded_on')
-                            founded_on_str = values[founded_on_idx].strip('"').strip('\n').strip()
-
-                            if founded_on_str:
-                                founded_on = date_parser.parse(founded_on_str)
-                                if from_filter <= founded_on <= to_filter:  # Apply date range filter
-                                    organizations_list.append(dict(zip(header, values)))
-                            elif from_filter == datetime.min and to_filter == datetime.max:
-                                organizations_list.append(dict(zip(header, values)))
-
+                if is_organization_row_matched(values, header_len, filter_idx, founded_on_idx, from_filter, to_filter):
+                    yield {key: (value if value != '' else None) for key, value in zip(header, values)}
             except Exception as ex:
                 logger.error(f'Error: {str(ex)}')
 
-            i += 1
-            progress = i / lines_total * 100
-            if int(progress) > int(prev_progress):
-                print(f'Progress: {progress:.0f}%', end='\r')
-                prev_progress = progress
+            if progress and i % 10000 == 0:
+                current_progress = fp.buffer.tell() / file_size * 100
+                if int(current_progress) > int(prev_progress):
+                    print(f'Progress: {current_progress:.0f}%', end='\r')
+                    prev_progress = current_progress
+
+    if progress:
+        print('\n')
+
+# a record starts after a line break with the uuid of the organization. quoted line breaks inside a field are not followed by a uuid
+CSV_RECORD_START_PATTERN = re.compile(rb'\n"?[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"?,')
+
+def get_csv_byte_ranges(filename, chunk_size=64 * 1024 * 1024):
+    '''
+    Splits a bulk export csv file into byte ranges of about chunk_size which are aligned to record boundaries.
+    Returns the header line as bytes and a list of (start, end) ranges covering all records.
+    '''
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as fp:
+        header = fp.readline()
+        boundaries = [fp.tell()]
+
+        for target in range(boundaries[0] + chunk_size, file_size, chunk_size):
+            # start one byte early so a record starting exactly at target is found
+            position = max(target - 1, boundaries[-1])
+            fp.seek(position)
+            window = b''
+            match = None
+            while match is None:
+                block = fp.read(1024 * 1024)
+                if not block:
+                    break
+                window += block
+                match = CSV_RECORD_START_PATTERN.search(window)
+            if match is None:
+                break
+            boundary = position + match.start() + 1
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+
+    return header, list(zip(boundaries, boundaries[1:] + [file_size]))
+
+def parse_organizations_csv_range(filename, start, end, header, filter, from_filter=datetime.min, to_filter=datetime.max):
+    # runs in a worker process of iter_organizations_from_crunchbase_csv_parallel
+    csv.field_size_limit(2**31 - 1)
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode('utf-8')
+
+    header_len = len(header)
+    filter_idx = [(header.index(filter_key), filter_value_list) for filter_key, filter_value_list in filter.items()]
+    founded_on_idx = header.index('founded_on')
+
+    organizations = []
+    for values in csv.reader(io.StringIO(text, newline='')):
+        try:
+            if is_organization_row_matched(values, header_len, filter_idx, founded_on_idx, from_filter, to_filter):
+                organizations.append({key: (value if value != '' else None) for key, value in zip(header, values)})
+        except Exception as ex:
+            logger.error(f'Error: {str(ex)}')
+    return organizations
+
+def parse_csv_range_rows(filename, start, end, header_len):
+    # runs in a worker process of CrunchbaseColumnarStore.build
+    csv.field_size_limit(2**31 - 1)
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode('utf-8')
+
+    return [values for values in csv.reader(io.StringIO(text, newline=''))
+            if values and len(values) == header_len and is_guid(values[0])]
+
+def iter_csv_ranges_parallel(filename, ranges, parse_range, args, workers=CRUNCHBASE_CSV_WORKERS, progress=True):
+    '''
+    Parses the byte ranges of a csv file with parse_range(filename, start, end, *args) in a process pool and yields the
+    results in file order. Only about workers ranges are parsed ahead of the consumer, the next range is submitted when
+    the oldest result is taken, so memory is bounded by the ranges in flight instead of by the file size.
+    '''
+    total = len(ranges)
+    ranges = iter(ranges)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        for i in itertools.count(1):
+            for start, end in itertools.islice(ranges, workers - len(futures)):
+                futures.append(executor.submit(parse_range, filename, start, end, *args))
+            if not futures:
+                break
+
+            yield futures.popleft().result()
+            if progress:
+                print(f'Progress: {i / total * 100:.0f}%', end='\r')
+
+    if progress:
+        print('\n')
+
+def iter_organizations_from_crunchbase_csv_parallel(uuids_filter, category_groups_list_filter, country_code_filter,
+                                                    from_filter=datetime.min, to_filter=datetime.max,
+                                                    workers=CRUNCHBASE_CSV_WORKERS, chunk_size=64 * 1024 * 1024, progress=True):
+    '''
+    Parallel version of iter_organizations_from_crunchbase_csv. organizations.csv is split into byte ranges aligned to
+    record boundaries which are parsed and filtered in a process pool. Ranges are yielded in file order, so the result is
+    the same as the one of the serial reader.
+    '''
+    filter = get_crunchbase_csv_filter(uuids_filter, category_groups_list_filter, country_code_filter)
+
+    logger.info(f"Parsing organizations from Crunchbase CSV with {workers} workers and filters {str(filter)}")
+    filename = f'{CRUNCHBASE_DIR}/bulk_export/organizations.csv'
+    header, ranges = get_csv_byte_ranges(filename, chunk_size)
+    header = next(csv.reader([header.decode('utf-8')]))
+
+    for organizations in iter_csv_ranges_parallel(filename, ranges, parse_organizations_csv_range, (header, filter, from_filter, to_filter), workers, progress):
+        yield from organizations
+
+def get_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_filter, country_code_filter,
+                                          from_filter=datetime.min, to_filter=datetime.max, use_store=True, workers=CRUNCHBASE_CSV_WORKERS):
+    filter = get_crunchbase_csv_filter(uuids_filter, category_groups_list_filter, country_code_filter)
+    logger.info(f"Fetching organizations from Crunchbase CSV with filters {str(filter)}")
 
-    print('\n')
+    if use_store:
+        organizations = iter_organizations_from_crunchbase_store(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter)
+    elif workers > 1:
+        organizations = iter_organizations_from_crunchbase_csv_parallel(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter, workers)
+    else:
+        organizations = iter_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter)
+    organizations_list = list(organizations)
 
     logger.info(f'Organizations found: {len(organizations_list)} {str(filter)}')
-    clean_list_of_dictionaries(organizations_list)
     sorted_organizations_list = sorted(organizations_list, key=lambda x: x['name'])
     logger.info("Organizations fetched successfully.")
     return sorted_organizations_list
 
+ORGANIZATIONS_DICTIONARY_COLUMNS = {'country_code': False, 'category_groups_list': True, 'category_list': True}
+CATEGORY_GROUPS_DICTIONARY_COLUMNS = {'name': False, 'category_groups_list': True}
+
+class CrunchbaseColumnarStore():
+    '''
+    Typed columnar copy of a Crunchbase bulk export csv file. The csv is converted once into raw numpy files in
+    <filename>.columnar/ which are memory mapped on open:
+
+    <column>.offsets / <column>.data:   every column as utf-8 bytes with int64 row offsets
+    <column>.codes (/ .code_offsets):   dictionary encoded filter columns. multi value columns (comma separated lists)
+                                        store their codes per row between code_offsets
+    founded_on.dates:                   founded_on as datetime64[D], NaT if empty
+
+    The manifest stores the size, mtime and sha256 of the csv file. The store is rebuilt whenever they do not match,
+    a changed mtime alone only triggers rehashing the file.
+    '''
+    __version__ = 2
+    block_size = 1024 * 1024
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.header = manifest['header']
+        self.rows = manifest['rows']
+        self.vocabularies = manifest['vocabularies']
+        self.arrays = {}
+
+    @staticmethod
+    def get_directory(filename):
+        return f'{filename}.columnar'
+
+    @staticmethod
+    def get_file_hash(filename):
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(CrunchbaseColumnarStore.block_size), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def get_file_signature(filename, with_hash=True):
+        stat = os.stat(filename)
+        signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if with_hash:
+            signature['sha256'] = CrunchbaseColumnarStore.get_file_hash(filename)
+        return signature
+
+    @classmethod
+    def open(cls, filename, dictionary_columns, rebuild=False):
+        directory = cls.get_directory(filename)
+        manifest_path = os.path.join(directory, 'manifest.json')
+
+        if not rebuild and os.path.isfile(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as fp:
+                manifest = json.load(fp)
+
+            signature = cls.get_file_signature(filename, with_hash=False)
+            stored = manifest.get('signature', {})
+            is_valid = manifest.get('version') == cls.__version__ and manifest.get('dictionary_columns') == dictionary_columns \
+                       and stored.get('size') == signature['size']
+
+            if is_valid and stored.get('mtime') != signature['mtime']:
+                # file was touched or copied. only a different content invalidates the store
+                is_valid = stored.get('sha256') == cls.get_file_hash(filename)
+                if is_valid:
+                    manifest['signature']['mtime'] = signature['mtime']
+                    with open(manifest_path, 'w', encoding='utf-8') as fp:
+                        json.dump(manifest, fp)
+
+            if is_valid:
+                return cls(directory, manifest)
+
+        return cls.build(filename, dictionary_columns)
+
+    @classmethod
+    def build(cls, filename, dictionary_columns, workers=CRUNCHBASE_CSV_WORKERS, chunk_size=64 * 1024 * 1024):
+        logger.info(f'Building columnar store for {filename} with {workers} workers')
+        directory = cls.get_directory(filename)
+        directory_tmp = f'{directory}.tmp'
+        shutil.rmtree(directory_tmp, ignore_errors=True)
+        os.makedirs(directory_tmp)
+
+        signature = cls.get_file_signature(filename)
+        # csv records are parsed in a process pool by byte ranges, the columns are appended here in file order
+        header, ranges = get_csv_byte_ranges(filename, chunk_size)
+        header = next(csv.reader([header.decode('utf-8')]))
+        header_len = len(header)
+
+        writers = [_ColumnWriter(directory_tmp, column) for column in header]
+        dictionaries = {column: {} for column in dictionary_columns if column in header}
+        code_writers = {column: _CodeWriter(directory_tmp, column, is_multi_value) for column, is_multi_value in dictionary_columns.items() if column in header}
+        code_idx = [(header.index(column), dictionaries[column], code_writers[column]) for column in code_writers]
+        founded_on_idx = header.index('founded_on') if 'founded_on' in header else None
+        founded_on = array('q')
+        founded_on_path = os.path.join(directory_tmp, 'founded_on.dates')
+        nat = np.datetime64('NaT', 'D').astype(np.int64)
+
+        rows = 0
+        with open(founded_on_path, 'wb') as fp_founded_on:
+            for range_rows in iter_csv_ranges_parallel(filename, ranges, parse_csv_range_rows, (header_len,), workers):
+                for values in range_rows:
+                    for writer, value in zip(writers, values):
+                        writer.append(value)
+
+                    for idx, dictionary, code_writer in code_idx:
+                        code_writer.append(values[idx].strip('"').strip(), dictionary)
+
+                    if founded_on_idx is not None:
+                        founded_on_str = values[founded_on_idx].strip('"').strip()
+                        try:
+                            founded_on.append(np.datetime64(parse_founded_on(founded_on_str).date(), 'D').astype(np.int64) if founded_on_str else nat)
+                        except Exception as ex:
+                            logger.error(f'Error: {str(ex)}')
+                            founded_on.append(nat)
+                        if len(founded_on) >= 65536:
+                            founded_on.tofile(fp_founded_on)
+                            founded_on = array('q')
+
+                    rows += 1
+
+            founded_on.tofile(fp_founded_on)
+
+        for writer in writers:
+            writer.close()
+        for code_writer in code_writers.values():
+            code_writer.close()
+
+        # vocabularies are stored in code order, i.e. vocabulary[code] is the value
+        vocabularies = {column: sorted(dictionary, key=dictionary.get) for column, dictionary in dictionaries.items()}
+        manifest = {'version': cls.__version__, 'signature': signature, 'header': header, 'rows': rows,
+                    'dictionary_columns': dictionary_columns, 'vocabularies': vocabularies}
+        with open(os.path.join(directory_tmp, 'manifest.json'), 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(directory_tmp, directory)
+        logger.info(f'Built columnar store for {filename}: {rows} rows')
+        return cls(directory, manifest)
+
+    def get_array(self, name, dtype):
+        if name not in self.arrays:
+            path = os.path.join(self.directory, name)
+            # np.memmap cannot map empty files
+            if os.path.getsize(path) == 0:
+                self.arrays[name] = np.empty(0, dtype=dtype)
+            else:
+                self.arrays[name] = np.memmap(path, dtype=dtype, mode='r')
+        return self.arrays[name]
+
+    def get_values(self, column, row_ids):
+        offsets = self.get_array(f'{column}.offsets', np.int64)
+        # slicing a memoryview is much cheaper than slicing the memmap per value
+        data = memoryview(self.get_array(f'{column}.data', np.uint8))
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        starts = offsets[row_ids].tolist()
+        ends = offsets[row_ids + 1].tolist()
+        return [str(data[start:end], 'utf-8') for start, end in zip(starts, ends)]
+
+    def get_rows(self, row_ids):
+        row_ids = list(row_ids)
+        columns = [self.get_values(column, row_ids) for column in self.header]
+        return [{key: (value if value != '' else None) for key, value in zip(self.header, values)} for values in zip(*columns)]
+
+    def get_vocabulary(self, column):
+        return self.vocabularies[column]
+
+    def get_matching_codes(self, column, filter_value_list):
+        # substring match against the dictionary, same as matching against the csv value
+        return np.array([code for code, value in enumerate(self.vocabularies[column])
+                         if any(filter_value in value for filter_value in filter_value_list)], dtype=np.int32)
+
+    def get_column_mask(self, column, filter_value_list):
+        if column in self.vocabularies:
+            codes = self.get_array(f'{column}.codes', np.int32)
+            hits = np.isin(codes, self.get_matching_codes(column, filter_value_list))
+            if not self.manifest['dictionary_columns'][column]:
+                return hits
+            # a row matches if any of its codes matches
+            code_offsets = self.get_array(f'{column}.code_offsets', np.int64)
+            hits_cumulative = np.concatenate(([0], np.cumsum(hits)))
+            return hits_cumulative[code_offsets[1:]] > hits_cumulative[code_offsets[:-1]]
+        elif column == 'uuid':
+            # all uuids have a fixed width of 36 characters
+            uuids = self.get_array('uuid.data', np.uint8).view('S36')
+            return np.isin(uuids, [filter_value.encode('utf-8') for filter_value in filter_value_list])
+        else:
+            values = self.get_values(column, np.arange(self.rows))
+            return np.fromiter((any(filter_value in value.strip('"').strip() for filter_value in filter_value_list) for value in values),
+                               dtype=bool, count=self.rows)
+
+    def get_mask(self, filter, from_filter=datetime.min, to_filter=datetime.max):
+        mask = np.ones(self.rows, dtype=bool)
+        for filter_key, filter_value_list in filter.items():
+            mask &= self.get_column_mask(filter_key, filter_value_list)
+
+        return mask & self.get_founded_on_mask(from_filter, to_filter)
+
+    def get_founded_on_mask(self, from_filter=datetime.min, to_filter=datetime.max, row_ids=None):
+        if from_filter == datetime.min and to_filter == datetime.max:
+            return np.ones(self.rows if row_ids is None else len(row_ids), dtype=bool)
+
+        founded_on = self.get_array('founded_on.dates', 'datetime64[D]')
+        if row_ids is not None:
+            founded_on = founded_on[row_ids]
+        fr = np.datetime64(from_filter, 'D')
+        if from_filter.time() != datetime.min.time():
+            fr += 1
+        return ~np.isnat(founded_on) & (founded_on >= fr) & (founded_on <= np.datetime64(to_filter, 'D'))
+
+class _ColumnWriter():
+    def __init__(self, directory, column):
+        self.fp_data = open(os.path.join(directory, f'{column}.data'), 'wb')
+        self.fp_offsets = open(os.path.join(directory, f'{column}.offsets'), 'wb')
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+        self.offset = 0
+
+    def append(self, value):
+        encoded = value.encode('utf-8')
+        self.data += encoded
+        self.offset += len(encoded)
+        self.offsets.append(self.offset)
+        if len(self.data) >= CrunchbaseColumnarStore.block_size:
+            self.flush()
+
+    def flush(self):
+        self.fp_data.write(self.data)
+        self.offsets.tofile(self.fp_offsets)
+        self.data = bytearray()
+        self.offsets = array('q')
+
+    def close(self):
+        self.flush()
+        self.fp_data.close()
+        self.fp_offsets.close()
+
+class _CodeWriter():
+    def __init__(self, directory, column, is_multi_value):
+        self.is_multi_value = is_multi_value
+        self.fp_codes = open(os.path.join(directory, f'{column}.codes'), 'wb')
+        self.fp_code_offsets = open(os.path.join(directory, f'{column}.code_offsets'), 'wb') if is_multi_value else None
+        self.codes = array('i')
+        self.code_offsets = array('q', [0])
+        self.code_offset = 0
+
+    def append(self, value, dictionary):
+        if self.is_multi_value:
+            # a value listed twice, i.e. "Software, Software", is stored once so that postings of a code stay unique
+            for item in dict.fromkeys(item.strip() for item in value.split(',')):
+                if item:
+                    self.codes.append(dictionary.setdefault(item, len(dictionary)))
+                    self.code_offset += 1
+            self.code_offsets.append(self.code_offset)
+        else:
+            self.codes.append(dictionary.setdefault(value, len(dictionary)) if value else -1)
+
+        if len(self.codes) >= 65536:
+            self.flush()
+
+    def flush(self):
+        self.codes.tofile(self.fp_codes)
+        self.codes = array('i')
+        if self.is_multi_value:
+            self.code_offsets.tofile(self.fp_code_offsets)
+            self.code_offsets = array('q')
+
+    def close(self):
+        self.flush()
+        self.fp_codes.close()
+        if self.fp_code_offsets:
+            self.fp_code_offsets.close()
+
+class CrunchbaseInvertedIndex():
+    '''
+    Inverted index over the dictionary encoded columns of a CrunchbaseColumnarStore. For every category group, category
+    and country code it keeps the sorted row ids of the organizations having that value, persisted in <filename>.index/:
+
+    <column>.postings:          uint32 row ids of all values, grouped by code and sorted within a code
+    <column>.posting_offsets:   int64 offsets into postings, i.e. postings[offsets[code]:offsets[code + 1]]
+
+    Values of one filter key are combined as union, different filter keys as intersection of their row ids.
+    '''
+    __version__ = 2
+
+    def __init__(self, store, directory, manifest):
+        self.store = store
+        self.directory = directory
+        self.manifest = manifest
+        self.arrays = {}
+
+    @staticmethod
+    def get_directory(filename):
+        return f'{filename}.index'
+
+    @classmethod
+    def open(cls, filename, store, rebuild=False):
+        directory = cls.get_directory(filename)
+        manifest_path = os.path.join(directory, 'manifest.json')
+
+        if not rebuild and os.path.isfile(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as fp:
+                manifest = json.load(fp)
+            if manifest.get('version') == cls.__version__ and manifest.get('sha256') == store.manifest['signature']['sha256'] \
+                    and manifest.get('columns') == list(store.vocabularies):
+                return cls(store, directory, manifest)
+
+        return cls.build(filename, store)
+
+    @classmethod
+    def build(cls, filename, store):
+        logger.info(f'Building inverted index for {filename}')
+        directory = cls.get_directory(filename)
+        directory_tmp = f'{directory}.tmp'
+        shutil.rmtree(directory_tmp, ignore_errors=True)
+        os.makedirs(directory_tmp)
+
+        for column in store.vocabularies:
+            codes = np.asarray(store.get_array(f'{column}.codes', np.int32))
+            if store.manifest['dictionary_columns'][column]:
+                code_offsets = store.get_array(f'{column}.code_offsets', np.int64)
+                row_ids = np.repeat(np.arange(store.rows, dtype=np.uint32), np.diff(code_offsets))
+            else:
+                row_ids = np.flatnonzero(codes >= 0).astype(np.uint32)
+                codes = codes[codes >= 0]
+
+            # stable sort keeps the row ids of every code in ascending order
+            postings = row_ids[np.argsort(codes, kind='stable')]
+            counts = np.bincount(codes, minlength=len(store.vocabularies[column]))
+            posting_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+            postings.tofile(os.path.join(directory_tmp, f'{column}.postings'))
+            posting_offsets.tofile(os.path.join(directory_tmp, f'{column}.posting_offsets'))
+
+        manifest = {'version': cls.__version__, 'sha256': store.manifest['signature']['sha256'], 'columns': list(store.vocabularies)}
+        with open(os.path.join(directory_tmp, 'manifest.json'), 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(directory_tmp, directory)
+        logger.info(f'Built inverted index for {filename}')
+        return cls(store, directory, manifest)
+
+    def get_array(self, name, dtype):
+        if name not in self.arrays:
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == 0:
+                self.arrays[name] = np.empty(0, dtype=dtype)
+            else:
+                self.arrays[name] = np.memmap(path, dtype=dtype, mode='r')
+        return self.arrays[name]
+
+    def get_postings(self, column, code):
+        posting_offsets = self.get_array(f'{column}.posting_offsets', np.int64)
+        return self.get_array(f'{column}.postings', np.uint32)[posting_offsets[code]:posting_offsets[code + 1]]
+
+    def get_column_row_ids(self, column, filter_value_list):
+        if column not in self.manifest['columns']:
+            return np.flatnonzero(self.store.get_column_mask(column, filter_value_list)).astype(np.uint32)
+
+        postings = [self.get_postings(column, code) for code in self.store.get_matching_codes(column, filter_value_list)]
+        if not postings:
+            return np.empty(0, dtype=np.uint32)
+        elif len(postings) == 1:
+            return np.asarray(postings[0])
+        return np.unique(np.concatenate(postings))
+
+    def get_row_ids(self, filter, from_filter=datetime.min, to_filter=datetime.max):
+        row_ids = None
+        # intersect the smallest row ids first
+        for column_row_ids in sorted((self.get_column_row_ids(key, value) for key, value in filter.items()), key=len):
+            row_ids = column_row_ids if row_ids is None else np.intersect1d(row_ids, column_row_ids, assume_unique=True)
+
+        if row_ids is None:
+            row_ids = np.arange(self.store.rows, dtype=np.uint32)
+
+        return row_ids[self.store.get_founded_on_mask(from_filter, to_filter, row_ids)]
+
+    def get_counts(self, column, by_column, filter_value_lists=None, from_filter=datetime.min, to_filter=datetime.max):
+        '''
+        Counts organizations for every value of column (multi value, e.g. category_groups_list) split by every value
+        of by_column (single value, e.g. country_code). Returns {value: {by_value: count}} without zero counts.
+        '''
+        by_codes = self.store.get_array(f'{by_column}.codes', np.int32)
+        by_vocabulary = self.store.get_vocabulary(by_column)
+        vocabulary = self.store.get_vocabulary(column)
+
+        counts = {}
+        for code, value in enumerate(vocabulary):
+            if filter_value_lists is not None and value not in filter_value_lists:
+                continue
+            row_ids = self.get_postings(column, code)
+            row_ids = row_ids[self.store.get_founded_on_mask(from_filter, to_filter, row_ids)]
+            row_codes = by_codes[row_ids]
+            by_counts = np.bincount(row_codes[row_codes >= 0], minlength=len(by_vocabulary))
+            counts[value] = {by_vocabulary[by_code]: int(count) for by_code, count in enumerate(by_counts) if count}
+        return counts
+
+def open_organizations_index():
+    filename = f'{CRUNCHBASE_DIR}/bulk_export/organizations.csv'
+    store = CrunchbaseColumnarStore.open(filename, ORGANIZATIONS_DICTIONARY_COLUMNS)
+    return CrunchbaseInvertedIndex.open(filename, store)
 
-def create_database():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database="postgres",  # Connect to the default "postgres" database
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
+'''
+Counts organizations of the bulk export for every category group and country code. Used to plan subsets before
+running initialize, i.e. one entry per CATEGORY_LIST_GROUPS and country in seconds instead of one csv scan per combination.
 
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+category_groups_list:   List of category groups. wildcard * is supported
+country_codes:          List of country codes. wildcard * is supported
+returns:                {category_group: {country_code: count}}
+'''
+def get_subset_counts(category_groups_list='*', country_codes='*', from_filter=datetime.min, to_filter=datetime.max):
+    assert type(category_groups_list) == list or category_groups_list == '*'
+    assert type(country_codes) == list or country_codes == '*'
 
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{DB_NAME}'")
-    database_exists = cursor.fetchone()
+    index = open_organizations_index()
+    counts = index.get_counts('category_groups_list', 'country_code',
+                              None if category_groups_list == '*' else category_groups_list, from_filter, to_filter)
+    if country_codes != '*':
+        counts = {group: {country_code: count for country_code, count in by_country.items() if country_code in country_codes}
+                  for group, by_country in counts.items()}
+    return counts
+
+def iter_organizations_from_crunchbase_store(uuids_filter, category_groups_list_filter, country_code_filter,
+                                             from_filter=datetime.min, to_filter=datetime.max, batch_size=10000):
+    '''
+    Same result as iter_organizations_from_crunchbase_csv, but answered from the columnar store and inverted index of
+    organizations.csv. Both are (re)built on first use after the bulk export changed.
+    '''
+    filter = get_crunchbase_csv_filter(uuids_filter, category_groups_list_filter, country_code_filter)
+    index = open_organizations_index()
+
+    row_ids = index.get_row_ids(filter, from_filter, to_filter)
+    logger.info(f'Inverted index matched {len(row_ids)} organizations {str(filter)}')
+    for chunk in chunk_data(row_ids, batch_size):
+        yield from index.store.get_rows(chunk)
+
+
+class ConnectionPool():
+    '''
+    Process wide pool of PostgreSQL connections. Checkouts block while max connections are in use instead of failing,
+    connections idle for longer than health_check seconds are tested with SELECT 1 and replaced if they are broken. After
+maxconn broken connections in a row the checkout fails with OperationalError, so callers do not wait on a database that is down.
+    Connections are returned rolled back, so an uncommitted transaction never leaks into the next checkout.
+    '''
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, health_check=DB_POOL_HEALTH_CHECK_SECONDS, **connect_kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.semaphore = threading.BoundedSemaphore(maxconn)
+        self.maxconn = maxconn
+        self.health_check = health_check
+        self.last_used = {}
+        self.pid = os.getpid()
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self.last_used.get(id(conn), 0) < self.health_check:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        self.semaphore.acquire()
+        try:
+            conn = self.pool.getconn()
+            attempts = 0
+            while not self.is_healthy(conn):
+                self.pool.putconn(conn, close=True)
+                attempts += 1
+                if attempts > self.maxconn:
+                    raise psycopg2.OperationalError(f'No healthy database connection after replacing {self.maxconn} broken connections')
+                logger.warning(f'Replacing broken database connection ({attempts}/{self.maxconn})')
+                time.sleep(0.1 * attempts)
+                conn = self.pool.getconn()
+            return conn
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            self.last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.semaphore.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        if self.pid == os.getpid() and not self.pool.closed:
+            self.pool.closeall()
+
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def get_connection_pool(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD, port=DB_PORT):
+    # one pool per database and process. forked workers create their own pool instead of sharing sockets of the parent
+    key = (host, database, user, password, port, os.getpid())
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(host=host, database=database, user=user, password=password, port=port)
+        return connection_pools[key]
+
+def get_connection(**connect_kwargs):
+    '''
+    Context manager checking out a connection of the shared pool, i.e. with get_connection() as conn. connect_kwargs
+    override the database settings of bots.config.
+    '''
+    return get_connection_pool(**connect_kwargs).connection()
 
-    if not database_exists:
-        cursor.execute(f"CREATE DATABASE {DB_NAME}")
 
-    cursor.close()
-    conn.close()
+def create_database():
+    # a one-off connection to the maintenance database, a pool would keep it open for the life of the process
+    conn = psycopg2.connect(host=DB_HOST, database="postgres", user=DB_USER, password=DB_PASSWORD, port=DB_PORT)
+    try:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 
-def create_organizations_table(drop_existing=False):
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port = DB_PORT
-    )
-
-    cursor = conn.cursor()
-
-    table_name = 'crunchbase_organizations'
-
-    if drop_existing:
-        drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
-        cursor.execute(drop_table_query)
-        logger.info(f'Dropped postgreSQL table {table_name}')
-
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS {} (
-        uuid UUID,
-        name TEXT,
-        type TEXT,
-        permalink TEXT,
-        cb_url TEXT,
-        rank INTEGER,
-        created_at TIMESTAMP,
-        updated_at TIMESTAMP,
-        legal_name TEXT,
-        roles TEXT,
-        domain TEXT,
-        homepage_url TEXT,
-        country_code TEXT,
-        state_code TEXT,
-        region TEXT,
-        city TEXT,
-        address TEXT,
-        postal_code TEXT,
-        status TEXT,
-        short_description TEXT,
-        category_list TEXT,
-        category_groups_list TEXT,
-        num_funding_rounds INTEGER,
-        total_funding_usd BIGINT,
-        total_funding BIGINT,
-        total_funding_currency_code TEXT,
-        founded_on DATE,
-        last_funding_on DATE,
-        closed_on DATE,
-        employee_count TEXT,
-        email TEXT,
-        phone TEXT,
-        facebook_url TEXT,
-        linkedin_url TEXT,
-        twitter_url TEXT,
-        logo_url TEXT,
-        alias1 TEXT,
-        alias2 TEXT,
-        alias3 TEXT,
-        primary_role TEXT,
-        num_exits INTEGER,
-        CONSTRAINT crunchbase_organizations_pkey PRIMARY KEY (uuid)
-    )
-    """.format(table_name)
-    cursor.execute(create_table_query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info(f'Created postgreSQL table if existing {table_name}')
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{DB_NAME}'")
+        database_exists = cursor.fetchone()
 
-# pending table will contain all entries that need further processing by crunchbase REST API, companies house spider or linked in spider
-def create_pending_table(drop_existing=False):
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
+        if not database_exists:
+            cursor.execute(f"CREATE DATABASE {DB_NAME}")
+
+        cursor.close()
+    finally:
+        conn.close()
+
+def create_organizations_table(drop_existing=False):
+    with get_connection() as conn:
 
-    cursor = conn.cursor()
+        cursor = conn.cursor()
 
-    table_name = 'pending'
+        table_name = 'crunchbase_organizations'
 
-    if drop_existing:
-        drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
-        cursor.execute(drop_table_query)
-        logger.info(f'Dropped postgreSQL table {table_name}')
+        if drop_existing:
+            drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
+            cursor.execute(drop_table_query)
+            logger.info(f'Dropped postgreSQL table {table_name}')
 
-    create_table_query = """
+        create_table_query = """
         CREATE TABLE IF NOT EXISTS {} (
-            uuid UUID NOT NULL,
-            uuid_parent UUID NOT NULL,
-            name TEXT NOT NULL,
+            uuid UUID,
+            name TEXT,
+            type TEXT,
+            permalink TEXT,
+            cb_url TEXT,
+            rank INTEGER,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
             legal_name TEXT,
+            roles TEXT,
+            domain TEXT,
+            homepage_url TEXT,
             country_code TEXT,
-            category_groups_list TEXT[] NOT NULL,
-            founded_on TIMESTAMP,
-            source TEXT NOT NULL,
-            status TEXT NOT NULL,
-            version TEXT,
-            created_at TIMESTAMP NOT NULL,
-            updated_at TIMESTAMP NOT NULL,
-            CONSTRAINT pending_pkey PRIMARY KEY (uuid, source)
+            state_code TEXT,
+            region TEXT,
+            city TEXT,
+            address TEXT,
+            postal_code TEXT,
+            status TEXT,
+            short_description TEXT,
+            category_list TEXT,
+            category_groups_list TEXT,
+            num_funding_rounds INTEGER,
+            total_funding_usd BIGINT,
+            total_funding BIGINT,
+            total_funding_currency_code TEXT,
+            founded_on DATE,
+            last_funding_on DATE,
+            closed_on DATE,
+            employee_count TEXT,
+            email TEXT,
+            phone TEXT,
+            facebook_url TEXT,
+            linkedin_url TEXT,
+            twitter_url TEXT,
+            logo_url TEXT,
+            alias1 TEXT,
+            alias2 TEXT,
+            alias3 TEXT,
+            primary_role TEXT,
+            num_exits INTEGER,
+            CONSTRAINT crunchbase_organizations_pkey PRIMARY KEY (uuid)
         )
         """.format(table_name)
-    cursor.execute(create_table_query)
-
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info(f'Created postgreSQL table if exisiting {table_name}')
+        cursor.execute(create_table_query)
+        conn.commit()
+        cursor.close()
+        logger.info(f'Created postgreSQL table if existing {table_name}')
 
-def create_data_table(drop_existing=False):
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
+# pending table will contain all entries that need further processing by crunchbase REST API, companies house spider or linked in spider
+def create_pending_table(drop_existing=False):
+    with get_connection() as conn:
 
-    cursor = conn.cursor()
+        cursor = conn.cursor()
 
-    table_name = 'data'
+        table_name = 'pending'
 
-    if drop_existing:
-        drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
-        cursor.execute(drop_table_query)
-        logger.info(f'Dropped postgreSQL table {table_name}')
+        if drop_existing:
+            drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
+            cursor.execute(drop_table_query)
+            logger.info(f'Dropped postgreSQL table {table_name}')
 
-    create_table_query = """
+        create_table_query = """
             CREATE TABLE IF NOT EXISTS {} (
-                uuid UUID,
-                uuid_parent UUID,
-                name TEXT,
-                source TEXT,
+                uuid UUID NOT NULL,
+                uuid_parent UUID NOT NULL,
+                name TEXT NOT NULL,
+                legal_name TEXT,
+                country_code TEXT,
+                category_groups_list TEXT[] NOT NULL,
+                founded_on TIMESTAMP,
+                source TEXT NOT NULL,
+                status TEXT NOT NULL,
                 version TEXT,
-                created_at TIMESTAMP,
-                updated_at TIMESTAMP,
-                data JSON,
-                CONSTRAINT data_pkey PRIMARY KEY (uuid, source)
+                created_at TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP NOT NULL,
+                CONSTRAINT pending_pkey PRIMARY KEY (uuid, source)
             )
             """.format(table_name)
-    cursor.execute(create_table_query)
+        cursor.execute(create_table_query)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info(f'Created postgreSQL table if existing {table_name}')
+        conn.commit()
+        cursor.close()
+        logger.info(f'Created postgreSQL table if exisiting {table_name}')
+
+def create_data_table(drop_existing=False):
+    with get_connection() as conn:
+
+        cursor = conn.cursor()
+
+        table_name = 'data'
+
+        if drop_existing:
+            drop_table_query = f"DROP TABLE IF EXISTS {table_name}"
+            cursor.execute(drop_table_query)
+            logger.info(f'Dropped postgreSQL table {table_name}')
+
+        create_table_query = """
+                CREATE TABLE IF NOT EXISTS {} (
+                    uuid UUID,
+                    uuid_parent UUID,
+                    name TEXT,
+                    source TEXT,
+                    version TEXT,
+                    created_at TIMESTAMP,
+                    updated_at TIMESTAMP,
+                    data JSON,
+                    CONSTRAINT data_pkey PRIMARY KEY (uuid, source)
+                )
+                """.format(table_name)
+        cursor.execute(create_table_query)
+
+        conn.commit()
+        cursor.close()
+        logger.info(f'Created postgreSQL table if existing {table_name}')
 
 def clean_list_of_dictionaries(data):
     for d in data:
@@ -533,48 +1141,147 @@ def clean_list_of_dictionaries(data):
 
 
 def chunk_data(source, chunk_size):
-    """Generator to divide the source data into chunks."""
-    for i in range(0, len(source), chunk_size):
-        yield source[i:i + chunk_size]
+    """Generator to divide the source data (list or any iterable) into chunks."""
+    iterator = iter(source)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def write_organizations_from_csv(organizations, logging=None):
     # write to organizations table
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
-    table_name = 'crunchbase_organizations'
-    cursor = conn.cursor()
-
-    columns = organizations[0].keys()
-    query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING"
-
-    # Process the data in chunks
-    total_inserted = 0
-    for index, data_chunk in enumerate(chunk_data(organizations, 1000), start=1):
-        # Extract values from the chunk of dictionaries
-        values = [tuple(d.values()) for d in data_chunk]
-
-        # Execute the bulk insert query for the current chunk
-        execute_values(cursor, query, values)
-
-        chunk_size = len(data_chunk)
-        total_inserted += chunk_size
-
-        # Log which chunk is written
+    with get_connection() as conn:
+        table_name = 'crunchbase_organizations'
+        cursor = conn.cursor()
+
+        # organizations can be a generator, so the columns are taken from the first chunk
+        query = None
+
+        # Process the data in chunks
+        total_inserted = 0
+        for index, data_chunk in enumerate(chunk_data(organizations, 1000), start=1):
+            if query is None:
+                columns = data_chunk[0].keys()
+                query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING"
+
+            # Extract values from the chunk of dictionaries
+            values = [tuple(d.values()) for d in data_chunk]
+
+            # Execute the bulk insert query for the current chunk
+            execute_values(cursor, query, values)
+
+            chunk_size = len(data_chunk)
+            total_inserted += chunk_size
+
+            # Log which chunk is written
+            if logging:
+                logging.info(f'Written chunk {index}: {chunk_size} records.')
+
+        conn.commit()
+        cursor.close()
+
         if logging:
-            logging.info(f'Written chunk {index}: {chunk_size} records.')
+            logging.info(f'Writing organizations from csv successful: {total_inserted}')
+
+
+class CopyStream():
+    '''
+    File like object for cursor.copy_expert that encodes rows (dictionaries) lazily as csv in the given column order.
+    None is written unquoted, which COPY reads as NULL. Every other value is quoted, so it is never read as NULL
+    or as the end of data marker.
+    '''
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = ''
+        self.count = 0
+
+    @staticmethod
+    def encode(value):
+        if value is None:
+            return ''
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = ','.join([self.encode(row.get(column)) for column in self.columns]) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+
+        data = ''.join(lines)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+def get_table_columns(cursor, table_name):
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position", (table_name,))
+    return [row[0] for row in cursor.fetchall()]
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+'''
+Bulk loads organizations (list or generator of dictionaries, i.e. from iter_organizations_from_crunchbase_store) into
+crunchbase_organizations. Rows are streamed with COPY ... FROM STDIN into a temporary staging table and merged with a
+single INSERT ... SELECT ... ON CONFLICT DO NOTHING. The staging table belongs to the session and is dropped on commit,
+so concurrent loads do not share or truncate each other's rows.
+Columns are matched by name, so the key order of the dictionaries does not matter.
+'''
+def copy_organizations_from_csv(organizations, logging=None, update=False):
+    with get_connection() as conn:
+        table_name = 'crunchbase_organizations'
+        staging_table_name = 'crunchbase_organizations_staging'
+        cursor = conn.cursor()
+
+        try:
+            organizations = iter(organizations)
+            first = next(organizations, None)
+            if first is None:
+                if logging:
+                    logging.info('Copying organizations from csv: no organizations to write')
+                return
+
+            # only columns existing in the table are copied. missing keys are written as NULL
+            columns = [column for column in get_table_columns(cursor, table_name) if column in first]
+            columns_str = ', '.join(columns)
+
+            cursor.execute(f"CREATE TEMP TABLE {staging_table_name} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP")
+
+            stream = CopyStream(itertools.chain([first], organizations), columns)
+            cursor.copy_expert(f"COPY {staging_table_name} ({columns_str}) FROM STDIN WITH (FORMAT csv)", stream, size=1024 * 1024)
+
+            if logging:
+                logging.info(f'Copied organizations into {staging_table_name}: {stream.count}')
+
+            # DISTINCT ON makes the merge independent of duplicated uuids in the export. with update existing organizations are
+            # only rewritten if the bulk export changed them, which keeps updated_at comparable to the data table
+            if update:
+                update_str = ', '.join([f"{column} = EXCLUDED.{column}" for column in columns if column != 'uuid'])
+                conflict_str = f"ON CONFLICT (uuid) DO UPDATE SET {update_str} " \
+                               f"WHERE {table_name}.updated_at IS DISTINCT FROM EXCLUDED.updated_at"
+            else:
+                conflict_str = "ON CONFLICT DO NOTHING"
+            cursor.execute(f"INSERT INTO {table_name} ({columns_str}) "
+                           f"SELECT DISTINCT ON (uuid) {columns_str} FROM {staging_table_name} "
+                           f"{conflict_str}")
+            total_inserted = cursor.rowcount
+
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
-    if logging:
-        logging.info(f'Writing organizations from csv successful: {total_inserted}')
+        if logging:
+            logging.info(f'Copying organizations from csv successful: {total_inserted}')
 
 
 '''
@@ -590,160 +1297,147 @@ to_filter:      Date until companies have been founded to query original csv cru
 force:      Used to force the status update. if it is set to false or true and current record does not exist in pending table, 
             a new record will be written. if it is set to false and a current record exists in the table, status will not be updated.
             if it is true and record exists, record status will be updated
+incremental:    Only write organizations which have no data record for the source yet or were updated in the Crunchbase bulk
+            export after their data record was written. Their status is updated like with force
 '''
 def write_organizations_pending(uuids, category_groups_list, country_codes, source, status=PendingStatus.pending,
-                                fr=datetime.min, to=datetime.max, force=False):
+                                fr=datetime.min, to=datetime.max, force=False, incremental=False):
     # write to organizations table
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
-
-    cursor = conn.cursor()
-
-    if uuids == '*':
-        uuids_str = "'%'"
-    else:
-        uuids_str = ', '.join([f"'{item}'" for item in uuids])
+    with get_connection() as conn:
 
-    if category_groups_list == '*':
-        category_groups_list_str = "'%'"
-    else:
-        category_groups_list_str = ', '.join([f"'%{item}%'" for item in category_groups_list])
+        cursor = conn.cursor()
 
-    if country_codes == '*':
-        country_codes_str = "'%'"
-    else:
-        country_codes_str = ', '.join([f"'{item}'" for item in country_codes])
-
-    query = f"SELECT uuid, name, legal_name, country_code, category_groups_list, founded_on " \
-            f"FROM crunchbase_organizations " \
-            f"WHERE founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
-            f"country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
-            f"uuid::text ILIKE ANY (ARRAY[{uuids_str}])"
-
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    dt = datetime.utcnow()
-    data = []
-
-    for row in rows:
-        uuid = row[0]
-        name = row[1]
-        legal_name = row[2]
-        country_code = row[3]
-        category_group_list = [element.strip() for element in row[4].split(',')]
-        category_group_list_str = "{" + ",".join(category_group_list) + "}"
-
-        founded_on = row[5]
-        version = ''
-        created_at = dt
-        updated_at = dt
-        d = {'uuid': uuid, 'uuid_parent': uuid, 'name': name, 'legal_name': legal_name, 'country_code': country_code, 'category_groups_list': category_group_list_str,
-             'founded_on': founded_on, 'source': source.name, 'status': status.name, 'version': version,
-             'created_at': created_at, 'updated_at': updated_at}
-        data.append(d)
-
-    # insert organizations into pending table. if force = True set state to pending. if force = False only add non existing records and don't change state
-    table_name = 'pending'
-    if data:
-        columns = data[0].keys()
-        if force:
-            query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT (uuid, source) DO UPDATE SET status = EXCLUDED.status, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
+        if uuids == '*':
+            uuids_str = "'%'"
         else:
-            query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING"
+            uuids_str = ', '.join([f"'{item}'" for item in uuids])
 
-        # Extract values from the list of dictionaries
-        values = [tuple(d.values()) for d in data]
+        if category_groups_list == '*':
+            category_groups_list_str = "'%'"
+        else:
+            category_groups_list_str = ', '.join([f"'%{item}%'" for item in category_groups_list])
 
-        # Execute the bulk insert query
-        execute_values(cursor, query, values)
+        if country_codes == '*':
+            country_codes_str = "'%'"
+        else:
+            country_codes_str = ', '.join([f"'{item}'" for item in country_codes])
+
+        query = f"SELECT uuid, name, legal_name, country_code, category_groups_list, founded_on " \
+                f"FROM crunchbase_organizations " \
+                f"WHERE founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
+                f"country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
+                f"uuid::text ILIKE ANY (ARRAY[{uuids_str}])"
+
+        if incremental:
+            # organizations without updated_at are treated as unchanged once they have data
+            query += f" and NOT EXISTS (SELECT 1 FROM data " \
+                     f"WHERE data.uuid = crunchbase_organizations.uuid AND data.source = '{source.name}' AND " \
+                     f"(crunchbase_organizations.updated_at IS NULL OR data.updated_at >= crunchbase_organizations.updated_at))"
+
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        dt = datetime.utcnow()
+        data = []
+
+        for row in rows:
+            uuid = row[0]
+            name = row[1]
+            legal_name = row[2]
+            country_code = row[3]
+            category_group_list = [element.strip() for element in row[4].split(',')]
+            category_group_list_str = "{" + ",".join(category_group_list) + "}"
+
+            founded_on = row[5]
+            version = ''
+            created_at = dt
+            updated_at = dt
+            d = {'uuid': uuid, 'uuid_parent': uuid, 'name': name, 'legal_name': legal_name, 'country_code': country_code, 'category_groups_list': category_group_list_str,
+                 'founded_on': founded_on, 'source': source.name, 'status': status.name, 'version': version,
+                 'created_at': created_at, 'updated_at': updated_at}
+            data.append(d)
+
+        # insert organizations into pending table. if force = True set state to pending. if force = False only add non existing records and don't change state
+        table_name = 'pending'
+        if data:
+            columns = data[0].keys()
+            if force or incremental:
+                query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT (uuid, source) DO UPDATE SET status = EXCLUDED.status, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
+            else:
+                query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING"
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logger.info(f'Writing organization pending successful: source: {source.name} status: {status} rows: {len(data)}')
-    else:
-        logger.info(f'Writing organization pending has data to write for {source.name} {str(category_groups_list)}.')
+            # Extract values from the list of dictionaries
+            values = [tuple(d.values()) for d in data]
+
+            # Execute the bulk insert query
+            execute_values(cursor, query, values)
+
+            conn.commit()
+            cursor.close()
+            logger.info(f'Writing organization pending successful: source: {source.name} status: {status} rows: {len(data)}')
+        else:
+            logger.info(f'Writing organization pending has data to write for {source.name} {str(category_groups_list)}.')
 
 
 ### find differences between crunchbase and companieshouse data
 ### if diff is false, the same and matching records will be returned
 def get_data_diff(diff=True):
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
-
-    cursor = conn.cursor()
-
-    if diff == True:
-        sign = '<'
-    else:
-        sign = '='
-
-    sql = f"SELECT t4.uuid, t4.name, t4.source, t4.category_groups_list \
-            FROM(SELECT t1.uuid, t2.name, t2.source \
-                FROM (SELECT uuid \
-                    FROM data \
-                    WHERE source in ('companieshouse', 'crunchbase') \
-                    GROUP BY uuid \
-                    HAVING COUNT(DISTINCT source) {sign} (SELECT COUNT(DISTINCT source) FROM data WHERE source in ('companieshouse', 'crunchbase')) \
-                ) AS t1 \
-                JOIN (SELECT uuid, name, source FROM data) AS t2 \
-                ON t1.uuid = t2.uuid) as t3 \
-            JOIN (SELECT uuid, name, source, category_groups_list FROM pending) AS t4 \
-            ON t3.uuid = t4.uuid and t3.source = t4.source"
-
-    cursor.execute(sql)
-    rows = cursor.fetchall()
-    # Get the column names from the cursor description
-    columns = [desc[0] for desc in cursor.description]
-
-    # Transform the result set into a list of dictionaries
-    result = [dict(zip(columns, row)) for row in rows]
-    cursor.close()
-    conn.close()
+    with get_connection() as conn:
 
-    return result
-    # WHERE 'Hardware' = ANY (category_groups_list);"
+        cursor = conn.cursor()
+
+        if diff == True:
+            sign = '<'
+        else:
+            sign = '='
+
+        sql = f"SELECT t4.uuid, t4.name, t4.source, t4.category_groups_list \
+                FROM(SELECT t1.uuid, t2.name, t2.source \
+                    FROM (SELECT uuid \
+                        FROM data \
+                        WHERE source in ('companieshouse', 'crunchbase') \
+                        GROUP BY uuid \
+                        HAVING COUNT(DISTINCT source) {sign} (SELECT COUNT(DISTINCT source) FROM data WHERE source in ('companieshouse', 'crunchbase')) \
+                    ) AS t1 \
+                    JOIN (SELECT uuid, name, source FROM data) AS t2 \
+                    ON t1.uuid = t2.uuid) as t3 \
+                JOIN (SELECT uuid, name, source, category_groups_list FROM pending) AS t4 \
+                ON t3.uuid = t4.uuid and t3.source = t4.source"
+
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        # Get the column names from the cursor description
+        columns = [desc[0] for desc in cursor.description]
+
+        # Transform the result set into a list of dictionaries
+        result = [dict(zip(columns, row)) for row in rows]
+        cursor.close()
+
+        return result
+        # WHERE 'Hardware' = ANY (category_groups_list);"
 
 # get uuids by name from crunchbase_organizations
 def get_uuids_from_crunchbase_organizations(names=['elliptic', 'isize']):
 
-    conn = psycopg2.connect(
-                host=DB_HOST,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                port=DB_PORT
-            )
+    with get_connection() as conn:
 
-    cursor = conn.cursor()
+        cursor = conn.cursor()
 
-    names_str = ', '.join([f"'%{item}%'" for item in names])
-    query = f"SELECT * FROM crunchbase_organizations WHERE name ILIKE ANY (ARRAY[{names_str}])"
+        names_str = ', '.join([f"'%{item}%'" for item in names])
+        query = f"SELECT * FROM crunchbase_organizations WHERE name ILIKE ANY (ARRAY[{names_str}])"
 
-    cursor.execute(query)
-    rows = cursor.fetchall()
+        cursor.execute(query)
+        rows = cursor.fetchall()
 
-    # Get the column names from the cursor description
-    columns = [desc[0] for desc in cursor.description]
+        # Get the column names from the cursor description
+        columns = [desc[0] for desc in cursor.description]
 
-    # Transform the result set into a list of dictionaries
-    result = [dict(zip(columns, row)) for row in rows]
+        # Transform the result set into a list of dictionaries
+        result = [dict(zip(columns, row)) for row in rows]
 
-    cursor.close()
-    conn.close()
-    return result
+        cursor.close()
+        return result
 
 def get_profile_uuid(name, company_uuid):
     return name.lower() + '|' + str(company_uuid)
@@ -759,7 +1453,7 @@ def get_data(uuids_filter='*', country_codes_filter='*', category_groups_filter=
     - join_companieshouse: 'INNER' or 'LEFT' join type for companieshouse data.
     - join_linkedin: 'INNER' or 'LEFT' join type for linkedin data.
     """
-    with psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD, port=DB_PORT) as conn:
+    with get_connection(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD, port=DB_PORT) as conn:
         with conn.cursor() as cursor:
             # Handling UUIDs filtering
             uuids_str = "'%'" if uuids_filter == '*' else ', '.join([f"'{item}'" for item in uuids_filter])
@@ -838,23 +1532,25 @@ def get_logger(name):
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
 
-    # Create a file handler and set its log level
-    os.makedirs('logs', exist_ok=True)
-    utc_str = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
-    log_name = f'logs\\companybot_{utc_str}.log'
-    file_handler = logging.FileHandler(log_name, encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
-
     # Define a log format
     formatter = CustomFormatter()
 
     # Set the log format for the handlers
     console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
 
     # Add the handlers to the logger
     logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+
+    # Create a file handler and set its log level. worker processes (i.e. parallel csv parsing) import this module again
+    # and only log to the console, otherwise every worker would create its own log file
+    if multiprocessing.parent_process() is None:
+        os.makedirs('logs', exist_ok=True)
+        utc_str = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        log_name = os.path.join('logs', f'companybot_{utc_str}.log')
+        file_handler = logging.FileHandler(log_name, encoding='utf-8')
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
 
     ## Test the logger
     # logger.debug('Debug message')
@@ -865,77 +1561,400 @@ def get_logger(name):
     return logger
 
 
-def bulk_export_crunchbase(download_path="C:\\Users\\Djordje\\Downloads\\crunchbase_bulk_export.tar.gz"):
+class TokenBucket():
+    '''
+    Thread safe token bucket rate limiter. Tokens are refilled continuously with rate tokens per second up to capacity.
+    reserve() takes tokens immediately, possibly going into debt, and returns how long the caller has to wait before
+    using them. acquire() blocks for that time, so callers are served in the order they asked.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, calls, capacity=1):
+        return cls(calls / 60, capacity)
+
+    def reserve(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+'''
+Returns the token bucket for domain that is shared by all crawlers and threads of this process, so that concurrent
+spiders and searches together stay below calls_per_minute
+'''
+def get_rate_limiter(domain, calls_per_minute):
+    with rate_limiters_lock:
+        if domain not in rate_limiters:
+            rate_limiters[domain] = TokenBucket.per_minute(calls_per_minute)
+        return rate_limiters[domain]
+
+
+class FileCache():
+    '''
+    Persistent cache of JSON serializable values on disk. Every entry is a gzip compressed file named after the sha256 of
+    its key parts. Entries older than ttl seconds are ignored, ttl None keeps them forever. Writes go through a temporary
+    file and a rename, so concurrent writers and crashes never leave half written entries behind.
+    '''
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+
+    def get_path(self, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], f'{digest}.json.gz')
+
+    def get(self, key, newer_than=None):
+        '''
+        Returns the cached value of key or None if it is missing or expired. newer_than is a naive UTC datetime, i.e. the
+        updated_at of the source record, entries written before are treated as stale.
+        '''
+        path = self.get_path(key)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if self.ttl is not None and time.time() - modified > self.ttl:
+            return None
+        if newer_than is not None and modified < newer_than.replace(tzinfo=timezone.utc).timestamp():
+            return None
+
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as ex:
+            logger.warning(f'Ignoring unreadable cache entry {path}: {str(ex)}')
+            return None
+
+    def set(self, key, value):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=6) as file:
+            json.dump(value, file)
+        os.replace(temp_path, path)
+
+
+class BatchWriter():
+    '''
+    Buffers the writes of the bots and flushes them with execute_values in a single transaction once max_size rows are
+    buffered or the oldest row waited max_delay seconds. Buffers are deduplicated by (uuid, source): the last data upsert
+    and status change win, the first pending insert wins like ON CONFLICT DO NOTHING. Rows rejected by the database are
+    dropped and logged, rows of a batch that failed to connect are retried. A background thread takes care of
+    the time threshold and pending rows are flushed at interpreter exit by close_connections.
+    '''
+
+    DATA_COLUMNS = ['uuid', 'uuid_parent', 'name', 'source', 'version', 'created_at', 'updated_at', 'data']
+    PENDING_COLUMNS = ['uuid', 'uuid_parent', 'name', 'legal_name', 'country_code', 'category_groups_list', 'founded_on', 'source', 'status', 'version', 'created_at', 'updated_at']
+
+    def __init__(self, max_size=DB_BATCH_SIZE, max_delay=DB_BATCH_SECONDS):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.data = {}
+        self.pending_inserts = {}
+        self.pending_status = {}
+        self.first_write = None
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher, name='batch-writer', daemon=True)
+        self.flusher.start()
+        batch_writers.add(self)
+
+    def __len__(self):
+        return len(self.data) + len(self.pending_inserts) + len(self.pending_status)
+
+    def add(self, buffer, key, row, replace=True):
+        with self.lock:
+            if replace or key not in buffer:
+                buffer[key] = row
+            if self.first_write is None:
+                self.first_write = time.monotonic()
+            is_full = len(self) >= self.max_size
+        if is_full:
+            self.flush()
+
+    def write_data(self, uuid, uuid_parent, name, source, version, data):
+        dt = datetime.utcnow()
+        self.add(self.data, (str(uuid), source), (uuid, uuid_parent, name, source, version, dt, dt, json.dumps(data)))
+
+    def insert_pending(self, uuid, uuid_parent, name, legal_name, country_code, category_groups_list, founded_on, source,
+                       status=PendingStatus.pending, version=''):
+        dt = datetime.utcnow()
+        row = (uuid, uuid_parent, name, legal_name, country_code, category_groups_list, founded_on, source, status.name, version, dt, dt)
+        self.add(self.pending_inserts, (str(uuid), source), row, replace=False)
+
+    def set_pending_status(self, uuid, source, status):
+        self.add(self.pending_status, (str(uuid), source), (str(uuid), source, status.name, datetime.utcnow()))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                data, pending_inserts, pending_status = self.data, self.pending_inserts, self.pending_status
+                self.data, self.pending_inserts, self.pending_status = {}, {}, {}
+                self.first_write = None
+            if not (data or pending_inserts or pending_status):
+                return 0
+
+            rows = [('data', key, row) for key, row in data.items()] + \
+                   [('pending_inserts', key, row) for key, row in pending_inserts.items()] + \
+                   [('pending_status', key, row) for key, row in pending_status.items()]
+            try:
+                dropped = self.write_or_split(rows)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError):
+                # the database is not reachable, keep the rows for the next flush, rows buffered in the meantime are newer
+                with self.lock:
+                    self.data = {**data, **self.data}
+                    self.pending_inserts = {**self.pending_inserts, **pending_inserts}
+                    self.pending_status = {**pending_status, **self.pending_status}
+                    if self.first_write is None:
+                        self.first_write = time.monotonic()
+                raise
+
+            count = len(rows) - dropped
+            logger.debug(f'Batch writer flushed data: {len(data)} pending inserts: {len(pending_inserts)} pending status: {len(pending_status)} dropped: {dropped}')
+            return count
+
+    def write_or_split(self, rows):
+        '''
+        Writes rows in a single transaction. If the database rejects the batch, it is split in halves which are written
+        separately, so a bad row is dropped and logged on its own instead of blocking all rows buffered after it. Returns
+        the number of dropped rows. Connection errors are raised, the rows are kept for the next flush then.
+        '''
+        try:
+            self.write_rows(rows)
+            return 0
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError):
+            raise
+        except psycopg2.Error as ex:
+            if len(rows) == 1:
+                buffer, key, row = rows[0]
+                logger.error(f'Batch writer dropped row of {buffer} {str(key)}: {str(ex).strip()}')
+                return 1
+            middle = len(rows) // 2
+            return self.write_or_split(rows[:middle]) + self.write_or_split(rows[middle:])
+
+    def write_rows(self, rows):
+        data = [row for buffer, key, row in rows if buffer == 'data']
+        pending_inserts = [row for buffer, key, row in rows if buffer == 'pending_inserts']
+        pending_status = [row for buffer, key, row in rows if buffer == 'pending_status']
+        with get_connection() as conn, conn.cursor() as cursor:
+            if data:
+                execute_values(cursor, f"INSERT INTO data ({', '.join(self.DATA_COLUMNS)}) VALUES %s "
+                                       f"ON CONFLICT (uuid, source) DO UPDATE SET data = EXCLUDED.data, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at",
+                               data)
+            if pending_inserts:
+                execute_values(cursor, f"INSERT INTO pending ({', '.join(self.PENDING_COLUMNS)}) VALUES %s ON CONFLICT DO NOTHING",
+                               pending_inserts)
+            if pending_status:
+                execute_values(cursor, "UPDATE pending SET status = v.status, updated_at = v.updated_at "
+                                       "FROM (VALUES %s) AS v (uuid, source, status, updated_at) "
+                                       "WHERE pending.uuid = v.uuid::uuid AND pending.source = v.source",
+                               pending_status)
+            conn.commit()
+
+    def run_flusher(self):
+        while not self.closed.wait(min(self.max_delay, 1)):
+            with self.lock:
+                is_due = self.first_write is not None and time.monotonic() - self.first_write >= self.max_delay
+            if is_due:
+                try:
+                    self.flush()
+                except Exception as ex:
+                    logger.error(f'Batch writer flush failed, retrying: {str(ex)}')
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flusher.join()
+        try:
+            self.flush()
+        except Exception as ex:
+            logger.error(f'Batch writer flush on close failed, {len(self)} rows not written: {str(ex)}')
+
+
+batch_writer = None
+batch_writer_lock = threading.Lock()
+batch_writers = weakref.WeakSet()
+
+def get_batch_writer():
+    # the writer is shared by all bots of the process, so their rows end up in the same transactions
+    global batch_writer
+    with batch_writer_lock:
+        if batch_writer is None or batch_writer.closed.is_set():
+            batch_writer = BatchWriter()
+        return batch_writer
+
+def close_connections():
+    '''
+    Flushes the batch writers and closes the connection pools afterwards. A single exit hook keeps this order, separate
+    hooks would run in reverse order of creation and close a pool before the writer created earlier is flushed.
+    '''
+    for writer in list(batch_writers):
+        writer.close()
+    with connection_pools_lock:
+        pools = list(connection_pools.values())
+    for pool in pools:
+        pool.close()
+
+atexit.register(close_connections)
+
+
+# bulk export files used by the bots, the rest of the archive is skipped while streaming
+BULK_EXPORT_MEMBERS = ('organizations.csv', 'category_groups.csv', 'people.csv', 'funding_rounds.csv')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+class ResumableHttpReader:
+    '''
+    Read-only file-like object over the body of a HTTP download. When the connection drops, the download is resumed
+    from the last received byte with a Range request, so the consumer (i.e. tarfile in stream mode) never notices.
+    '''
+
+    def __init__(self, url, chunk_size=DOWNLOAD_CHUNK_SIZE, max_retries=5, timeout=60):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.position = 0
+        self.total_size = None
+        self.response = None
+        self.chunks = None
+        self.buffer = b''
+        self.retries = 0
+        self.open()
+
+    def open(self):
+        resume = self.response is not None
+        headers = {'Range': f'bytes={self.position}-'} if resume else {}
+        self.chunks = None
+        self.response = requests.get(self.url, headers=headers, stream=True, timeout=self.timeout)
+        if self.response.status_code >= 500:
+            # a server error is retried like a dropped connection
+            self.response.close()
+            self.response.raise_for_status()
+        if resume and self.response.status_code != 206:
+            self.response.close()
+            raise IOError(f'Server does not support resuming {self.url} (status {self.response.status_code})')
+        self.response.raise_for_status()
+
+        if self.total_size is None:
+            self.total_size = int(self.response.headers.get('content-length', 0)) or None
+        self.chunks = self.response.iter_content(self.chunk_size)
+
+    def read_chunk(self):
+        while True:
+            try:
+                if self.chunks is None:
+                    # the previous reconnect failed
+                    self.open()
+                chunk = next(self.chunks, b'')
+                if chunk:
+                    # every resumed connection gets the full number of retries
+                    self.retries = 0
+                    return chunk
+                if self.total_size is None or self.position >= self.total_size:
+                    return chunk
+                # the body ended before content-length was reached
+                raise requests.exceptions.ChunkedEncodingError(f'Connection closed after {self.position} of {self.total_size} bytes')
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as ex:
+                if isinstance(ex, requests.exceptions.HTTPError) and (ex.response is None or ex.response.status_code < 500):
+                    raise
+                self.retries += 1
+                if self.retries > self.max_retries:
+                    raise
+                logger.warning(f'Download of {self.url} interrupted at {self.position} bytes, resuming ({self.retries}/{self.max_retries}): {str(ex)}')
+                self.response.close()
+                self.chunks = None
+                time.sleep(min(2 ** (self.retries - 1), 30))
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.read_chunk()
+            if not chunk:
+                break
+            self.position += len(chunk)
+            self.buffer += chunk
+            if self.total_size:
+                print(f'Downloaded {self.position // 1024} of {self.total_size // 1024} KB', end='\r')
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def download_and_extract_tar(url, extraction_path, members=None, max_retries=5):
+    '''
+    Streams a tar.gz download straight into tarfile and extracts it on the fly, without writing the archive to disk.
+    Only members whose file name is in members are extracted, all of them if members is None. Returns the names of the
+    extracted members. An interrupted download is resumed up to max_retries times in a row.
+    '''
+    extracted = []
+    with ResumableHttpReader(url, max_retries=max_retries) as reader:
+        with tarfile.open(fileobj=reader, mode='r|gz', bufsize=DOWNLOAD_CHUNK_SIZE) as tar:
+            for member in tar:
+                if not member.isfile() or (members is not None and os.path.basename(member.name) not in members):
+                    continue
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, path=extraction_path, filter='data')
+                else:
+                    tar.extract(member, path=extraction_path)
+                extracted.append(member.name)
+                logger.info(f'Extracted {member.name} to {extraction_path}')
+
+    missing = set(members or []) - {os.path.basename(name) for name in extracted}
+    if missing:
+        logger.warning(f'Archive {url.split("?")[0]} is missing {", ".join(sorted(missing))}')
+    return extracted
+
+
+def bulk_export_crunchbase(extraction_path=f'{CRUNCHBASE_DIR}/bulk_export', members=BULK_EXPORT_MEMBERS):
     # URL of the file to be downloaded
     url = f"https://api.crunchbase.com/bulk/v4/bulk_export.tar.gz?user_key={CRUNCHBASE_KEY}"
-    # Path where the file will be extracted
-    extraction_path = "./data/crunchbase/bulk_export"
-
-    # Download the file
-    response = requests.get(url, stream=True)
-
-    total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024 #1 Kibibyte
-    total_kb = total_size // block_size
-
-    with open(download_path, 'wb') as file:
-        for data in response.iter_content(block_size):
-            file.write(data)
-            downloaded_kb = file.tell() // block_size
-            print(f'Downloaded {downloaded_kb} of {total_kb} KB', end='\r')
-
-    # Check if the downloaded file is a tar.gz file
-    if (tarfile.is_tarfile(download_path)):
-        # If it is, extract it
-        with tarfile.open(download_path, 'r:gz') as tar:
-            members = tar.getmembers()
-            for i, member in enumerate(members):
-                tar.extract(member, path=extraction_path)
-                print(f'Extracted {i + 1} of {len(members)} files', end='\r')
-    else:
-        print(f"{download_path} is not a .tar.gz file")
+    return download_and_extract_tar(url, extraction_path, members)
 
-    # Delete the downloaded tar.gz file after extraction
-    os.remove(download_path)
 
-
-def node_keys_crunchbase(download_path="C:\\Users\\Djordje\\Downloads\\crunchbase_node_keys.tar.gz"):
+def node_keys_crunchbase(extraction_path=f'{CRUNCHBASE_DIR}/node_keys'):
     # URL of the file to be downloaded
     url = f"https://api.crunchbase.com/node_keys/v4/node_keys.tar.gz?user_key={CRUNCHBASE_KEY}"
-    # Path where the file will be extracted
-    extraction_path = "./data/crunchbase/node_keys"
-
-    # Download the file
-    response = requests.get(url, stream=True)
-
-    total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024 #1 Kibibyte
-    total_kb = total_size // block_size
-
-    with open(download_path, 'wb') as file:
-        for data in response.iter_content(block_size):
-            file.write(data)
-            downloaded_kb = file.tell() // block_size
-            print(f'Downloaded {downloaded_kb} of {total_kb} KB', end='\r')
-
-    # Check if the downloaded file is a tar.gz file
-    if (tarfile.is_tarfile(download_path)):
-        # If it is, extract it
-        with tarfile.open(download_path, 'r:gz') as tar:
-            members = tar.getmembers()
-            for i, member in enumerate(members):
-                tar.extract(member, path=extraction_path)
-                print(f'Extracted {i + 1} of {len(members)} files', end='\r')
-    else:
-        print(f"{download_path} is not a .tar.gz file")
-
-    # Delete the downloaded tar.gz file after extraction
-    os.remove(download_path)
+    return download_and_extract_tar(url, extraction_path)
 
 
 def initialize(uuids_filter ='*', category_groups_list_filter ='*', country_code_filter ='*',
                from_filter=datetime.min, to_filter=datetime.max,
-               download_crunchbase_csv=True, drop_tables=False, write_organizations=False, pending_force=False):
+               download_crunchbase_csv=True, drop_tables=False, write_organizations=False, pending_force=False, pending_incremental=False):
     """
     Sets up and populates a database with specific Crunchbase companies based on a provided filter.
 
@@ -949,6 +1968,10 @@ def initialize(uuids_filter ='*', category_groups_list_filter ='*', country_code
     :param drop_tables: If True, existing database tables will be dropped and recreated. Use with caution!
                         Defaults to False.
     :type drop_tables: bool
+    :param pending_incremental: If True, organizations changed in the bulk export are updated and only organizations
+                                updated after their last successful fetch (or never fetched) are set to pending.
+                                Defaults to False.
+    :type pending_incremental: bool
 
     :return: None
 
@@ -974,23 +1997,24 @@ def initialize(uuids_filter ='*', category_groups_list_filter ='*', country_code
     create_data_table(drop_tables)
 
     if write_organizations:
-        # get list of organizatins as list of dictionaries. this is the initial step used to fill the database with subset of crunchbase orgnizations.
+        # stream organizatins as dictionaries. this is the initial step used to fill the database with subset of crunchbase orgnizations.
         # we for example just record GBR organizations in crunchbase_organizations table
         # organizations = get_organizations_from_crunchbase_csv({'category_groups_list': ['Artificial Intelligence'], 'country_code': ['GBR']})
-        organizations = get_organizations_from_crunchbase_csv(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter)
+        organizations = iter_organizations_from_crunchbase_store(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter)
         # write the organizations from crunchbase csv file into database. we use that usually to create a subset
-        write_organizations_from_csv(organizations, logging=logging)
+        # incremental refreshes update changed organizations so their updated_at can be compared to the data table
+        copy_organizations_from_csv(organizations, logging=logging, update=pending_incremental)
 
         write_organizations_pending(uuids=uuids_filter, category_groups_list=category_groups_list_filter, country_codes=country_code_filter,
                                     source=DataSource.crunchbase,
                                     status=PendingStatus.pending,
                                     fr=from_filter,
                                     to=to_filter,
-                                    force=pending_force)
+                                    force=pending_force,
+                                    incremental=pending_incremental)
 
 
 from fuzzywuzzy import fuzz
-import itertools
 
 def get_aligned_name(name):
     split_name = name.split(',')
@@ -1356,45 +2380,39 @@ def get_data_from_pending(source, uuids='*', uuids_parent='*', category_groups_l
     assert type(fr) == datetime
     assert type(to) == datetime
 
-    conn = psycopg2.connect(
-                host=DB_HOST,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                port=DB_PORT
-            )
+    with get_connection() as conn:
+
+        uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
+        uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
+        category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
+        country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
+
+        pending = f"" if force else f" and pending.status = '{PendingStatus.pending.name}' "
+
+        cursor = conn.cursor()
+        query = f"SELECT uuid, uuid_parent, name, legal_name, country_code, category_groups_list, founded_on " \
+                f"FROM pending " \
+                f"WHERE source = '{source}' and " \
+                f"founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
+                f"country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
+                f"uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
+                f"uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
+                f"{pending}" \
+                f"ORDER BY name ASC"
+
+        if return_query:
+            return query
+
+        cursor.execute(query)
+        columns = [desc[0] for desc in cursor.description]
+        rows = cursor.fetchall()
+
+        cursor.close()
+        results = [dict(zip(columns, row)) for row in rows]
 
-    uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
-    uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
-    category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
-    country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
-
-    pending = f"" if force else f" and pending.status = '{PendingStatus.pending.name}' "
-
-    cursor = conn.cursor()
-    query = f"SELECT uuid, uuid_parent, name, legal_name, country_code, category_groups_list, founded_on " \
-            f"FROM pending " \
-            f"WHERE source = '{source}' and " \
-            f"founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
-            f"country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
-            f"uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
-            f"uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
-            f"{pending}" \
-            f"ORDER BY name ASC"
-
-    if return_query:
-        return query
-
-    cursor.execute(query)
-    columns = [desc[0] for desc in cursor.description]
-    rows = cursor.fetchall()
-
-    cursor.close()
-    results = [dict(zip(columns, row)) for row in rows]
-
-    return results
+        return results
 
 def clean_and_convert_to_int(ocr_string):
     # Use regular expression to remove any non-digit characters
@@ -2,10 +2,11 @@ from io import StringIO
 from pathlib import Path
 # from pdfminer.layout import LAParams
 # from pdfminer.high_level import extract_text_to_fp, extract_pages, extract_text
-import pytesseract, re, json, math, scrapy, requests, os, psycopg2
+import pytesseract, re, json, math, scrapy, requests, os, psycopg2, threading, atexit, hashlib, subprocess, collections
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from pdf2image import convert_from_path, convert_from_bytes
-from fuzzywuzzy import fuzz, process
+from urllib.parse import urlparse
+from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_bytes
 from sortedcontainers import SortedDict
 from lxml import etree
 from requests.adapters import HTTPAdapter
@@ -25,13 +26,16 @@ from scrapy.utils.project import get_project_settings
 from scrapy import signals
 from scrapy.crawler import CrawlerProcess, CrawlerRunner
 from scrapy.loader import ItemLoader
+from scrapy.exceptions import DontCloseSpider
 
 from twisted.python.failure import Failure
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 
 from uuid import uuid5, NAMESPACE_DNS
-from bots.common import clean_and_convert_to_int, PendingStatus, DataSource, get_profile_uuid, logger, is_organization, get_persons, get_aligned_name, remove_titles
-from bots.config import TESSDATA_PATH, TESSERACT_PATH, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT, POPPLER_PATH, BRAVE_PATH # these imports are required for setup
+from bots.common import clean_and_convert_to_int, PendingStatus, DataSource, get_profile_uuid, logger, is_organization, get_persons, get_aligned_name, remove_titles, get_batch_writer, get_connection, get_rate_limiter, FileCache
+from bots.companieshouse_index import get_companieshouse_index
+from bots.matching import get_company_name_score, get_names_matching_score, rank_candidates, MATCH_SCORE_WEAK, MATCH_SCORE_STRONG
+from bots.config import TESSDATA_PATH, TESSERACT_PATH, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT, POPPLER_PATH, BRAVE_PATH, COMPANIESHOUSE_INDEX_CANDIDATES, COMPANIESHOUSE_SEARCH_CONCURRENCY, COMPANIESHOUSE_SEARCH_LOOKAHEAD, COMPANIESHOUSE_CRAWL_CONCURRENCY, COMPANIESHOUSE_PENDING_PAGE_SIZE, COMPANIESHOUSE_REQUESTS_PER_MINUTE, COMPANIESHOUSE_DOCUMENT_WORKERS, COMPANIESHOUSE_OCR_WORKERS, COMPANIESHOUSE_OCR_CACHE_DIR, COMPANIESHOUSE_OCR_DPI, COMPANIESHOUSE_RASTERIZE_THREADS, COMPANIESHOUSE_OCR_LOOKAHEAD # these imports are required for setup
 
 # pytesseract segmentation modes (--psm)
 # Page segmentation modes:
@@ -62,6 +66,191 @@ session.mount('http://', adapter)
 session.mount('https://', adapter)
 
 
+'''
+Sends a GET request with the shared session after waiting for the process wide rate limit of the url's domain. This
+blocks and must not be called from the reactor thread
+'''
+def session_get(url):
+    get_rate_limiter(urlparse(url).netloc, COMPANIESHOUSE_REQUESTS_PER_MINUTE).acquire()
+    return session.get(url=url)
+
+# document jobs (pdf download and OCR) of all spiders share COMPANIESHOUSE_DOCUMENT_WORKERS threads
+document_semaphore = defer.DeferredSemaphore(COMPANIESHOUSE_DOCUMENT_WORKERS)
+# pages with fewer characters in their text layer are OCR'd
+TEXT_LAYER_MIN_CHARS = 20
+
+
+def init_ocr_worker(tesseract_cmd):
+    # every worker runs one page at a time, tesseract's own OpenMP threads would only compete with the other workers
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+def ocr_page(img, psm):
+    return pytesseract.image_to_string(img, config=f'--psm {psm}')
+
+def get_tesseract_version():
+    return str(pytesseract.get_tesseract_version())
+
+
+'''
+Returns the text layer of each page of the pdf in page order using poppler's pdftotext, or None if it cannot be
+extracted. Pages of scanned documents have no text layer and are returned as empty strings
+'''
+def get_text_layer(content, poppler_path=POPPLER_PATH):
+    command = os.path.join(poppler_path, 'pdftotext') if poppler_path else 'pdftotext'
+    try:
+        result = subprocess.run([command, '-layout', '-enc', 'UTF-8', '-', '-'], input=content, capture_output=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as ex:
+        logger.warning(f'pdftotext failed: {str(ex)}')
+        return None
+    if result.returncode != 0:
+        return None
+    # pdftotext ends every page with a form feed
+    return result.stdout.decode('utf-8', errors='replace').split('\f')[:-1]
+
+def has_text(text):
+    return len(''.join(text.split())) >= TEXT_LAYER_MIN_CHARS
+
+def get_page_count(content, poppler_path=POPPLER_PATH):
+    return pdfinfo_from_bytes(content, poppler_path=poppler_path)['Pages']
+
+'''
+Returns the sorted page numbers as (first_page, last_page) ranges of consecutive pages
+'''
+def get_page_ranges(page_numbers):
+    ranges = []
+    for page_number in sorted(set(page_numbers)):
+        if ranges and ranges[-1][1] == page_number - 1:
+            ranges[-1][1] = page_number
+        else:
+            ranges.append([page_number, page_number])
+    return [tuple(page_range) for page_range in ranges]
+
+
+'''
+Renders the pages (starting at 1) of the pdf for tesseract in page order. Pages are rendered in grayscale by pdftocairo,
+which needs a third of the memory of colour images, and every range of consecutive pages is split across thread_count
+pdftocairo processes
+'''
+def rasterize_pages(content, page_numbers, poppler_path=POPPLER_PATH, dpi=COMPANIESHOUSE_OCR_DPI, thread_count=COMPANIESHOUSE_RASTERIZE_THREADS):
+    images = []
+    for first_page, last_page in get_page_ranges(page_numbers):
+        images.extend(convert_from_bytes(content, dpi=dpi, first_page=first_page, last_page=last_page, grayscale=True,
+                                         use_pdftocairo=True, thread_count=thread_count, poppler_path=poppler_path))
+    return images
+
+
+'''
+Process pool running tesseract for the pages of all documents of all spiders. Document jobs submit their pages and
+block until all pages are done, so pages of one document are OCR'd in parallel and the workers are shared with the
+documents of other companies. The pool is started on first use. Filings never change, so the page texts of a pdf are
+cached on disk by the sha256 of its content, the psm, the dpi and the tesseract version and a page is only OCR'd once
+'''
+class OcrEngine():
+
+    def __init__(self, workers=COMPANIESHOUSE_OCR_WORKERS, tesseract_cmd=TESSERACT_PATH, cache_dir=COMPANIESHOUSE_OCR_CACHE_DIR, dpi=COMPANIESHOUSE_OCR_DPI):
+        self.workers = workers
+        self.tesseract_cmd = tesseract_cmd
+        self.cache = FileCache(cache_dir) if cache_dir else None
+        self.dpi = dpi
+        self.executor = None
+        self.tesseract_version = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_ocr_worker, initargs=(self.tesseract_cmd,))
+            return self.executor
+
+    '''
+    Returns the text of each image in page order
+    '''
+    def image_to_string(self, images, psm=4):
+        return list(self.get_executor().map(ocr_page, images, [psm] * len(images)))
+
+    def get_tesseract_version(self):
+        # asked from a worker which runs the tesseract executable of this engine
+        if self.tesseract_version is None:
+            self.tesseract_version = self.get_executor().submit(get_tesseract_version).result()
+        return self.tesseract_version
+
+    '''
+    Returns the text of each page of the pdf in page order
+    '''
+    def pdf_to_string(self, content, psm=4, poppler_path=POPPLER_PATH, use_text_layer=True):
+        return [text for page_number, text in self.iter_pdf_pages(content, psm, poppler_path, use_text_layer)]
+
+    '''
+    Yields the page number and text of each page of the pdf, or of page_numbers only, in page order. Electronically
+    filed documents are read from their text layer, which is a lot faster and more accurate than OCR. Pages without text
+    layer are rendered and OCR'd in the pool at most lookahead pages ahead of the consumer, so a parser that stops once
+    it has its section does not render and OCR the remaining pages. Pages which are not consumed are cancelled. Rendered
+    pages are kept in images if it is given, so that a retry with another psm only runs tesseract again
+    '''
+    def iter_pdf_pages(self, content, psm=4, poppler_path=POPPLER_PATH, use_text_layer=True, page_numbers=None, images=None,
+                       lookahead=COMPANIESHOUSE_OCR_LOOKAHEAD):
+        texts = get_text_layer(content, poppler_path) if use_text_layer else None
+        if texts is None:
+            texts = [''] * get_page_count(content, poppler_path)
+        page_numbers = [page_number for page_number in page_numbers or range(1, len(texts) + 1) if 1 <= page_number <= len(texts)]
+
+        key = None
+        texts_ocr = {}
+        if self.cache is not None and not all(has_text(texts[page_number - 1]) for page_number in page_numbers):
+            key = ['ocr', hashlib.sha256(content).hexdigest(), psm, self.dpi, self.get_tesseract_version()]
+            texts_ocr = {int(page_number): text for page_number, text in (self.cache.get(key) or {}).items()}
+        texts_ocr_cached = len(texts_ocr)
+
+        futures = collections.deque()
+
+        def submit(page_numbers_batch):
+            page_numbers_ocr = [page_number for page_number in page_numbers_batch if not has_text(texts[page_number - 1]) and page_number not in texts_ocr]
+            page_numbers_render = [page_number for page_number in page_numbers_ocr if images is None or page_number not in images]
+            rendered = dict(zip(page_numbers_render, rasterize_pages(content, page_numbers_render, poppler_path, self.dpi))) if page_numbers_render else {}
+            if images is not None:
+                images.update(rendered)
+            for page_number in page_numbers_batch:
+                if page_number not in page_numbers_ocr:
+                    futures.append(None)
+                    continue
+                image = rendered[page_number] if page_number in rendered else images[page_number]
+                futures.append(self.get_executor().submit(ocr_page, image, psm))
+
+        i_submit = 0
+        try:
+            for i, page_number in enumerate(page_numbers):
+                # the next pages are rendered in one batch once half of the prepared pages are consumed
+                if len(futures) <= lookahead // 2:
+                    i_last = min(len(page_numbers), i + max(lookahead, 1))
+                    submit(page_numbers[i_submit:i_last])
+                    i_submit = max(i_submit, i_last)
+
+                future = futures.popleft()
+                if future is not None:
+                    texts_ocr[page_number] = future.result()
+                yield page_number, texts_ocr.get(page_number, texts[page_number - 1])
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            if key is not None and len(texts_ocr) > texts_ocr_cached:
+                self.cache.set(key, texts_ocr)
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+ocr_engine = OcrEngine()
+atexit.register(ocr_engine.close)
+
+INCORPORATED_ON_PATTERN = re.compile(r'Incorporated on\s+(\d{1,2} [A-Za-z]+ \d{4})')
+
+
 class CompaniesHouseErrorCodes():
 
     document_not_readable = {
@@ -85,6 +274,8 @@ class CompaniesHouseBot(scrapy.Spider):
     allowed_domains = ['find-and-update.company-information.service.gov.uk']
     special_characters = '_—"?#¬|:;,=!%$£*&'
     __version__ = 'CompaniesHouseBot 0.9'
+    # requests of all concurrently running spiders are rate limited together by middlewares.RateLimitMiddleware
+    custom_settings = {'RATE_LIMITS_PER_MINUTE': {'find-and-update.company-information.service.gov.uk': COMPANIESHOUSE_REQUESTS_PER_MINUTE}}
     def __init__(self, company_id, crunchbase_company_name, uuid, poppler_path, is_write_db=False, is_write_file=False, callback_finish=None):
         self.company_id = company_id
         self.crunchbase_company_name = crunchbase_company_name
@@ -125,16 +316,20 @@ class CompaniesHouseBot(scrapy.Spider):
         self.parse_group_count = 0
         self.parse_appointments_count = 0
 
-        self.conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT
-        )
-        self.conn.autocommit = False
+        # filing history is completed once all pages are parsed and all document jobs are done
+        self.document_jobs_count = 0
+        self.is_filing_parsed = False
+        self.is_filing_completed = False
+
+        self.writer = get_batch_writer()
+
     @staticmethod
-    def get_data_from_pending(uuids='*', uuids_parent='*', category_groups_list='*', country_codes='*', fr=datetime.min, to=datetime.max, force=False):
+    def get_data_from_pending(uuids='*', uuids_parent='*', category_groups_list='*', country_codes='*', fr=datetime.min, to=datetime.max, force=False,
+                              limit=None, after=None):
+        '''
+        Returns the pending rows ordered by name and uuid. With limit at most limit rows are returned, after is the
+        (name, uuid) of the last row of the previous page.
+        '''
 
         assert type(uuids) == list or uuids == '*'
         assert type(uuids_parent) == list or uuids_parent == '*'
@@ -143,45 +338,43 @@ class CompaniesHouseBot(scrapy.Spider):
         assert type(fr) == datetime
         assert type(to) == datetime
 
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT
-        )
-
-        cursor = conn.cursor()
-
-        uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
-        uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
-        category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
-        country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
-
-        pending = f"" if force else f" and pending.status = '{PendingStatus.pending.name}' "
-
-        query = f"SELECT pending.*, \"data\".data as crunchbase_data " \
-            f"FROM pending " \
-            f"INNER JOIN \"data\" ON pending.uuid = \"data\".uuid AND \"data\".source = '{DataSource.crunchbase.name}' " \
-            f"WHERE pending.source = '{DataSource.companieshouse.name}' and " \
-            f"pending.founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"pending.founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"pending.category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
-            f"pending.country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
-            f"pending.uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
-            f"pending.uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
-            f"{pending}" \
-            f"ORDER BY pending.name COLLATE \"C\" ASC"
-
-        # print(query)
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        # Get the column names from the cursor description
-        columns = [desc[0] for desc in cursor.description]
-
-        cursor.close()
-        conn.close()
+        with get_connection() as conn:
+
+            cursor = conn.cursor()
+
+            uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
+            uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
+            category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
+            country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
+
+            pending = f"" if force else f" and pending.status = '{PendingStatus.pending.name}' "
+            # keyset paging, rows completed while the previous pages are crawled do not shift the next page
+            page = cursor.mogrify(" and (pending.name COLLATE \"C\", pending.uuid) > (%s COLLATE \"C\", %s::uuid) ", (after[0], str(after[1]))).decode() if after is not None else f" "
+            limit_str = f" LIMIT {int(limit)}" if limit is not None else f""
+
+            query = f"SELECT pending.*, \"data\".data as crunchbase_data " \
+                f"FROM pending " \
+                f"INNER JOIN \"data\" ON pending.uuid = \"data\".uuid AND \"data\".source = '{DataSource.crunchbase.name}' " \
+                f"WHERE pending.source = '{DataSource.companieshouse.name}' and " \
+                f"pending.founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"pending.founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"pending.category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
+                f"pending.country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
+                f"pending.uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
+                f"pending.uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
+                f"{pending}" \
+                f"{page}" \
+                f"ORDER BY pending.name COLLATE \"C\" ASC, pending.uuid ASC" \
+                f"{limit_str}"
+
+            # print(query)
+            cursor.execute(query)
+            rows = cursor.fetchall()
+
+            # Get the column names from the cursor description
+            columns = [desc[0] for desc in cursor.description]
+
+            cursor.close()
 
         results = [dict(zip(columns, row)) for row in rows]
 
@@ -202,153 +395,198 @@ class CompaniesHouseBot(scrapy.Spider):
     '''
     @staticmethod
     def calculate_matching_score(names1, names2):
-        total_names1 = len(names1)
-        total_names2 = len(names2)
-        max_score = 0
+        # all officer x founder pairs are scored in one batch, 1 for a perfect match otherwise the closest match from 0 to 1
+        return get_names_matching_score(names1, names2)
+
+
+    '''
+    Decides if a companies house search candidate is the crunchbase company. Officers are only requested if crunchbase
+    has founder names and the company name is a weak match. Returns (id_company, url_company) or None
+    '''
+    @staticmethod
+    def match_candidate(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on_dt, id_company,
+                        companieshouse_company_name, companieshouse_company_names_prev, companieshouse_founded_on_dt, score=0.85):
+
+        url_company = f'https://find-and-update.company-information.service.gov.uk/company/{id_company}'
+        url_officers = f'https://find-and-update.company-information.service.gov.uk/company/{id_company}/officers'
+
+        # an unknown incorporation date never matches the founding date
+        is_match_founded_fuzzy = companieshouse_founded_on_dt is not None and abs((crunchbase_founded_on_dt - companieshouse_founded_on_dt).days) <= 365
+
+        match_company_fuzzy = get_company_name_score([companieshouse_company_name] + companieshouse_company_names_prev, crunchbase_company_name)
+
+        is_match_company_fuzzy_weak = match_company_fuzzy >= MATCH_SCORE_WEAK
+        is_match_company_fuzzy_strong = match_company_fuzzy >= MATCH_SCORE_STRONG
+
+        is_match_company_name_exact = companieshouse_company_name.lower() == crunchbase_company_name.strip().lower() or \
+                                        companieshouse_company_name.lower() == crunchbase_company_name.strip().lower().replace('limited', 'ltd')  or \
+                                        companieshouse_company_name.lower() == crunchbase_company_name.strip().lower().replace('ltd', 'limited')
+
+        companieshouse_officers = []
+        msg = {'company_name_CB': crunchbase_company_name.upper(),
+               'company_name_CH': companieshouse_company_name.upper(),
+               'founded_on_CB': crunchbase_founded_on_dt.strftime('%Y-%m-%d'),
+               'founded_on_CH': companieshouse_founded_on_dt.strftime('%Y-%m-%d') if companieshouse_founded_on_dt else None,
+               'founders_CB': crunchbase_founder_names,
+               'officers_CH': companieshouse_officers,
+               'url_CH': url_company
+               }
+
+        # match by founder names
+        if crunchbase_founder_names and is_match_company_fuzzy_weak:
+            r_officers = session_get(url=url_officers)
+            html_officers = etree.HTML(r_officers.content)
+            companieshouse_officers = []
+
+            j = 1
+            for officer_element in html_officers.xpath('//div[@class="appointments-list"]/*'):
+                officer_name = CompaniesHouseBot.strip(html_officers.xpath(f"//div[@class='appointment-{j}']/h2/span/a/text()")[0]).title()
+                officer_string = etree.tostring(officer_element, encoding="unicode")
+                if not '<dt>Registration number</dt>' in officer_string:
+                    # if it contains a registration_element, it is not an officer but a company. this does not work all the time as sometimes companies do not havea registration element
+                    if is_organization(officer_name) == False:
+                        profile_name_split = officer_name.split(',')
+                        profile_name = profile_name_split[1].strip().split(' ')[0].strip() + ' ' + profile_name_split[0]
+                        profile_name = profile_name.title()
+                    else:
+                        profile_name = officer_name #could still be a company it seems
+                    companieshouse_officers.append(profile_name.title())
+                j += 1
+
+            msg['officers_CH'] = companieshouse_officers
+
+            officers_lower = [x.lower() for x in companieshouse_officers]
+            founders_lower = [x.lower() for x in crunchbase_founder_names]
+            matching_score = CompaniesHouseBot.calculate_matching_score(officers_lower, founders_lower)
+            if matching_score >= score:
+                logger.info(f'company: {crunchbase_company_name} successful match by FOUNDER NAME and DATE {json.dumps(msg)}')
+                return id_company, url_company
+            else:
+                logger.info(f'company: {crunchbase_company_name} unsuccessful match by FOUNDER NAME and DATE {json.dumps(msg)}')
+        # match by founding date
+        elif is_match_founded_fuzzy and is_match_company_fuzzy_strong:
+            logger.info(f'company: {crunchbase_company_name} successful match by COMPANY NAME and DATE {json.dumps(msg)}')
+            return id_company, url_company
+        elif is_match_company_name_exact:
+            logger.info(f'company: {crunchbase_company_name} successful match by COMPANY NAME {json.dumps(msg)}')
+            return id_company, url_company
+        else:
+            logger.info(f'company: {crunchbase_company_name} unsuccessful match by COMPANY NAME and DATE {json.dumps(msg)}')
+
+        return None
+
+    '''
+    Returns the candidates of a companies house search results page with company number, name, matching previous names
+    and the incorporation date of the result snippet. Dissolved companies show their dissolution date instead and have
+    no incorporation date
+    '''
+    @staticmethod
+    def parse_search_results(html_search, max_search_results=10):
+        candidates = []
+        ul_element = html_search.xpath("//ul[@id='results']")
+
+        if ul_element:
+            for li_element in ul_element[0].iter('li'): #company_href in html_search.xpath("//li[@class='type-company']/h3/a/@href"):
+                if len(candidates) >= max_search_results:
+                    break
 
-        # Check if there is a perfect match
-        if set(names1).intersection(names2):
-            return 1
+                a_element = li_element.find('.//a')
+                if a_element is None:
+                    continue
 
-        # Iterate over names1 and find the closest match
-        for name1 in names1:
-            max_name_score = 0
-            for name2 in names2:
-                name_score = fuzz.ratio(name1, name2)
-                if name_score > max_name_score:
-                    max_name_score = name_score
-            if max_name_score > max_score:
-                max_score = max_name_score
+                # check if companies house previous names are a match
+                companieshouse_company_names_prev = []
+                for matching_previous_names_element in li_element.xpath('.//p[contains(text(), "Matching previous names")]'):
+                    span_element = matching_previous_names_element.find('span')
+                    if span_element is not None and span_element.text:
+                        companieshouse_company_names_prev.append(span_element.text.strip())
 
-        # Calculate matching score
-        return max_score / 100  # Normalize score to range from 0 to 1
+                incorporated_on = None
+                incorporated_on_match = INCORPORATED_ON_PATTERN.search(' '.join(li_element.itertext()))
+                if incorporated_on_match:
+                    incorporated_on = datetime.strptime(CompaniesHouseBot.to_date(incorporated_on_match.group(1)), '%Y-%m-%d')
 
+                candidates.append({'company_number': a_element.get('href').split('/')[-1],
+                                   'name': a_element.text.strip(),
+                                   'names_prev': companieshouse_company_names_prev,
+                                   'incorporated_on': incorporated_on})
+
+        return candidates
 
     '''
     Searches for a company name in companies house based on two criteria. search only by name might not be sufficient. if loops through max_search_results to match a company AND one of 
     its founders (supplied by crunchbase) to identify a company. If founders are not available it uses founding date to 
-    confirm match.   
+    confirm match. Candidates are ranked first by name, previous names and the incorporation date of the search results
+    page. Candidates that can not match by name are dropped without requesting their pages and the rest are checked in
+    descending score order until the first match. If a local companies house index is supplied, candidates are
+    generated and ranked from the index and only the max_index_candidates best candidates are checked. The companies
+    house search is used if none of them matches, e.g. for companies incorporated or renamed after the index was built.
     '''
     @staticmethod
     def search(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on, max_search_results = 10,
-               score=0.85, brave_path=r'C:\Program Files\BraveSoftware\Brave-Browser\Application\brave.exe'):
+               score=0.85, brave_path=r'C:\Program Files\BraveSoftware\Brave-Browser\Application\brave.exe',
+               index=None, max_index_candidates=COMPANIESHOUSE_INDEX_CANDIDATES):
 
         # https://find-and-update.company-information.service.gov.uk/search?q=ANDFACTS+LIMITED
         crunchbase_company_name = crunchbase_company_name.strip()
-        search_name = crunchbase_company_name.replace(' ', '+')
-        url_search = f'https://find-and-update.company-information.service.gov.uk/search/companies?q={search_name}'
-        r_search = session.get(url=url_search)
-        html_search = etree.HTML(r_search.content)
-        i = 0
-        ul_element = html_search.xpath("//ul[@id='results']")
 
-        try:
-            if ul_element:
-                for li_element in ul_element[0].iter('li'): #company_href in html_search.xpath("//li[@class='type-company']/h3/a/@href"):
+        # founders are matched for weak company name matches, without founders a strong match is required
+        min_score = MATCH_SCORE_WEAK if crunchbase_founder_names else MATCH_SCORE_STRONG
 
-                    company_href = li_element.find('.//a').get('href')
-                    i += 1
-                    if i > max_search_results:
-                        break
-
-                    id_company = company_href.split('/')[-1]
-                    url_company = f'https://find-and-update.company-information.service.gov.uk/company/{id_company}'
-                    url_officers = f'https://find-and-update.company-information.service.gov.uk/company/{id_company}/officers'
-                    companieshouse_company_name = li_element.find('.//a').text.strip()
-
-                    # check if companies house previous names are a match
-                    matchin_previous_names_element = li_element.xpath('//p[contains(text(), "Matching previous names")]')
-                    companieshouse_company_name_prev = None
-                    if matchin_previous_names_element:
-                        companieshouse_company_name_prev = matchin_previous_names_element[0].find('span').text.strip()
-
-                    r_company = session.get(url=url_company)
-                    html_company = etree.HTML(r_company.content)
-
-                    crunchbase_founded_on_dt = datetime.strptime(crunchbase_founded_on, '%Y-%m-%d')
-                    companieshouse_founded_on_dt = crunchbase_founded_on_dt
-                    if html_company.xpath("//dd[@id='company-creation-date']/text()"):
-                        companieshouse_founded_on_dt = datetime.strptime(CompaniesHouseBot.to_date(html_company.xpath("//dd[@id='company-creation-date']/text()")[0]),'%Y-%m-%d')
-
-
-                    is_match_founded_fuzzy = abs((crunchbase_founded_on_dt - companieshouse_founded_on_dt).days) <= 365
-
-                    match_company_fuzzy = fuzz.ratio(companieshouse_company_name.lower(), crunchbase_company_name.lower()) / 100
-                    match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name.lower(), crunchbase_company_name.lower() +  ' ltd') / 100)
-                    match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name.lower(), crunchbase_company_name.lower() + ' limited') / 100)
-                    match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name.lower(), crunchbase_company_name.lower().replace('limited', 'ltd')) / 100)
-                    match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name.lower(), crunchbase_company_name.lower().replace('ltd', 'limited')) / 100)
-
-                    if companieshouse_company_name_prev:
-                        match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name_prev.lower(), crunchbase_company_name.lower()) / 100)
-                        match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name_prev.lower(), crunchbase_company_name.lower() + ' ltd') / 100)
-                        match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name_prev.lower(), crunchbase_company_name.lower() + ' limited') / 100)
-                        match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name_prev.lower(), crunchbase_company_name.lower().replace( 'limited', 'ltd')) / 100)
-                        match_company_fuzzy = max(match_company_fuzzy, fuzz.ratio(companieshouse_company_name_prev.lower(), crunchbase_company_name.lower().replace( 'ltd', 'limited')) / 100)
-
-                    is_match_company_fuzzy_weak = match_company_fuzzy >= 0.5
-                    is_match_company_fuzzy_strong = match_company_fuzzy >= 0.75
-
-                    is_match_company_name_exact = companieshouse_company_name.lower() == crunchbase_company_name.strip().lower() or \
-                                                    companieshouse_company_name.lower() == crunchbase_company_name.strip().lower().replace('limited', 'ltd')  or \
-                                                    companieshouse_company_name.lower() == crunchbase_company_name.strip().lower().replace('ltd', 'limited')
-
-                    companieshouse_officers = []
-                    msg = {'company_name_CB': crunchbase_company_name.upper(),
-                           'company_name_CH': companieshouse_company_name.upper(),
-                           'founded_on_CB': crunchbase_founded_on_dt.strftime('%Y-%m-%d'),
-                           'founded_on_CH': companieshouse_founded_on_dt.strftime('%Y-%m-%d'),
-                           'founders_CB': crunchbase_founder_names,
-                           'officers_CH': companieshouse_officers,
-                           'url_CH': url_company
-                           }
-
-                    # match by founder names
-                    if crunchbase_founder_names and is_match_company_fuzzy_weak:
-                        r_officers = session.get(url=url_officers)
-                        html_officers = etree.HTML(r_officers.content)
-                        companieshouse_officers = []
-
-                        j = 1
-                        for officer_element in html_officers.xpath('//div[@class="appointments-list"]/*'):
-                            officer_name = CompaniesHouseBot.strip(html_officers.xpath(f"//div[@class='appointment-{j}']/h2/span/a/text()")[0]).title()
-                            officer_string = etree.tostring(officer_element, encoding="unicode")
-                            if not '<dt>Registration number</dt>' in officer_string:
-                                # if it contains a registration_element, it is not an officer but a company. this does not work all the time as sometimes companies do not havea registration element
-                                if is_organization(officer_name) == False:
-                                    profile_name_split = officer_name.split(',')
-                                    profile_name = profile_name_split[1].strip().split(' ')[0].strip() + ' ' + profile_name_split[0]
-                                    profile_name = profile_name.title()
-                                else:
-                                    profile_name = officer_name #could still be a company it seems
-                                companieshouse_officers.append(profile_name.title())
-                            j += 1
-
-                        msg['officers_CH'] = companieshouse_officers
-
-                        officers_lower = [x.lower() for x in companieshouse_officers]
-                        founders_lower = [x.lower() for x in crunchbase_founder_names]
-                        matching_score = CompaniesHouseBot.calculate_matching_score(officers_lower, founders_lower)
-                        if matching_score >= score:
-                            logger.info(f'company: {crunchbase_company_name} successful match by FOUNDER NAME and DATE {json.dumps(msg)}')
-                            return id_company, url_company
-                        else:
-                            logger.info(f'company: {crunchbase_company_name} unsuccessful match by FOUNDER NAME and DATE {json.dumps(msg)}')
-                    # match by founding date
-                    elif is_match_founded_fuzzy and is_match_company_fuzzy_strong:
-                        logger.info(f'company: {crunchbase_company_name} successful match by COMPANY NAME and DATE {json.dumps(msg)}')
-                        return id_company, url_company
-                    elif is_match_company_name_exact:
-                        logger.info(f'company: {crunchbase_company_name} successful match by COMPANY NAME {json.dumps(msg)}')
-                        return id_company, url_company
-                    else:
-                        logger.info(f'company: {crunchbase_company_name} unsuccessful match by COMPANY NAME and DATE {json.dumps(msg)}')
+        try:
+            crunchbase_founded_on_dt = datetime.strptime(crunchbase_founded_on, '%Y-%m-%d')
+
+            if index is not None:
+                candidates = index.get_candidates(crunchbase_company_name, crunchbase_founded_on_dt, max_index_candidates, min_score)
+                for candidate in candidates:
+                    companieshouse_founded_on_dt = CompaniesHouseBot.get_incorporated_on(candidate)
+                    match = CompaniesHouseBot.match_candidate(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on_dt,
+                                                              candidate['company_number'], candidate['name'], candidate['names_prev'],
+                                                              companieshouse_founded_on_dt, score)
+                    if match:
+                        return match
+                logger.info(f'company: {crunchbase_company_name} no match among {len(candidates)} candidates in companies house index, searching companies house')
+
+            search_name = crunchbase_company_name.replace(' ', '+')
+            url_search = f'https://find-and-update.company-information.service.gov.uk/search/companies?q={search_name}'
+            r_search = session_get(url=url_search)
+            html_search = etree.HTML(r_search.content)
+
+            search_results = CompaniesHouseBot.parse_search_results(html_search, max_search_results)
+            candidates = rank_candidates(search_results, crunchbase_company_name, crunchbase_founded_on_dt, min_score)
+            logger.info(f'company: {crunchbase_company_name} {len(candidates)} of {len(search_results)} search results ranked for matching')
+
+            for candidate in candidates:
+                id_company = candidate['company_number']
+
+                companieshouse_founded_on_dt = CompaniesHouseBot.get_incorporated_on(candidate)
+                match = CompaniesHouseBot.match_candidate(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on_dt,
+                                                          id_company, candidate['name'], candidate['names_prev'],
+                                                          companieshouse_founded_on_dt, score)
+                if match:
+                    return match
 
         except Exception as ex:
             logger.error(f'company: {crunchbase_company_name} {str(ex)}')
 
         return None
 
+    '''
+    Returns the incorporation date of a search candidate. The company page is only requested if the search results
+    page or the index did not have the date. None if the company page has no date either
+    '''
+    @staticmethod
+    def get_incorporated_on(candidate):
+        if candidate['incorporated_on'] is not None:
+            return candidate['incorporated_on']
+
+        url_company = f'https://find-and-update.company-information.service.gov.uk/company/{candidate["company_number"]}'
+        r_company = session_get(url=url_company)
+        html_company = etree.HTML(r_company.content)
+        if html_company.xpath("//dd[@id='company-creation-date']/text()"):
+            return datetime.strptime(CompaniesHouseBot.to_date(html_company.xpath("//dd[@id='company-creation-date']/text()")[0]),'%Y-%m-%d')
+        return None
+
     def get_requests(self):
         yield scrapy.Request(self.company_url, self.parse_company_info)
         yield scrapy.Request(self.officers_url, self.parse_officers)
@@ -360,8 +598,21 @@ class CompaniesHouseBot(scrapy.Spider):
         yield from self.get_requests()
 
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def spider_idle(self, spider):
+        # document jobs run outside of scrapy, keep the spider open until their results are in self.data
+        if self.document_jobs_count > 0:
+            raise DontCloseSpider
+
     def closed(self, reason):
-        pass
+        # rows of this company are written when the spider closes instead of when the process exits
+        if self.is_write_db:
+            return flush_batch_writer()
 
     @staticmethod
     def to_date(dt_string):
@@ -561,42 +812,10 @@ class CompaniesHouseBot(scrapy.Spider):
     def write(self, uuid, name, json_rest_api):
 
         try:
-            cursor = self.conn.cursor()
-
-            table_name = 'data'
-            dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-            data_str = json.dumps(json_rest_api)
-
-            d = {'uuid': uuid, 'uuid_parent': uuid, 'name': name, 'source': DataSource.companieshouse.name, 'version':self.__version__, 'created_at': dt, 'updated_at': dt, 'data': data_str}
-            columns = d.keys()
-            values = tuple(d.values())
-
-            # write data to db
-            query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (uuid, source) DO UPDATE SET data = EXCLUDED.data, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
-            # query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ('{values[0]}', '{values[1]}', '{values[2]}', '{values[3]}', '{values[4]}', '{values[5]}', '{values[6]}')"
-            # print(f'query_data 1: {query_data}')
-            cursor.execute(query_data, values)
-            # print(f'query_data 2: {query_data}')
-
-            # update pending table
-            query_pending = f"UPDATE pending SET status = '{PendingStatus.completed.name}', updated_at = '{dt}'  WHERE uuid = '{uuid}' AND source = '{DataSource.companieshouse.name}'"
-
-            # print(f'query_pending 1: {query_data}')
-            cursor.execute(query_pending)
-            # print(f'query_pending 2: {query_data}')
-
             # write pending table for linkedin. this is done so that we immidiately have pending record for linked in officers
             # when a new linkedin record is written if a record is already existing in
-            # pending table DO NOTHING ON CONFLICT
-            columns_companieshouse = ['uuid', 'uuid_parent', 'name', 'legal_name', 'category_groups_list', 'founded_on', 'source',
-                                       'status', 'version', 'created_at', 'updated_at']
-
-            source = DataSource.linkedin.name
-            status = PendingStatus.pending.name
-            version = ''
-            created_at = dt
-            updated_at = dt
-
+            # pending table DO NOTHING ON CONFLICT. persons are resolved before anything is buffered, so a failure
+            # does not leave a half written company behind
             persons = get_persons(self.data)
             # convert to usable format (input into LinkedInBot)
 
@@ -605,6 +824,9 @@ class CompaniesHouseBot(scrapy.Spider):
             print(json.dumps(persons))
             print('\n')
 
+            self.writer.write_data(uuid, uuid, name, DataSource.companieshouse.name, self.__version__, json_rest_api)
+            self.writer.set_pending_status(uuid, DataSource.companieshouse.name, PendingStatus.completed)
+
             for item in persons['items']:
                 profile_name = item['profile_name'].title()
                 name = item['name'].title()
@@ -613,24 +835,13 @@ class CompaniesHouseBot(scrapy.Spider):
                 uuid_profile = item['uuid']
                 occupations = item['occupation']
 
-                values_pending_companieshouse = [uuid_profile, uuid, profile_name, name, occupations, date_of_birth, source, status,
-                                                  version, created_at, updated_at]
-
-                query_pending_linkedin = f"INSERT INTO pending ({', '.join(columns_companieshouse)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " \
-                                                f"ON CONFLICT DO NOTHING"
-
-                cursor.execute(query_pending_linkedin, values_pending_companieshouse)
+                self.writer.insert_pending(uuid_profile, uuid, profile_name, name, None, occupations, date_of_birth, DataSource.linkedin.name)
 
-        except psycopg2.Error as e:
-            logger.error(f"company: {self.crunchbase_company_name} write executing queries: {str(e)}")
-            self.conn.rollback()
         except Exception as e:
             logger.error(f"company: {self.crunchbase_company_name} write: {str(e)}")
         else:
-            self.conn.commit()
-            logger.info(f'company: {self.crunchbase_company_name} writing data successful from source: {DataSource.companieshouse.name} status: {PendingStatus.completed.name} company: {name}')
-        finally:
-            cursor.close()
+            # rows are written by the batch writer later, database errors are logged by its flush
+            logger.info(f'company: {self.crunchbase_company_name} writing data queued from source: {DataSource.companieshouse.name} status: {PendingStatus.completed.name} company: {name}')
 
 
     def write_to_file(self):
@@ -742,13 +953,10 @@ class CompaniesHouseBot(scrapy.Spider):
         rows = response.xpath(f'//table[@id="fhTable"][@class="full-width-table"]/tr[*]')
         if len(rows) <= 1: #means the table is not existing for this page and we return the stored data
             # since this is a recursive function. this is the last time it is called
-            self.parse_group_count += 1
-            logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} completed. count: {self.parse_group_count}')
+            self.is_filing_parsed = True
+            logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} parsed. document jobs: {self.document_jobs_count}')
             logger.debug(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} data: {json.dumps(self.filing_dict)}')
-            if self.parse_group_count == self.parse_group_num:
-                self.finished(self.data)
-                if self.callback_finish: self.callback_finish(self.data)
-
+            self.complete_filing()
             return
         elif len(rows) == 2 and 'Company added to register' in rows[1].xpath('.//td/text()').extract()[2]:
             logger.info(
@@ -784,14 +992,8 @@ class CompaniesHouseBot(scrapy.Spider):
                             else:
                                 raise ValueError('updates not found in confirmation statement string')
 
-                            confirmation_statement = self.parse_confirmation_statement_ocr(url, filing_dt, self.poppler_path)
-                            self.data['cards']['shareholding'][received_dt] = {}
-                            self.data['cards']['shareholding'][received_dt]['source'] = 'Confirmation Statement'
-                            self.data['cards']['shareholding'][received_dt]['url'] = url
-                            self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
-                            self.data['cards']['shareholding'][received_dt]['filing_date'] = filing_dt
-                            self.data['cards']['shareholding'][received_dt]['update'] = update
-                            self.data['cards']['shareholding'][received_dt]['items'] = confirmation_statement['FULL DETAILS OF SHAREHOLDERS']
+                            self.start_document_job('Confirmation Statement', self.parse_confirmation_statement_ocr, (url, filing_dt, self.poppler_path),
+                                                    self.set_confirmation_statement, url, received_dt, filing_dt, update)
 
                         elif 'annual return' in description.lower():
                             d = self.strip(row.xpath(f'//table[@id="fhTable"][@class="full-width-table"]/tr[{i}]/td[3]').get())
@@ -805,33 +1007,13 @@ class CompaniesHouseBot(scrapy.Spider):
                                 # raise ValueError('updates not found in confirmation statement string')
 
                             update = True
-                            annual_return_dict = self.parse_annual_return_ocr(url, filing_dt, self.poppler_path)
-                            self.data['cards']['shareholding'][received_dt] = {}
-                            self.data['cards']['shareholding'][received_dt]['source'] = 'Annual Return'
-                            self.data['cards']['shareholding'][received_dt]['url'] = url
-                            self.data['cards']['shareholding'][received_dt]['filing_date'] = filing_dt
-                            self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
-                            self.data['cards']['shareholding'][received_dt]['update'] = update
-                            self.data['cards']['shareholding'][received_dt]['items'] = annual_return_dict['FULL DETAILS OF SHAREHOLDERS']
+                            self.start_document_job('Annual Return', self.parse_annual_return_ocr, (url, filing_dt, self.poppler_path),
+                                                    self.set_annual_return, url, received_dt, filing_dt, update)
 
                         elif 'incorporation' in description.lower():
                             update = True
-                            incorporation = self.parse_incorporation_ocr(url, received_dt, self.poppler_path)
-                            if 'error' not in incorporation:
-                                self.data['cards']['incorporation']['url'] = url
-                                self.data['cards']['incorporation']['received_date'] = received_dt
-                                self.data['cards']['incorporation']['update'] = update
-                                self.data['cards']['incorporation']['items'] = incorporation['INITIAL SHAREHOLDINGS']
-                                self.data['cards']['shareholding'][received_dt] = {}
-                                self.data['cards']['shareholding'][received_dt]['source'] = 'Incorporation'
-                                self.data['cards']['shareholding'][received_dt]['url'] = url
-                                self.data['cards']['shareholding'][received_dt]['filing_date'] = received_dt
-                                self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
-                                self.data['cards']['shareholding'][received_dt]['update'] = update
-                                self.data['cards']['shareholding'][received_dt]['items'] = incorporation['INITIAL SHAREHOLDINGS']
-                            else:
-                                self.data['cards']['incorporation']['url'] = url
-                                self.data['cards']['incorporation']['error'] = incorporation['error']
+                            self.start_document_job('Incorporation', self.parse_incorporation_ocr, (url, received_dt, self.poppler_path),
+                                                    self.set_incorporation, url, received_dt, update)
                 i += 1
 
         except Exception as ex:
@@ -842,7 +1024,85 @@ class CompaniesHouseBot(scrapy.Spider):
         next_page_url = f'https://find-and-update.company-information.service.gov.uk/company/{self.company_id}/filing-history?page={self.page_number_filing}'  #response.xpath(f'//ul[@class="pager"]/li[{self.page_number}]/a/@href').get()
         yield scrapy.Request(next_page_url, self.parse_filing)
 
-    def parse_confirmation_statement_ocr(self, url, dt, poppler_path, psm=4):
+    '''
+    Runs a blocking document parser (pdf download and OCR) in the reactor thread pool so that other requests of this and
+    other spiders continue meanwhile. on_content is called with the parsed content and on_content_args in the reactor
+    thread and folds it into self.data. A failed document does not stop the company from being written, it is recorded in
+    the filing_error card by received date, so the missing shareholding is visible in the written data
+    '''
+    def start_document_job(self, source, parse, parse_args, on_content, url, received_dt, *on_content_args):
+        self.document_jobs_count += 1
+
+        job = document_semaphore.run(threads.deferToThread, parse, *parse_args)
+        job.addCallback(on_content, url, received_dt, *on_content_args)
+        job.addErrback(self.document_job_failed, source, url, received_dt)
+        job.addBoth(self.document_job_done)
+        return job
+
+    def document_job_failed(self, failure, source, url, received_dt):
+        logger.error(f'company: {self.crunchbase_company_name} {source} {failure.getErrorMessage()} {str(url)}')
+        filing_error = self.data['cards'].setdefault('filing_error', {})
+        filing_error[received_dt] = {}
+        filing_error[received_dt]['source'] = source
+        filing_error[received_dt]['url'] = url
+        filing_error[received_dt]['received_date'] = received_dt
+        filing_error[received_dt]['error'] = failure.getErrorMessage()
+
+    def document_job_done(self, _):
+        self.document_jobs_count -= 1
+        self.complete_filing()
+
+    def complete_filing(self):
+        if not self.is_filing_parsed or self.document_jobs_count > 0 or self.is_filing_completed:
+            return
+
+        self.is_filing_completed = True
+        self.parse_group_count += 1
+        logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} completed. count: {self.parse_group_count}')
+        if self.parse_group_count == self.parse_group_num:
+            self.finished(self.data)
+            if self.callback_finish: self.callback_finish(self.data)
+
+    def set_confirmation_statement(self, confirmation_statement, url, received_dt, filing_dt, update):
+        self.data['cards']['shareholding'][received_dt] = {}
+        self.data['cards']['shareholding'][received_dt]['source'] = 'Confirmation Statement'
+        self.data['cards']['shareholding'][received_dt]['url'] = url
+        self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
+        self.data['cards']['shareholding'][received_dt]['filing_date'] = filing_dt
+        self.data['cards']['shareholding'][received_dt]['update'] = update
+        self.data['cards']['shareholding'][received_dt]['items'] = confirmation_statement['FULL DETAILS OF SHAREHOLDERS']
+
+    def set_annual_return(self, annual_return_dict, url, received_dt, filing_dt, update):
+        self.data['cards']['shareholding'][received_dt] = {}
+        self.data['cards']['shareholding'][received_dt]['source'] = 'Annual Return'
+        self.data['cards']['shareholding'][received_dt]['url'] = url
+        self.data['cards']['shareholding'][received_dt]['filing_date'] = filing_dt
+        self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
+        self.data['cards']['shareholding'][received_dt]['update'] = update
+        self.data['cards']['shareholding'][received_dt]['items'] = annual_return_dict['FULL DETAILS OF SHAREHOLDERS']
+
+    def set_incorporation(self, incorporation, url, received_dt, update):
+        if 'error' not in incorporation:
+            self.data['cards']['incorporation']['url'] = url
+            self.data['cards']['incorporation']['received_date'] = received_dt
+            self.data['cards']['incorporation']['update'] = update
+            self.data['cards']['incorporation']['items'] = incorporation['INITIAL SHAREHOLDINGS']
+            self.data['cards']['shareholding'][received_dt] = {}
+            self.data['cards']['shareholding'][received_dt]['source'] = 'Incorporation'
+            self.data['cards']['shareholding'][received_dt]['url'] = url
+            self.data['cards']['shareholding'][received_dt]['filing_date'] = received_dt
+            self.data['cards']['shareholding'][received_dt]['received_date'] = received_dt
+            self.data['cards']['shareholding'][received_dt]['update'] = update
+            self.data['cards']['shareholding'][received_dt]['items'] = incorporation['INITIAL SHAREHOLDINGS']
+        else:
+            self.data['cards']['incorporation']['url'] = url
+            self.data['cards']['incorporation']['error'] = incorporation['error']
+
+    '''
+    A retry passes the downloaded pdf, the rendered images and the shareholder pages of the first attempt, with the
+    section the first of them starts in, so that only tesseract runs again and only on these pages
+    '''
+    def parse_confirmation_statement_ocr(self, url, dt, poppler_path, psm=4, pdf=None, images=None, page_numbers=None, key='COMPANY INFORMATION'):
         # output_string = StringIO()
         # # p = 'C:\\projects\\uni\\sources\\companieshouse\\data\\test\\annual_return\\annual_return_AR01__07101408__20141210.pdf'
         # p = 'C:\\projects\\uni\\sources\\companieshouse\\data\\test\\annual_return\\annual_return_AR01__07110878__20171222.pdf'
@@ -856,8 +1116,11 @@ class CompaniesHouseBot(scrapy.Spider):
 
         logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} date: {str(dt)} url: {url}')
 
-        r = session.get(url=url)
-        pages = convert_from_bytes(r.content, poppler_path=poppler_path)
+        if pdf is None:
+            pdf = session_get(url=url).content
+        images = {} if images is None else images
+        # the psm 6 retry OCRs the document in case its text layer could not be parsed
+        pages = ocr_engine.iter_pdf_pages(pdf, psm, poppler_path, use_text_layer=psm == 4, page_numbers=page_numbers, images=images)
 
         # Read text from images using OCR
 
@@ -881,10 +1144,13 @@ class CompaniesHouseBot(scrapy.Spider):
                     'AUTHORISATION': []
                     }
 
-        key = 'COMPANY INFORMATION'
+        shareholders_page_numbers = []
+        page_keys = {}
 
-        for img in pages:
-            page = pytesseract.image_to_string(img, config=f'--psm {psm}').split('\n')
+        for page_number, text in pages:
+            page = text.split('\n')
+            page_keys[page_number] = key
+            shareholders_count = len(sections['FULL DETAILS OF SHAREHOLDERS'])
 
             for line in page:
 
@@ -910,6 +1176,13 @@ class CompaniesHouseBot(scrapy.Spider):
                     key = 'AUTHORISATION'
                 sections[key].append(line)
 
+            if len(sections['FULL DETAILS OF SHAREHOLDERS']) > shareholders_count:
+                shareholders_page_numbers.append(page_number)
+
+            # the shareholders are complete once a page ends in a later section, the remaining pages are not needed
+            if sections['FULL DETAILS OF SHAREHOLDERS'] and key in ['PERSON WITH SIGNIFICANT CONTROL (PSC)', 'CONFIRMATION STATEMENT', 'AUTHORISATION']:
+                break
+
         # COMPANY INFORMATION ARE not parsed from this document since its information is available on website. the only additional data that this document posseses are historical addresses which are not important at this stage
         # OFFICERS OF THE COMPANY are not parsed from this document since its full history is available on website
         # STATEMENT OF CAPITAL (SHARE CAPITAL) are not parsed as most information can be deducted from FULL DETAILS OF SHAREHOLDERS
@@ -976,7 +1249,9 @@ class CompaniesHouseBot(scrapy.Spider):
             if psm == 4:
                 logger.info(f'company retrying with psm 6: {self.crunchbase_company_name} page: {self.page_number_filing} {str(line)} {str(lst)} {str(ex)}')
                 try:
-                    content = self.parse_confirmation_statement_ocr(url, dt, poppler_path, psm=6)
+                    content = self.parse_confirmation_statement_ocr(url, dt, poppler_path, psm=6, pdf=pdf, images=images,
+                                                                    page_numbers=shareholders_page_numbers or None,
+                                                                    key=page_keys[shareholders_page_numbers[0]] if shareholders_page_numbers else 'COMPANY INFORMATION')
                     return content
                 except Exception as ex:
                     raise ValueError(f'cannot parse confirmation statement str{ex}')
@@ -984,7 +1259,14 @@ class CompaniesHouseBot(scrapy.Spider):
         logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} completed. {str(dt)} {url}')
         return content
 
-    def parse_annual_return_ocr(self, url, dt, poppler_path, psm=4):
+    '''
+    A retry passes the downloaded pdf, the rendered images and the shareholder pages of the first attempt, with the
+    section the first of them starts in, so that only tesseract runs again and only on these pages
+    '''
+    def parse_annual_return_ocr(self, url, dt, poppler_path, psm=4, pdf=None, images=None, page_numbers=None, key='COMPANY INFORMATION'):
+        images = {} if images is None else images
+        shareholders_page_numbers = []
+        page_keys = {}
         try:
             # output_string = StringIO()
             # # p = 'C:\\projects\\uni\\sources\\companieshouse\\data\\test\\annual_return\\annual_return_AR01__07101408__20141210.pdf'
@@ -999,8 +1281,9 @@ class CompaniesHouseBot(scrapy.Spider):
 
             logger.info(f'company: {self.crunchbase_company_name} date: {str(dt)} url: {url}')
 
-            r = session.get(url=url)
-            pages = convert_from_bytes(r.content, poppler_path=poppler_path)
+            if pdf is None:
+                pdf = session_get(url=url).content
+            pages = ocr_engine.iter_pdf_pages(pdf, psm, poppler_path, use_text_layer=psm == 4, page_numbers=page_numbers, images=images)
 
             # Read text from images using OCR
 
@@ -1008,10 +1291,10 @@ class CompaniesHouseBot(scrapy.Spider):
                         'STATEMENT OF CAPITAL (TOTALS)': [], 'FULL DETAILS OF SHAREHOLDERS': [], 'AUTHORISATION': [],
                         }
 
-            key = 'COMPANY INFORMATION'
-
-            for img in pages:
-                page = pytesseract.image_to_string(img, config=f'--psm {psm}').split('\n')
+            for page_number, text in pages:
+                page = text.split('\n')
+                page_keys[page_number] = key
+                shareholders_count = len(sections['FULL DETAILS OF SHAREHOLDERS'])
 
                 for line in page:
 
@@ -1034,6 +1317,13 @@ class CompaniesHouseBot(scrapy.Spider):
                         key = 'AUTHORISATION'
                     sections[key].append(line)
 
+                if len(sections['FULL DETAILS OF SHAREHOLDERS']) > shareholders_count:
+                    shareholders_page_numbers.append(page_number)
+
+                # the shareholders are complete once a page ends in the authorisation, the remaining pages are not needed
+                if sections['FULL DETAILS OF SHAREHOLDERS'] and key == 'AUTHORISATION':
+                    break
+
             # COMPANY INFORMATION ARE not parsed from this document since its information is available on website. the only additional data that this document posseses are historical addresses which are not important at this stage
             # OFFICERS OF THE COMPANY are not parsed from this document since its full history is available on website
             # STATEMENT OF CAPITAL (SHARE CAPITAL) are not parsed as most information can be deducted from FULL DETAILS OF SHAREHOLDERS
@@ -1096,7 +1386,9 @@ class CompaniesHouseBot(scrapy.Spider):
             if psm == 4:
                 logger.info(f'company retrying with psm 6: {self.crunchbase_company_name} page: {self.page_number_filing} {str(line)} {str(lst)} {str(ex)}')
                 try:
-                    content = self.parse_annual_return_ocr(url, dt, poppler_path, psm=6)
+                    content = self.parse_annual_return_ocr(url, dt, poppler_path, psm=6, pdf=pdf, images=images,
+                                                           page_numbers=shareholders_page_numbers or None,
+                                                           key=page_keys[shareholders_page_numbers[0]] if shareholders_page_numbers else 'COMPANY INFORMATION')
                     return content
                 except Exception as ex:
                     raise ValueError(f'cannot parse confirmation statement str(ex)')
@@ -1167,8 +1459,9 @@ class CompaniesHouseBot(scrapy.Spider):
         logger.info(f'company: {self.crunchbase_company_name} page: {self.page_number_filing} date: {str(dt)} url: {url}')
 
         # Convert PDF to image
-        r = session.get(url=url)
-        pages = convert_from_bytes(r.content, poppler_path=poppler_path)
+        r = session_get(url=url)
+        # pages after the initial shareholdings are not rendered and OCR'd once Found stops the iteration
+        pages = ocr_engine.iter_pdf_pages(r.content, 6, poppler_path)
 
         # Read text from images using OCR
 
@@ -1186,10 +1479,9 @@ class CompaniesHouseBot(scrapy.Spider):
 
 
         try:
-            page_num = 1
             is_electronic_document = False
-            for img in pages:
-                page = pytesseract.image_to_string(img, config='--psm 6').split('\n')
+            for page_num, text in pages:
+                page = text.split('\n')
 
                 for line in page:
                     # OFFICERS OF THE COMPANY
@@ -1209,7 +1501,6 @@ class CompaniesHouseBot(scrapy.Spider):
                                 raise Found
 
                         sections[key].append(line)
-                page_num += 1
 
         except Found:
             # found initial shareholdings
@@ -1315,6 +1606,39 @@ def run_companieshouse_bot(uuids_filter='*', category_groups_list_filter='*', co
                            force=False, callback_finish=None):
     run_companieshouse_bot_defer(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter, force, callback_finish)
     reactor.run()
+def get_crunchbase_company_name(row):
+    if row['legal_name'] == '' or row['legal_name'] is None:
+        return row['name']
+    return row['legal_name']
+
+'''
+Searches companies house for a pending row and returns (uuid, msg, search_results). This blocks on http requests and
+is run in the reactor thread pool by run_companieshouse_bot_defer
+'''
+def search_pending(row, index=None):
+    crunchbase_company_name = get_crunchbase_company_name(row)
+
+    uuid = row['crunchbase_data']['properties']['uuid']
+    crunchbase_founded_on = row['crunchbase_data']['properties']['founded_on']['value']
+    crunchbase_founder_names = []
+
+    if 'founder_identifiers' in row['crunchbase_data']['properties']:
+        if row['crunchbase_data']['properties']['founder_identifiers'] != []:
+            crunchbase_founder_names = [x['value'] for x in row['crunchbase_data']['properties']['founder_identifiers']]
+    elif 'founders' in row['crunchbase_data']['properties']:
+        if row['crunchbase_data']['cards']['founders'] != []:
+            raise NotImplementedError()
+
+    msg = {'company_name_CB': crunchbase_company_name.upper(),
+           'founded_on_CB': crunchbase_founded_on,
+           'founders_CB': crunchbase_founder_names,
+           }
+
+    logger.info(f'company: {crunchbase_company_name} searching for: {json.dumps(msg)}')
+
+    search_results = CompaniesHouseBot.search(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on, 10, 0.85, BRAVE_PATH, index)
+    return uuid, msg, search_results
+
 '''
 if uuids are not supplied, all companies that are pending in pending table will be scraped
 if force is True, then pending status completed will be ignored and scraped again 
@@ -1330,40 +1654,57 @@ def run_companieshouse_bot_defer(uuids_filter='*', category_groups_list_filter='
     # Set the log level to suppress warning messages
     settings = get_project_settings()
 
-    data = CompaniesHouseBot.get_data_from_pending(uuids_filter, '*', category_groups_list_filter, country_code_filter, from_filter, to_filter, force)
-
-    # data = [data[8]]
-    if len(data) == 0:
+    # pending rows are read a page at a time when the searches ahead of the crawls need them. data holds the rows not
+    # crawled yet by their position, count is the number of rows read so far
+    page_size = max(COMPANIESHOUSE_PENDING_PAGE_SIZE, COMPANIESHOUSE_SEARCH_LOOKAHEAD + 1)
+    data = {}
+    count = 0
+    after = None
+    is_exhausted = False
+
+    @defer.inlineCallbacks
+    def read_pending(i):
+        nonlocal count, after, is_exhausted
+        while not is_exhausted and i + COMPANIESHOUSE_SEARCH_LOOKAHEAD >= count:
+            rows = yield threads.deferToThread(CompaniesHouseBot.get_data_from_pending, uuids_filter, '*', category_groups_list_filter, country_code_filter,
+                                               from_filter, to_filter, force, page_size, after)
+            for row in rows:
+                data[count] = row
+                count += 1
+            is_exhausted = len(rows) < page_size
+            if rows:
+                after = (rows[-1]['name'], rows[-1]['uuid'])
+
+    yield read_pending(0)
+    if count == 0:
         logger.info(f'no companies found that are pending.')
         return
 
-    runner = CrawlerRunner(settings)
-    for row in data:
-        try:
-            if row['legal_name'] == '' or row['legal_name'] is None:
-                crunchbase_company_name = row['name']
-            else:
-                crunchbase_company_name = row['legal_name']
-
-            uuid = row['crunchbase_data']['properties']['uuid']
-            crunchbase_founded_on = row['crunchbase_data']['properties']['founded_on']['value']
-            crunchbase_founder_names = []
+    index = get_companieshouse_index()
+    if index is not None:
+        logger.info(f'using companies house index {index.path} to search for companies.')
 
-            if 'founder_identifiers' in row['crunchbase_data']['properties']:
-                if row['crunchbase_data']['properties']['founder_identifiers'] != []:
-                    crunchbase_founder_names = [x['value'] for x in row['crunchbase_data']['properties']['founder_identifiers']]
-            elif 'founders' in row['crunchbase_data']['properties']:
-                if row['crunchbase_data']['cards']['founders'] != []:
-                    raise NotImplementedError()
+    # searches use blocking requests and run in the reactor thread pool. searches for the next companies run while
+    # the current company is crawled, at most COMPANIESHOUSE_SEARCH_CONCURRENCY at a time
+    search_semaphore = defer.DeferredSemaphore(COMPANIESHOUSE_SEARCH_CONCURRENCY)
+    searches = {}
 
-            msg = {'company_name_CB': crunchbase_company_name.upper(),
-                   'founded_on_CB': crunchbase_founded_on,
-                   'founders_CB': crunchbase_founder_names,
-                   }
+    def start_searches(i):
+        for j in range(i, min(i + COMPANIESHOUSE_SEARCH_LOOKAHEAD + 1, count)):
+            if j not in searches:
+                searches[j] = search_semaphore.run(threads.deferToThread, search_pending, data[j], index)
 
-            logger.info(f'company: {crunchbase_company_name} searching for: {json.dumps(msg)}')
+    # up to COMPANIESHOUSE_CRAWL_CONCURRENCY spiders run at the same time, the next company is started when a slot frees up
+    crawl_semaphore = defer.DeferredSemaphore(COMPANIESHOUSE_CRAWL_CONCURRENCY)
+    # the reactor thread pool runs searches and document jobs
+    reactor.suggestThreadPoolSize(COMPANIESHOUSE_SEARCH_CONCURRENCY + COMPANIESHOUSE_DOCUMENT_WORKERS)
+    runner = CrawlerRunner(settings)
 
-            search_results = CompaniesHouseBot.search(crunchbase_company_name, crunchbase_founder_names, crunchbase_founded_on, 10, 0.85, BRAVE_PATH)
+    @defer.inlineCallbacks
+    def crawl(i, row):
+        crunchbase_company_name = get_crunchbase_company_name(row)
+        try:
+            uuid, msg, search_results = yield searches.pop(i)
 
             if search_results:
                 company_id, company_url = search_results
@@ -1384,57 +1725,45 @@ def run_companieshouse_bot_defer(uuids_filter='*', category_groups_list_filter='
                 logger.warning(f'company: {crunchbase_company_name} not found {json.dumps(msg)}.')
                 json_rest_api = CompaniesHouseErrorCodes.company_not_found
                 write_failed(uuid, crunchbase_company_name, json_rest_api)
+                yield flush_batch_writer()
 
         except Exception as ex:
             logger.error(f'company: {crunchbase_company_name} {str(ex)}')
+        finally:
+            crawl_semaphore.release()
 
-    reactor.active()
+    crawls = []
+    i = 0
+    while i < count:
+        yield crawl_semaphore.acquire()
+        yield read_pending(i)
+        start_searches(i)
+        crawls.append(crawl(i, data.pop(i)))
+        i += 1
 
-def write_failed(uuid, crunchbase_company_name, json_rest_api):
+    yield defer.DeferredList(crawls)
 
-    conn = psycopg2.connect(
-                host=DB_HOST,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                port=DB_PORT
-            )
-
-    try:
-        cursor = conn.cursor()
-
-        dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-        data_str = json.dumps(json_rest_api)
+    reactor.active()
 
-        d = {'uuid': uuid, 'uuid_parent': uuid, 'name': crunchbase_company_name, 'source': DataSource.companieshouse.name,
-             'version': CompaniesHouseBot.__version__, 'created_at': dt, 'updated_at': dt, 'data': data_str}
-        columns = d.keys()
-        values = tuple(d.values())
+def flush_batch_writer():
+    # flushes the shared batch writer in the reactor thread pool. flush errors are logged, the rows stay queued
+    def log_error(failure):
+        logger.error(f'Batch writer flush failed, {len(get_batch_writer())} rows not written: {failure.getErrorMessage()}')
 
-        table_name = 'data'
-        # write data to db
-        query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (uuid, source) DO UPDATE SET data = EXCLUDED.data, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
-        # query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ('{values[0]}', '{values[1]}', '{values[2]}', '{values[3]}', '{values[4]}', '{values[5]}', '{values[6]}')"
-        # print(f'query_data 1: {query_data}')
-        cursor.execute(query_data, values)
+    return threads.deferToThread(get_batch_writer().flush).addErrback(log_error)
 
-        # update pending table
-        query_pending = f"UPDATE pending SET status = '{PendingStatus.completed.name}', updated_at = '{dt}'  WHERE uuid = '{uuid}' AND source = '{DataSource.companieshouse.name}'"
+def write_failed(uuid, crunchbase_company_name, json_rest_api):
 
-        # print(f'query_pending 1: {query_data}')
-        cursor.execute(query_pending)
+    try:
+        writer = get_batch_writer()
+        writer.write_data(uuid, uuid, crunchbase_company_name, DataSource.companieshouse.name, CompaniesHouseBot.__version__, json_rest_api)
+        writer.set_pending_status(uuid, DataSource.companieshouse.name, PendingStatus.completed)
 
-    except psycopg2.Error as e:
-        logger.error(f"company: {crunchbase_company_name} write executing queries: {str(e)}")
-        conn.rollback()
     except Exception as e:
         logger.error(f"company: {crunchbase_company_name} write: {str(e)}")
     else:
-        conn.commit()
         logger.info(
-        f'company: {crunchbase_company_name} writing failed data successful from source: {DataSource.companieshouse.name} status: {PendingStatus.completed.name} company: {crunchbase_company_name}')
-    finally:
-        cursor.close()
+        f'company: {crunchbase_company_name} writing failed data queued from source: {DataSource.companieshouse.name} status: {PendingStatus.completed.name} company: {crunchbase_company_name}')
 
 def run_companieshouse_bot_by_company_id(company_house_id='07101408', callback_finish=None):
     # companies house crawler
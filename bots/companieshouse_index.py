@@ -0,0 +1,220 @@
+import csv, io, os, re, sqlite3, threading, zipfile
+from datetime import datetime
+
+from bots.common import logger
+from bots.config import COMPANIESHOUSE_INDEX_PATH
+from bots.matching import rank_candidates
+
+COMPANY_NAME_SUFFIXES = {'ltd', 'limited', 'plc', 'llp', 'lp', 'cic', 'cyf', 'cyfyngedig', 'ccc', 'cwmni'}
+PREVIOUS_NAME_PATTERN = re.compile(r'^PreviousName_\d+\.CompanyName$')
+INDEX_BATCH_SIZE = 50000
+
+
+'''
+Returns the company name in lower case without punctuation and legal suffixes such as ltd or limited, so that
+"MADE.COM DESIGN LTD" and "Made.com Design Limited" are both indexed as "made com design"
+'''
+def normalize_company_name(name):
+    name = name.lower().replace('&', ' and ')
+    tokens = re.sub(r'[^a-z0-9]+', ' ', name).split()
+    return ' '.join(token for token in tokens if token not in COMPANY_NAME_SUFFIXES)
+
+
+def get_trigrams(normalized_name):
+    padded = f'  {normalized_name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+'''
+Yields dictionaries for each company of the companies house free company data product. filename can be a single csv
+file or the zip file as downloaded from http://download.companieshouse.gov.uk/en_output.html
+'''
+def iter_companies_from_csv(filename):
+    def iter_rows(file):
+        reader = csv.reader(file)
+        columns = [column.strip() for column in next(reader)]
+        name_index = columns.index('CompanyName')
+        number_index = columns.index('CompanyNumber')
+        status_index = columns.index('CompanyStatus')
+        incorporation_index = columns.index('IncorporationDate')
+        previous_name_indexes = [i for i, column in enumerate(columns) if PREVIOUS_NAME_PATTERN.match(column)]
+
+        for row in reader:
+            if len(row) < len(columns):
+                continue
+            try:
+                incorporated_on = datetime.strptime(row[incorporation_index], '%d/%m/%Y').strftime('%Y-%m-%d')
+            except ValueError:
+                incorporated_on = None
+            yield {'company_number': row[number_index].strip(),
+                   'name': row[name_index].strip(),
+                   'names_prev': [row[i].strip() for i in previous_name_indexes if row[i].strip()],
+                   'status': row[status_index].strip(),
+                   'incorporated_on': incorporated_on}
+
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for member in archive.namelist():
+                if member.lower().endswith('.csv'):
+                    with io.TextIOWrapper(archive.open(member), encoding='utf-8', errors='replace', newline='') as file:
+                        yield from iter_rows(file)
+    else:
+        with open(filename, encoding='utf-8', errors='replace', newline='') as file:
+            yield from iter_rows(file)
+
+
+'''
+Builds the sqlite index at path from the companies house free company data product. The index is written to a
+temporary file first and replaces an existing index only once it is complete
+'''
+def build_companieshouse_index(filename, path=COMPANIESHOUSE_INDEX_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    path_tmp = f'{path}.tmp'
+    if os.path.exists(path_tmp):
+        os.remove(path_tmp)
+
+    logger.info(f'building companies house index {path} from {filename}')
+    conn = sqlite3.connect(path_tmp)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("CREATE TABLE companies (company_number TEXT PRIMARY KEY, name TEXT, status TEXT, incorporated_on TEXT)")
+        cursor.execute("CREATE TABLE names (id INTEGER PRIMARY KEY, company_number TEXT, name TEXT, normalized TEXT, is_previous INTEGER)")
+        cursor.execute("CREATE TABLE tokens (token TEXT, name_id INTEGER)")
+        cursor.execute("CREATE TABLE trigrams (trigram TEXT, name_id INTEGER)")
+
+        companies, names, tokens, trigrams = [], [], [], []
+        name_id = 0
+        count = 0
+
+        def insert():
+            cursor.executemany("INSERT OR REPLACE INTO companies VALUES (?, ?, ?, ?)", companies)
+            cursor.executemany("INSERT INTO names VALUES (?, ?, ?, ?, ?)", names)
+            cursor.executemany("INSERT INTO tokens VALUES (?, ?)", tokens)
+            cursor.executemany("INSERT INTO trigrams VALUES (?, ?)", trigrams)
+            conn.commit()
+            for items in (companies, names, tokens, trigrams):
+                items.clear()
+
+        for company in iter_companies_from_csv(filename):
+            companies.append((company['company_number'], company['name'], company['status'], company['incorporated_on']))
+            for is_previous, name in [(False, company['name'])] + [(True, name) for name in company['names_prev']]:
+                normalized = normalize_company_name(name)
+                if not normalized:
+                    continue
+                name_id += 1
+                names.append((name_id, company['company_number'], name, normalized, is_previous))
+                tokens.extend((token, name_id) for token in set(normalized.split()))
+                trigrams.extend((trigram, name_id) for trigram in get_trigrams(normalized))
+
+            count += 1
+            if count % INDEX_BATCH_SIZE == 0:
+                insert()
+                logger.info(f'companies house index: {count} companies written')
+        insert()
+
+        # indexes are created after loading which is a lot faster than maintaining them for every insert
+        cursor.execute("CREATE INDEX names_company_number ON names (company_number)")
+        cursor.execute("CREATE INDEX names_normalized ON names (normalized)")
+        cursor.execute("CREATE INDEX tokens_token ON tokens (token, name_id)")
+        cursor.execute("CREATE INDEX trigrams_trigram ON trigrams (trigram, name_id)")
+        cursor.execute("ANALYZE")
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+    os.replace(path_tmp, path)
+    logger.info(f'companies house index {path} built with {count} companies')
+    return count
+
+
+'''
+Local index of the companies house register to generate and rank search candidates without sending a request to
+companies house. Candidates are looked up by normalized name tokens first and by trigrams if the tokens do not find
+enough candidates, e.g. for misspelled names. Connections are opened per thread and read only
+'''
+class CompaniesHouseIndex():
+
+    def __init__(self, path=COMPANIESHOUSE_INDEX_PATH, max_lookup_candidates=200):
+        self.path = path
+        self.max_lookup_candidates = max_lookup_candidates
+        self.local = threading.local()
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        return conn
+
+    def lookup_tokens(self, cursor, normalized):
+        # exact matches first, names that contain all tokens could exceed max_lookup_candidates for common words
+        cursor.execute("SELECT id FROM names WHERE normalized = ?", (normalized,))
+        name_ids = [row[0] for row in cursor.fetchall()]
+
+        tokens = list(set(normalized.split()))
+        cursor.execute(f"SELECT name_id FROM tokens WHERE token IN ({', '.join('?' * len(tokens))}) "
+                       f"GROUP BY name_id HAVING count(*) = ? LIMIT ?", tokens + [len(tokens), self.max_lookup_candidates])
+        return list(dict.fromkeys(name_ids + [row[0] for row in cursor.fetchall()]))
+
+    def lookup_trigrams(self, cursor, normalized):
+        trigrams = list(get_trigrams(normalized))
+        cursor.execute(f"SELECT name_id FROM trigrams WHERE trigram IN ({', '.join('?' * len(trigrams))}) "
+                       f"GROUP BY name_id ORDER BY count(*) DESC LIMIT ?", trigrams + [self.max_lookup_candidates])
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_companies(self, cursor, name_ids):
+        cursor.execute(f"SELECT c.company_number, c.name, c.status, c.incorporated_on, n.name, n.is_previous "
+                       f"FROM names n INNER JOIN companies c ON c.company_number = n.company_number "
+                       f"WHERE n.company_number IN (SELECT company_number FROM names WHERE id IN ({', '.join('?' * len(name_ids))}))",
+                       name_ids)
+        companies = {}
+        for company_number, name, status, incorporated_on, name_other, is_previous in cursor.fetchall():
+            company = companies.setdefault(company_number, {'company_number': company_number, 'name': name,
+                                                            'names_prev': [], 'status': status,
+                                                            'incorporated_on': datetime.strptime(incorporated_on, '%Y-%m-%d') if incorporated_on else None})
+            if is_previous:
+                company['names_prev'].append(name_other)
+        return list(companies.values())
+
+    def get_candidates_by_name_ids(self, cursor, name_ids, crunchbase_company_name, crunchbase_founded_on_dt, min_score):
+        if not name_ids:
+            return []
+        return rank_candidates(self.get_companies(cursor, name_ids), crunchbase_company_name, crunchbase_founded_on_dt, min_score)
+
+    '''
+    Returns up to limit candidates with a name score of at least min_score, ordered by name score and by distance
+    between incorporation date and crunchbase founding date
+    '''
+    def get_candidates(self, crunchbase_company_name, crunchbase_founded_on_dt=None, limit=2, min_score=0.5):
+        normalized = normalize_company_name(crunchbase_company_name)
+        if not normalized:
+            return []
+
+        cursor = self.get_connection().cursor()
+        try:
+            name_ids = self.lookup_tokens(cursor, normalized)
+            candidates = self.get_candidates_by_name_ids(cursor, name_ids, crunchbase_company_name, crunchbase_founded_on_dt, min_score)
+            if len(candidates) < limit:
+                name_ids = list(set(name_ids + self.lookup_trigrams(cursor, normalized)))
+                candidates = self.get_candidates_by_name_ids(cursor, name_ids, crunchbase_company_name, crunchbase_founded_on_dt, min_score)
+        finally:
+            cursor.close()
+
+        return candidates[:limit]
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+'''
+Returns the local companies house index or None if it has not been built
+'''
+def get_companieshouse_index(path=COMPANIESHOUSE_INDEX_PATH):
+    if path and os.path.exists(path):
+        return CompaniesHouseIndex(path)
+    return None
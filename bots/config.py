@@ -12,6 +12,27 @@ load_dotenv(dotenv_path=env_path)
 # Load variables from the environment
 CRUNCHBASE_DIR = './data/crunchbase'
 CRUNCHBASE_KEY = os.getenv('CRUNCHBASE_KEY')
+CRUNCHBASE_CSV_WORKERS = int(os.getenv('CRUNCHBASE_CSV_WORKERS', os.cpu_count() or 1))
+CRUNCHBASE_API_URL = os.getenv('CRUNCHBASE_API_URL', 'https://api.crunchbase.com/api/v4')
+CRUNCHBASE_CALLS_PER_MINUTE = int(os.getenv('CRUNCHBASE_CALLS_PER_MINUTE', 200))
+CRUNCHBASE_CONCURRENCY = int(os.getenv('CRUNCHBASE_CONCURRENCY', 8))
+CRUNCHBASE_CACHE_DIR = os.getenv('CRUNCHBASE_CACHE_DIR', f'{CRUNCHBASE_DIR}/rest_cache')
+CRUNCHBASE_CACHE_TTL_DAYS = float(os.getenv('CRUNCHBASE_CACHE_TTL_DAYS', 30))
+CRUNCHBASE_PROFILE = os.getenv('CRUNCHBASE_PROFILE', 'full')
+
+COMPANIESHOUSE_INDEX_PATH = os.getenv('COMPANIESHOUSE_INDEX_PATH', './data/companieshouse/index.sqlite3')
+COMPANIESHOUSE_INDEX_CANDIDATES = int(os.getenv('COMPANIESHOUSE_INDEX_CANDIDATES', 2))
+COMPANIESHOUSE_SEARCH_CONCURRENCY = int(os.getenv('COMPANIESHOUSE_SEARCH_CONCURRENCY', 4))
+COMPANIESHOUSE_SEARCH_LOOKAHEAD = int(os.getenv('COMPANIESHOUSE_SEARCH_LOOKAHEAD', 8))
+COMPANIESHOUSE_CRAWL_CONCURRENCY = int(os.getenv('COMPANIESHOUSE_CRAWL_CONCURRENCY', 4))
+COMPANIESHOUSE_PENDING_PAGE_SIZE = int(os.getenv('COMPANIESHOUSE_PENDING_PAGE_SIZE', 100))
+COMPANIESHOUSE_REQUESTS_PER_MINUTE = float(os.getenv('COMPANIESHOUSE_REQUESTS_PER_MINUTE', 120))
+COMPANIESHOUSE_DOCUMENT_WORKERS = int(os.getenv('COMPANIESHOUSE_DOCUMENT_WORKERS', os.cpu_count() or 1))
+COMPANIESHOUSE_OCR_WORKERS = int(os.getenv('COMPANIESHOUSE_OCR_WORKERS', os.cpu_count() or 1))
+COMPANIESHOUSE_OCR_CACHE_DIR = os.getenv('COMPANIESHOUSE_OCR_CACHE_DIR', './data/companieshouse/ocr_cache')
+COMPANIESHOUSE_OCR_DPI = int(os.getenv('COMPANIESHOUSE_OCR_DPI', 200))
+COMPANIESHOUSE_RASTERIZE_THREADS = int(os.getenv('COMPANIESHOUSE_RASTERIZE_THREADS', 2))
+COMPANIESHOUSE_OCR_LOOKAHEAD = int(os.getenv('COMPANIESHOUSE_OCR_LOOKAHEAD', 4))
 
 POPPLER_PATH = os.getenv('POPPLER_PATH')
 TESSDATA_PATH = os.getenv('TESSDATA_PATH')
@@ -24,6 +45,11 @@ DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_PORT = int(os.getenv('DB_PORT'))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_HEALTH_CHECK_SECONDS = float(os.getenv('DB_POOL_HEALTH_CHECK_SECONDS', 30))
+DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 500))
+DB_BATCH_SECONDS = float(os.getenv('DB_BATCH_SECONDS', 5))
 
 LINKEDIN_EMAIL = os.getenv('LINKEDIN_EMAIL')
 LINKEDIN_PWD = os.getenv('LINKEDIN_PWD')
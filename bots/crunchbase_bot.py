@@ -1,79 +1,203 @@
-import time, requests, json, random
+import time, requests, json, itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
 import psycopg2
-from bots.common import PendingStatus, DataSource, logger, get_data_from_pending
-from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, CRUNCHBASE_DIR, CATEGORY_LIST_GROUPS, CRUNCHBASE_KEY
+from bots.common import PendingStatus, DataSource, logger, get_data_from_pending, get_batch_writer, get_connection, TokenBucket, FileCache
+from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, CRUNCHBASE_DIR, CATEGORY_LIST_GROUPS, CRUNCHBASE_KEY, \
+    CRUNCHBASE_API_URL, CRUNCHBASE_CALLS_PER_MINUTE, CRUNCHBASE_CONCURRENCY, CRUNCHBASE_CACHE_DIR, CRUNCHBASE_CACHE_TTL_DAYS, CRUNCHBASE_PROFILE
+# field and card projections requested from the REST API and stored in the data table.
+# search:    what run_companieshouse_bot_defer needs to search Companies House
+# analytics: search plus what bots/flatten.py reads
+# full:      everything we know of, used for backfills
+CRUNCHBASE_PROFILE_SEARCH_FIELDS = ['identifier', 'uuid', 'name', 'legal_name', 'founded_on', 'founder_identifiers', 'updated_at']
+CRUNCHBASE_PROFILE_ANALYTICS_FIELDS = CRUNCHBASE_PROFILE_SEARCH_FIELDS + [
+    'categories', 'category_groups', 'contact_email', 'description', 'equity_funding_total', 'funding_stage', 'ipo_status',
+    'last_equity_funding_type', 'linkedin', 'num_articles', 'num_employees_enum', 'num_funding_rounds', 'num_investors',
+    'num_lead_investors', 'status', 'twitter', 'website_url']
+CRUNCHBASE_PROFILE_FULL_FIELDS = 'acquirer_identifier,aliases,categories,category_groups,closed_on,company_type,contact_email,created_at,delisted_on,demo_days,description,diversity_spotlights,entity_def_id,equity_funding_total,exited_on,facebook,facet_ids,founded_on,founder_identifiers,funding_stage,funding_total,funds_total,hub_tags,identifier*,image_id,image_url,investor_identifiers,investor_stage,investor_type,ipo_status,last_equity_funding_total,last_equity_funding_type,last_funding_at,last_funding_total,last_funding_type,last_key_employee_change_date,last_layoff_date,layout_id,legal_name,linkedin,listed_stock_symbol,location_group_identifiers,location_identifiers,name,num_acquisitions,num_alumni,num_articles,num_current_advisor_positions,num_current_positions,num_diversity_spotlight_investments,num_employees_enum,num_enrollments,num_event_appearances,num_exits,num_exits_ipo,num_founder_alumni,num_founders,num_funding_rounds,num_funds,num_investments,num_investors,num_lead_investments,num_lead_investors,num_past_positions,num_portfolio_organizations,num_sub_organizations,operating_status,override_layout_id,owner_identifier,permalink,permalink_aliases,phone_number,program_application_deadline,program_duration,program_type,rank_delta_d30,rank_delta_d7,rank_delta_d90,rank_org,rank_principal,revenue_range,school_method,school_program,school_type,short_description,status,stock_exchange_symbol,stock_symbol,twitter,updated_at,uuid,valuation,valuation_date,website,website_url,went_public_on'.split(',')
+CRUNCHBASE_PROFILE_FULL_CARDS = ['acquiree_acquisitions', 'acquirer_acquisitions', 'child_organizations', 'child_ownerships', 'fields', 'founders',
+                                 'headquarters_address', 'investors', 'ipos', 'jobs', 'key_employee_changes', 'layoffs', 'parent_organization',
+                                 'parent_ownership', 'participated_funding_rounds', 'participated_funds', 'participated_investments',
+                                 'raised_funding_rounds', 'raised_funds', 'raised_investments']  # event_appearances and press_references are not needed
+
+# cards of the entity endpoint and every page of the card endpoint hold at most this many items
+CRUNCHBASE_CARD_PAGE_SIZE = 100
+
+CRUNCHBASE_PROFILES = {
+    'search': {'field_ids': CRUNCHBASE_PROFILE_SEARCH_FIELDS, 'card_ids': []},
+    'analytics': {'field_ids': CRUNCHBASE_PROFILE_ANALYTICS_FIELDS, 'card_ids': ['founders', 'raised_investments']},
+    'full': {'field_ids': CRUNCHBASE_PROFILE_FULL_FIELDS, 'card_ids': CRUNCHBASE_PROFILE_FULL_CARDS},
+}
+
 class CrunchBaseBot():
     __version__ = 'CrunchBaseBot 0.9'
 
-    def __init__(self):
+    def __init__(self, api_url=CRUNCHBASE_API_URL, calls_per_minute=CRUNCHBASE_CALLS_PER_MINUTE, concurrency=CRUNCHBASE_CONCURRENCY, max_retries=3,
+                 cache_dir=CRUNCHBASE_CACHE_DIR, cache_ttl_days=CRUNCHBASE_CACHE_TTL_DAYS, profile=CRUNCHBASE_PROFILE):
         self.logger = logger
+        if profile not in CRUNCHBASE_PROFILES:
+            raise ValueError(f'Unknown Crunchbase profile {profile}. Expected one of {", ".join(CRUNCHBASE_PROFILES)}')
+        self.profile_name = profile
+        self.profile = CRUNCHBASE_PROFILES[profile]
+        self.writer = get_batch_writer()
+        # responses are cached on disk so forced re-runs and restarts do not spend API calls on unchanged organizations.
+        # cache_dir None disables the cache, cache_ttl_days <= 0 keeps entries until the bulk export reports a change
+        self.cache = FileCache(cache_dir, ttl=cache_ttl_days * 24 * 3600 if cache_ttl_days > 0 else None) if cache_dir else None
+        self.api_url = api_url.rstrip('/')
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # all requests share one bucket, so the calls per minute hold however many organizations are in flight
+        self.rate_limiter = TokenBucket.per_minute(calls_per_minute)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # the card request of an organization runs here while its field request runs in the fetching thread
+        self.request_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='crunchbase-request')
 
     def run(self, uuids_filter='*', category_groups_list_filter='*', country_code_filter='*', from_filter=datetime.min, to_filter=datetime.max, force=False):
 
-        wait_from = 1
-        wait_to = 3
-
         try:
-            self.conn = psycopg2.connect(
-                host=DB_HOST,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                port=DB_PORT
-            )
             data = get_data_from_pending(DataSource.crunchbase.name, uuids_filter, '*', category_groups_list_filter, country_code_filter, from_filter, to_filter, force)
 
+            # cached responses written before the bulk export updated an organization are fetched again
+            updated_at = self.get_updated_at([row['uuid'] for row in data])
             for row in data:
+                row['crunchbase_updated_at'] = updated_at.get(str(row['uuid']))
+
+            # organizations are fetched concurrently, database writes stay in this thread
+            for row, json_rest_api, error in self.iter_rest_api(data):
 
                 try:
+                    if error is not None:
+                        raise error
                     uuid = row['uuid']
                     name = row['name']
                     legal_name = row['legal_name']
                     country_code = row['country_code']
                     category_groups_list = row['category_groups_list']
                     founded_on = row['founded_on']
-                    json_rest_api = self.get_rest_api(row)
                     self.write(uuid, name, legal_name, country_code, category_groups_list, founded_on, json_rest_api)
 
                 except Exception as ex:
                     logger.error(f'{str(ex)}. Data not written to database')
 
-                finally:
-                    time.sleep(random.randint(wait_from, wait_to))
-
         except Exception as ex:
             self.logger.error(ex)
         finally:
-            self.conn.close
+            self.close()
+            try:
+                self.writer.flush()
+            except Exception as ex:
+                logger.error(f'Batch writer flush failed, {len(self.writer)} rows not written: {str(ex)}')
+
+    def get_updated_at(self, uuids):
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT uuid::text, updated_at FROM crunchbase_organizations WHERE uuid::text = ANY(%s)", ([str(uuid) for uuid in uuids],))
+            return dict(cursor.fetchall())
+
+    def close(self):
+        self.request_executor.shutdown(wait=True)
+        self.session.close()
+
+    def iter_rest_api(self, rows):
+        '''
+        Fetches the REST API data of rows with up to self.concurrency organizations in flight. Yields tuples of
+        (row, json_rest_api, error) in completion order, error is None when the fetch succeeded.
+        '''
+        rows = iter(rows)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='crunchbase-fetch') as executor:
+            futures = {executor.submit(self.get_rest_api, row): row for row in itertools.islice(rows, self.concurrency)}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    row = futures.pop(future)
+                    for next_row in itertools.islice(rows, 1):
+                        futures[executor.submit(self.get_rest_api, next_row)] = next_row
+
+                    error = future.exception()
+                    yield row, (future.result() if error is None else None), error
+
+    def get(self, url):
+        # waits for a token before every call. 429 responses are retried after Retry-After or an exponential backoff
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            response = self.session.get(url, timeout=60)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+
+            retry_after = response.headers.get('Retry-After', '')
+            wait_seconds = float(retry_after) if retry_after.isdigit() else 2 ** attempt
+            self.logger.warning(f'Crunchbase rate limit hit, retrying in {wait_seconds}s ({attempt + 1}/{self.max_retries})')
+            time.sleep(wait_seconds)
+
+    def get_card_pages(self, uuid, card_id, after_id):
+        # follows the after_id cursor of a card until a page is not full
+        items = []
+        while after_id is not None:
+            url = f'{self.api_url}/entities/organizations/{uuid}/cards/{card_id}?after_id={after_id}&limit={CRUNCHBASE_CARD_PAGE_SIZE}&user_key={CRUNCHBASE_KEY}'
+            response = self.get(url)
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(f"Error: Response code - Card {card_id} after {after_id}: {response.status_code}")
+
+            page = response.json()['cards'].get(card_id, [])
+            items.extend(page)
+            after_id = page[-1]['identifier']['uuid'] if len(page) >= CRUNCHBASE_CARD_PAGE_SIZE else None
+        return items
+
+    def paginate_cards(self, uuid, cards):
+        '''
+        Completes cards truncated to the first page by the entity endpoint, i.e. raised_investments of large organizations.
+        The remaining pages of different cards are fetched in parallel, pages of one card follow each other.
+        '''
+        futures = {card_id: self.request_executor.submit(self.get_card_pages, uuid, card_id, items[-1]['identifier']['uuid'])
+                   for card_id, items in cards.items()
+                   if isinstance(items, list) and len(items) >= CRUNCHBASE_CARD_PAGE_SIZE and 'identifier' in items[-1]}
+
+        for card_id, future in futures.items():
+            cards[card_id] = cards[card_id] + future.result()
+            self.logger.info(f'organization: {uuid} card {card_id} paginated to {len(cards[card_id])} items')
+        return cards
 
     def get_rest_api(self, row):
         try:
             uuid = row['uuid']
 
-            field_ids = 'acquirer_identifier,aliases,categories,category_groups,closed_on,company_type,contact_email,created_at,delisted_on,demo_days,description,diversity_spotlights,entity_def_id,equity_funding_total,exited_on,facebook,facet_ids,founded_on,founder_identifiers,funding_stage,funding_total,funds_total,hub_tags,identifier*,image_id,image_url,investor_identifiers,investor_stage,investor_type,ipo_status,last_equity_funding_total,last_equity_funding_type,last_funding_at,last_funding_total,last_funding_type,last_key_employee_change_date,last_layoff_date,layout_id,legal_name,linkedin,listed_stock_symbol,location_group_identifiers,location_identifiers,name,num_acquisitions,num_alumni,num_articles,num_current_advisor_positions,num_current_positions,num_diversity_spotlight_investments,num_employees_enum,num_enrollments,num_event_appearances,num_exits,num_exits_ipo,num_founder_alumni,num_founders,num_funding_rounds,num_funds,num_investments,num_investors,num_lead_investments,num_lead_investors,num_past_positions,num_portfolio_organizations,num_sub_organizations,operating_status,override_layout_id,owner_identifier,permalink,permalink_aliases,phone_number,program_application_deadline,program_duration,program_type,rank_delta_d30,rank_delta_d7,rank_delta_d90,rank_org,rank_principal,revenue_range,school_method,school_program,school_type,short_description,status,stock_exchange_symbol,stock_symbol,twitter,updated_at,uuid,valuation,valuation_date,website,website_url,went_public_on'
-            url_field_ids = f'https://api.crunchbase.com/api/v4/entities/organizations/{uuid}?field_ids={field_ids}&user_key={CRUNCHBASE_KEY}'
-            r_field_ids = requests.get(url_field_ids)
+            field_ids = ','.join(self.profile['field_ids'])
+            url_field_ids = f'{self.api_url}/entities/organizations/{uuid}?field_ids={field_ids}&user_key={CRUNCHBASE_KEY}'
 
-            card_ids = 'acquiree_acquisitions,acquirer_acquisitions,child_organizations,child_ownerships,event_appearances,fields,founders,headquarters_address,investors,ipos,jobs,key_employee_changes,layoffs,parent_organization,parent_ownership,participated_funding_rounds,participated_funds,participated_investments,press_references,raised_funding_rounds,raised_funds,raised_investments'
-            card_ids = card_ids.replace(',event_appearances', '')  # data not needed
-            card_ids = card_ids.replace(',press_references', '')  # data not needed
-            url_card_ids = f'https://api.crunchbase.com/api/v4/entities/organizations/{uuid}?card_ids={card_ids}&user_key={CRUNCHBASE_KEY}'
-            r_card_ids = requests.get(url_card_ids)
+            card_ids = ','.join(self.profile['card_ids'])
+            url_card_ids = f'{self.api_url}/entities/organizations/{uuid}?card_ids={card_ids}&user_key={CRUNCHBASE_KEY}'
 
-            if r_field_ids.status_code == 200 and r_card_ids.status_code == 200:
+            cache_key = ['organizations', str(uuid), field_ids, card_ids]
+            if self.cache is not None:
+                r = self.cache.get(cache_key, newer_than=row.get('crunchbase_updated_at'))
+                if r is not None:
+                    return r
+
+            # field and card requests of an organization run concurrently. profiles without cards only need one request
+            future_card_ids = self.request_executor.submit(self.get, url_card_ids) if card_ids else None
+            r_field_ids = self.get(url_field_ids)
+            r_card_ids = future_card_ids.result() if future_card_ids else None
+
+            if r_field_ids.status_code == 200 and (r_card_ids is None or r_card_ids.status_code == 200):
                 r = {}
                 r['properties'] = r_field_ids.json()['properties']
-                r['cards'] = r_card_ids.json()['cards']
+                r['cards'] = self.paginate_cards(uuid, r_card_ids.json()['cards']) if r_card_ids is not None else {}
                 r['source'] = DataSource.crunchbase.name
+                r['profile'] = self.profile_name
+                if self.cache is not None:
+                    self.cache.set(cache_key, r)
                 return r
             else:
                 # Handle non-200 status codes (e.g., 404 Not Found, 403 Forbidden, etc.)
                 # Here you can raise an exception, log an error, or return an appropriate response.
                 # For example, you can raise an exception for further handling:
                 raise requests.exceptions.HTTPError(
-                    f"Error: Response codes - Field IDs: {r_field_ids.status_code}, Card IDs: {r_card_ids.status_code}")
+                    f"Error: Response codes - Field IDs: {r_field_ids.status_code}, Card IDs: {r_card_ids.status_code if r_card_ids is not None else None}")
         except requests.exceptions.RequestException as e:
             # Handle any other request exceptions (e.g., connection error, timeout, etc.)
             # Here you can raise an exception, log an error, or return an appropriate response.
@@ -82,51 +206,18 @@ class CrunchBaseBot():
 
 
     def write(self, uuid, name, legal_name, country_code, category_groups_list, founded_on, json_rest_api):
-        table_name = 'data'
-        dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-        data_str = json.dumps(json_rest_api)
-
-        d = {'uuid': uuid, 'uuid_parent': uuid, 'name': name,
-             'source': DataSource.crunchbase.name, 'version':self.__version__,'created_at': dt,'updated_at': dt,'data': data_str}
-        columns = d.keys()
-        values = tuple(d.values())
-
-        # write data to db
-        query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) " \
-                     f"ON CONFLICT (uuid, source) DO UPDATE SET data = EXCLUDED.data, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
-
-        cursor = self.conn.cursor()
-        cursor.execute(query_data, values)
-
-        # update pending table
-        query_pending = f"UPDATE pending SET status = '{PendingStatus.completed.name}', updated_at = '{dt}'  WHERE uuid = '{uuid}' AND source = '{DataSource.crunchbase.name}'"
-        cursor = self.conn.cursor()
-        cursor.execute(query_pending)
-        self.conn.commit()
-        # self.logger.info(f'company: {name} update pending status from source: {DataSource.crunchbase.name} status: {PendingStatus.completed.name}')
+        self.writer.write_data(uuid, uuid, name, DataSource.crunchbase.name, self.__version__, json_rest_api)
+        self.writer.set_pending_status(uuid, DataSource.crunchbase.name, PendingStatus.completed)
         # write pending table for companies house. this is done so that we immidiately have pending record for companieshouse
         # when a new crunchbase record is written if a record is already existing in
         # pending table for this company and companies house DO NOTHING ON CONFLICT
-        columns_companieshouse = ['uuid', 'uuid_parent', 'name', 'legal_name', 'country_code', 'category_groups_list', 'founded_on', 'source', 'status', 'version', 'created_at', 'updated_at']
-        source = DataSource.companieshouse.name
-        status = PendingStatus.pending.name
-        version = ''
-        created_at = dt
-        updated_at = dt
-        values_pending_companieshouse = [uuid, uuid, name, legal_name, country_code, category_groups_list, founded_on, source, status, version, created_at, updated_at]
-        query_pending_companieshouse = f"INSERT INTO pending ({', '.join(columns_companieshouse)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " \
-                        f"ON CONFLICT DO NOTHING"
-        cursor = self.conn.cursor()
-        cursor.execute(query_pending_companieshouse, values_pending_companieshouse)
-
-        self.conn.commit()
-        cursor.close()
+        self.writer.insert_pending(uuid, uuid, name, legal_name, country_code, category_groups_list, founded_on, DataSource.companieshouse.name)
 
-        self.logger.info(f'company: {name} writing successful from source: {DataSource.crunchbase.name} status: {PendingStatus.completed.name}')
+        self.logger.info(f'company: {name} writing queued from source: {DataSource.crunchbase.name} status: {PendingStatus.completed.name}')
 
 
 def run_crunchbase_bot(uuids_filter='*', category_groups_list_filter='*', country_code_filter='*',
                         from_filter=datetime.min, to_filter=datetime.max,
-                        force=False):
-    crunchbasebot = CrunchBaseBot()
+                        force=False, profile=CRUNCHBASE_PROFILE):
+    crunchbasebot = CrunchBaseBot(profile=profile)
     crunchbasebot.run(uuids_filter, category_groups_list_filter, country_code_filter, from_filter, to_filter, force)
@@ -151,8 +151,8 @@ def flatten_companieshouse_data(companieshouse_data_unique):
     return df
 
 def flatten_crunchbase_properties(crunchbase_sample, company_uuid, company_name):
-    # Provided dataset
-    data = crunchbase_sample['cards']['fields']
+    # Provided dataset. the fields card is only fetched by the full profile, otherwise the same values are in properties
+    data = crunchbase_sample['cards'].get('fields') or crunchbase_sample['properties']
 
     # Function to flatten nested dictionaries for category_groups and categories
     def flatten_categories(data, key):
@@ -219,7 +219,8 @@ def flatten_crunchbase_properties(crunchbase_sample, company_uuid, company_name)
 
 
 def flatten_crunchbase_investments(crunchbase_sample, company_name, company_uuid):
-    investments = crunchbase_sample['cards']['raised_investments']
+    # the raised_investments card is not fetched by the search profile
+    investments = crunchbase_sample['cards'].get('raised_investments', [])
     # Initialize an empty list to collect data
     data_rows = []
 
@@ -259,7 +260,7 @@ def flatten_crunchbase_investments(crunchbase_sample, company_name, company_uuid
 
     # Now, we need to aggregate the number of investors and total investment by round
     # To do this, we'll create a DataFrame and then perform groupby operations
-    df = pd.DataFrame(data_rows)
+    df = pd.DataFrame(data_rows, columns=['uuid', 'name', 'parent_uuid', 'parent_name', 'group_id', 'from_date', 'to_date', 'variable', 'value'])
     # Aggregate the number of investors by round
     df_num_investors = \
     df[df['variable'] == 'num_investors'].groupby(['uuid', 'name', 'parent_uuid', 'parent_name', 'group_id'])[
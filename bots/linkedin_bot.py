@@ -21,7 +21,7 @@ from webdriver_manager.chrome import ChromeDriverManager
 from webdriver_manager.core.os_manager import ChromeType
 
 from bots.config import LINKEDIN_EMAIL, LINKEDIN_PWD, BRAVE_PATH, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT
-from bots.common import PendingStatus, DataSource, logger, is_organization
+from bots.common import PendingStatus, DataSource, logger, is_organization, get_batch_writer, get_connection
 from bots.companieshouse_bot import CompaniesHouseBot
 
 
@@ -81,14 +81,7 @@ class LinkedInBot():
         self.companies = []
         self.headless = headless
 
-        self.conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT
-        )
-        self.conn.autocommit = False
+        self.writer = get_batch_writer()
 
     def init_driver(self, headless=True, proxy=None, option=None, firefox=False):
         """ initiate a chromedriver or firefoxdriver instance
@@ -222,53 +215,46 @@ class LinkedInBot():
         assert type(to) == datetime
         assert type(occupations) == list or occupations == '*'
 
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT
-        )
-
-        cursor = conn.cursor()
-
-        uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
-        uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
-        category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
-        occupations_str = "'%'" if occupations == '*' else ', '.join([f"'{item}'" for item in occupations])
-        country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
-
-        pending = f"" if force else f" and pending_linkedin.status = '{PendingStatus.pending.name}' "
-
-        occupations_filter = create_occupation_sql_expression(occupations)
-
-        query = f"SELECT pending_linkedin.*, pending_companieshouse.category_groups_list as companieshouse_category_groups_list, pending_companieshouse.name as companieshouse_name, \"data\".data as companieshouse_data " \
-            f"FROM pending as pending_linkedin " \
-            f"INNER JOIN \"data\" ON pending_linkedin.uuid_parent = \"data\".uuid AND \"data\".source = '{DataSource.companieshouse.name}' " \
-            f"INNER JOIN pending as pending_companieshouse ON pending_linkedin.uuid_parent = pending_companieshouse.uuid AND pending_companieshouse.source = '{DataSource.companieshouse.name}' " \
-            f"WHERE pending_linkedin.source = '{DataSource.linkedin.name}' and " \
-            f"pending_companieshouse.founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"pending_companieshouse.founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
-            f"pending_companieshouse.category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
-            f"pending_companieshouse.country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
-            f"{occupations_filter}" \
-            f"pending_linkedin.uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
-            f"pending_linkedin.uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
-            f"{pending}" \
-            f"ORDER BY pending_linkedin.uuid_parent, pending_linkedin.uuid ASC"
-
-        # print(query)
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        # Get the column names from the cursor description
-        columns = [desc[0] for desc in cursor.description]
-
-        # Transform the result set into a list of dictionaries
-        result = [dict(zip(columns, row)) for row in rows]
-
-        cursor.close()
-        conn.close()
+        with get_connection() as conn:
+
+            cursor = conn.cursor()
+
+            uuids_parent_str = "'%'" if uuids_parent == '*' else ', '.join([f"'{item}'" for item in uuids_parent])
+            uuids_str = "'%'" if uuids == '*' else ', '.join([f"'{item}'" for item in uuids])
+            category_groups_list_str = "'%'" if category_groups_list == '*' else ', '.join([f"'%{item}%'" for item in category_groups_list])
+            occupations_str = "'%'" if occupations == '*' else ', '.join([f"'{item}'" for item in occupations])
+            country_codes_str = "'%'" if country_codes == '*' else ', '.join([f"'{item}'" for item in country_codes])
+
+            pending = f"" if force else f" and pending_linkedin.status = '{PendingStatus.pending.name}' "
+
+            occupations_filter = create_occupation_sql_expression(occupations)
+
+            query = f"SELECT pending_linkedin.*, pending_companieshouse.category_groups_list as companieshouse_category_groups_list, pending_companieshouse.name as companieshouse_name, \"data\".data as companieshouse_data " \
+                f"FROM pending as pending_linkedin " \
+                f"INNER JOIN \"data\" ON pending_linkedin.uuid_parent = \"data\".uuid AND \"data\".source = '{DataSource.companieshouse.name}' " \
+                f"INNER JOIN pending as pending_companieshouse ON pending_linkedin.uuid_parent = pending_companieshouse.uuid AND pending_companieshouse.source = '{DataSource.companieshouse.name}' " \
+                f"WHERE pending_linkedin.source = '{DataSource.linkedin.name}' and " \
+                f"pending_companieshouse.founded_on >= '{fr.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"pending_companieshouse.founded_on <= '{to.strftime('%Y-%m-%dT%H:%M:%S')}' and " \
+                f"pending_companieshouse.category_groups_list::text ILIKE ANY (ARRAY[{category_groups_list_str}]) and " \
+                f"pending_companieshouse.country_code::text ILIKE ANY (ARRAY[{country_codes_str}]) and " \
+                f"{occupations_filter}" \
+                f"pending_linkedin.uuid_parent::text LIKE ANY (ARRAY[{uuids_parent_str}]) and " \
+                f"pending_linkedin.uuid::text LIKE ANY (ARRAY[{uuids_str}])" \
+                f"{pending}" \
+                f"ORDER BY pending_linkedin.uuid_parent, pending_linkedin.uuid ASC"
+
+            # print(query)
+            cursor.execute(query)
+            rows = cursor.fetchall()
+
+            # Get the column names from the cursor description
+            columns = [desc[0] for desc in cursor.description]
+
+            # Transform the result set into a list of dictionaries
+            result = [dict(zip(columns, row)) for row in rows]
+
+            cursor.close()
 
         return result
 
@@ -395,44 +381,20 @@ class LinkedInBot():
 
         except LoginFailedException as lf:
             self.logger.error(str(lf))
+        finally:
+            self.writer.flush()
 
     def write(self, uuid, uuid_parent, name, json_rest_api):
 
         try:
-            cursor = self.conn.cursor()
-
-            table_name = 'data'
-            dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-            data_str = json.dumps(json_rest_api)
-
-            d = {'uuid': uuid, 'uuid_parent': uuid_parent, 'name': name, 'source': DataSource.linkedin.name, 'version':self.__version__, 'created_at': dt, 'updated_at': dt, 'data': data_str}
-            columns = d.keys()
-            values = tuple(d.values())
-
-            # write data to db
-            query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (uuid, source) DO UPDATE SET data = EXCLUDED.data, version = EXCLUDED.version, updated_at = EXCLUDED.updated_at"
-            # query_data = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ('{values[0]}', '{values[1]}', '{values[2]}', '{values[3]}', '{values[4]}', '{values[5]}', '{values[6]}')"
-            # print(f'query_data 1: {query_data}')
-            cursor.execute(query_data, values)
-            # print(f'query_data 2: {query_data}')
+            self.writer.write_data(uuid, uuid_parent, name, DataSource.linkedin.name, self.__version__, json_rest_api)
+            self.writer.set_pending_status(uuid, DataSource.linkedin.name, PendingStatus.completed)
 
-            # update pending table
-            query_pending = f"UPDATE pending SET status = '{PendingStatus.completed.name}', updated_at = '{dt}'  WHERE uuid = '{uuid}' AND source = '{DataSource.linkedin.name}'"
-
-            # print(f'query_pending 1: {query_data}')
-            cursor.execute(query_pending)
-            # print(f'query_pending 2: {query_data}')
-
-        except psycopg2.Error as e:
-            self.logger.error(f"Write executing queries: {str(e)}")
-            self.conn.rollback()
         except Exception as e:
             self.logger.error(str(e))
         else:
-            self.conn.commit()
-            self.logger.info(f'Write data successful: source: {DataSource.companieshouse.name} status: {PendingStatus.completed.name} profile: {name}')
-        finally:
-            cursor.close()
+            # rows are written by the batch writer later, database errors are logged by its flush
+            self.logger.info(f'Write data queued: source: {DataSource.linkedin.name} status: {PendingStatus.completed.name} profile: {name}')
 
     def run_from_dict(self, profiles_by_company_id, occupations_filter):
         raise NotImplementedError()
@@ -0,0 +1,89 @@
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
+
+'''
+Name scoring for matching crunchbase organizations and founders with companies house companies and officers. Scores
+are computed for all names at once with rapidfuzz cdist and are identical to fuzzywuzzy's fuzz.ratio with
+python-Levenshtein installed, i.e. int(round(100 * Levenshtein.ratio)), so existing thresholds keep their decisions
+'''
+MATCH_SCORE_WEAK = 0.5
+MATCH_SCORE_STRONG = 0.75
+
+
+'''
+Returns the matrix of integer fuzz.ratio scores between 0 and 100 for all queries and choices
+'''
+def get_ratios(queries, choices):
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)), dtype=np.int64)
+    similarity = process.cdist(queries, choices, scorer=Indel.normalized_similarity, dtype=np.float64)
+    # np.round rounds half to even like python's round used by fuzzywuzzy
+    return np.round(similarity * 100).astype(np.int64)
+
+
+'''
+Returns the crunchbase company name in lower case and with ltd and limited suffix variants. The variants are built once
+per crunchbase company and compared against all companies house candidates
+'''
+def get_company_name_variants(crunchbase_company_name):
+    name = crunchbase_company_name.strip().lower()
+    variants = [name, name + ' ltd', name + ' limited', name.replace('limited', 'ltd'), name.replace('ltd', 'limited')]
+    return list(dict.fromkeys(variants))
+
+
+'''
+Returns the fuzzy matching score between 0 and 1 for each candidate. Each candidate is a list of companies house names
+(current and previous) and scores with its best matching name against all crunchbase name variants
+'''
+def get_company_name_scores(companieshouse_company_names_list, crunchbase_company_name):
+    names = [name.lower() for names in companieshouse_company_names_list for name in names]
+    if not names:
+        return [0] * len(companieshouse_company_names_list)
+
+    best = get_ratios(names, get_company_name_variants(crunchbase_company_name)).max(axis=1)
+
+    scores = []
+    start = 0
+    for companieshouse_company_names in companieshouse_company_names_list:
+        end = start + len(companieshouse_company_names)
+        scores.append(int(best[start:end].max()) / 100 if end > start else 0)
+        start = end
+    return scores
+
+
+'''
+Returns the fuzzy matching score between 0 and 1 of the best matching companies house name (current or previous) and
+the crunchbase company name, also trying the crunchbase name with ltd and limited suffixes
+'''
+def get_company_name_score(companieshouse_company_names, crunchbase_company_name):
+    return get_company_name_scores([companieshouse_company_names], crunchbase_company_name)[0]
+
+
+'''
+Returns 1 if names1 and names2 have a name in common, otherwise the score between 0 and 1 of the closest matching pair.
+This is used to check if one of the crunchbase founders is in the companies house officers list
+'''
+def get_names_matching_score(names1, names2):
+    if set(names1).intersection(names2):
+        return 1
+    if not names1 or not names2:
+        return 0
+    return int(get_ratios(list(names1), list(names2)).max()) / 100
+
+
+'''
+Scores companies house candidates (dictionaries with name, names_prev and incorporated_on) against the crunchbase
+company and returns the candidates with a score of at least min_score, ordered by name score and by distance between
+incorporation date and crunchbase founding date. Candidates without incorporation date are ranked last among equal scores
+'''
+def rank_candidates(candidates, crunchbase_company_name, crunchbase_founded_on_dt=None, min_score=0):
+    def get_sort_key(candidate):
+        if crunchbase_founded_on_dt and candidate['incorporated_on']:
+            return -candidate['score'], abs((crunchbase_founded_on_dt - candidate['incorporated_on']).days)
+        return -candidate['score'], float('inf')
+
+    scores = get_company_name_scores([[candidate['name']] + candidate['names_prev'] for candidate in candidates], crunchbase_company_name)
+    for candidate, score in zip(candidates, scores):
+        candidate['score'] = score
+    return sorted([candidate for candidate in candidates if candidate['score'] >= min_score], key=get_sort_key)
@@ -5,8 +5,9 @@ from datetime import datetime
 from dateutil import parser as date_parser
 import json, logging, os, argparse
 
-from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, CRUNCHBASE_DIR, POPPLER_PATH, BRAVE_PATH, CRUNCHBASE_KEY, CATEGORY_LIST_GROUPS
+from bots.config import DB_NAME, DB_HOST, DB_USER, DB_PASSWORD, DB_PORT, CRUNCHBASE_DIR, POPPLER_PATH, BRAVE_PATH, CRUNCHBASE_KEY, CATEGORY_LIST_GROUPS, CRUNCHBASE_PROFILE
 from bots.companieshouse_bot import run_companieshouse_bot, run_companieshouse_bot_by_company_id
+from bots.companieshouse_index import build_companieshouse_index
 
 def companieshouse_finished(data):
     # handle completed requests here
@@ -30,9 +31,9 @@ def main(
             uuids_filter='*', uuids_profile_filter='*',
             category_groups_list_filter='*', country_code_filter='*',
             from_filter=datetime.min, to_filter=datetime.max,
-            initialize_run=True, initialize_drop_tables=False, initialize_download_csv=False, initialize_write_organizations=False, initialize_pending_force=False,
-            crunchbase_run=False, crunchbase_force=False,
-            companieshouse_run=False, companieshouse_force=False,
+            initialize_run=True, initialize_drop_tables=False, initialize_download_csv=False, initialize_write_organizations=False, initialize_pending_force=False, initialize_pending_incremental=False,
+            crunchbase_run=False, crunchbase_force=False, crunchbase_profile=CRUNCHBASE_PROFILE,
+            companieshouse_run=False, companieshouse_force=False, companieshouse_build_index=None,
             linkedin_run=False, linkedin_force=False, linkedin_occupations_filter=[['Founder'], ['Director', 'Shareholder']]):
 
 
@@ -40,7 +41,7 @@ def main(
         initialize(uuids_filter=uuids_filter,
                    category_groups_list_filter=category_groups_list_filter, country_code_filter=country_code_filter,
                    from_filter=from_filter, to_filter=to_filter,
-                   drop_tables=initialize_drop_tables, download_crunchbase_csv=initialize_download_csv, write_organizations=initialize_write_organizations, pending_force=initialize_pending_force,
+                   drop_tables=initialize_drop_tables, download_crunchbase_csv=initialize_download_csv, write_organizations=initialize_write_organizations, pending_force=initialize_pending_force, pending_incremental=initialize_pending_incremental,
                    )
 
 
@@ -51,9 +52,15 @@ def main(
         run_crunchbase_bot(uuids_filter=uuids_filter,
                            category_groups_list_filter=category_groups_list_filter, country_code_filter=country_code_filter,
                            from_filter=from_filter, to_filter=to_filter,
-                           force=crunchbase_force)
+                           force=crunchbase_force,
+                           profile=crunchbase_profile)
 
 
+    if companieshouse_build_index:
+        # Build the local Companies House index from the Free Company Data Product. The Companies House bot uses it
+        # to find search candidates without querying the Companies House search page.
+        build_companieshouse_index(companieshouse_build_index)
+
     if companieshouse_run:
         # Query pending database to get all organizations for Companies House that need scraping.
         # Use Companies House spider for this. Use legal name from Crunchbase instead of name if it exists as a name input.
@@ -104,12 +111,18 @@ if __name__ == '__main__':
     parser.add_argument('--initialize-pending-force', choices=['true', 'false'], default='false', help='Specify if the pending state will be force reset. WARNING! When using the --initialize-force option, exercise caution as it will '
                                                                                              'overwrite the pending table state to True. This action will repopulate all '
                                                                                              'selected records by the bots once again. Default "false"')
+    parser.add_argument('--initialize-pending-incremental', choices=['true', 'false'], default='false', help='Update organizations changed in the Crunchbase csv file and only reset the pending state of organizations '
+                                                                                                         'updated since they were last fetched. Use with --initialize-write-organizations for weekly refreshes. Default "false"')
 
     parser.add_argument('--crunchbase-run', choices=['true', 'false'], default='false', help='Run the Crunchbase bot. Default "false"')
     parser.add_argument('--crunchbase-force', choices=['true', 'false'], default='false', help='Force updating Crunchbase data. Default "false"')
+    parser.add_argument('--crunchbase-profile', choices=['search', 'analytics', 'full'], default=CRUNCHBASE_PROFILE, help='Crunchbase fields and cards to fetch and store. "search" is enough to search Companies House, '
+                                                                                                                   f'"analytics" adds what the flatten functions read and "full" fetches everything for backfills. Default "{CRUNCHBASE_PROFILE}"')
 
     parser.add_argument('--companieshouse-run', choices=['true', 'false'], default='false', help='Run the Companies House bot. Default "false"')
     parser.add_argument('--companieshouse-force', choices=['true', 'false'], default='false', help='Force updating Companies House data. Default "false"')
+    parser.add_argument('--companieshouse-build-index', default=None, help='Build the local Companies House index from the Free Company Data Product csv or zip file '
+                                                                           '(http://download.companieshouse.gov.uk/en_output.html). Searches use the index if it exists. Default None')
 
     parser.add_argument('--linkedin-run', choices=['true', 'false'], default='false', help='Run the LinkedIn bot. Default "false"')
     parser.add_argument('--linkedin-force', choices=['true', 'false'], default='false', help='Force updating LinkedIn data. Default "false"')
@@ -126,9 +139,13 @@ if __name__ == '__main__':
     # Convert string values to boolean
     args_dict = vars(args)
     for key, value in args_dict.items():
-        if isinstance(value, str):
+        if isinstance(value, str) and value.lower() in ('true', 'false'):
             args_dict[key] = value.lower() == 'true'
 
+    if args.initialize_run and args.initialize_pending_incremental and not args.initialize_write_organizations:
+        # the incremental refresh compares the organizations written from the csv file with the data table
+        parser.error('--initialize-pending-incremental requires --initialize-write-organizations true')
+
     if args.initialize_run and args.initialize_pending_force:
         confirmation = input('Are you sure you want to force reseting the pending state for the records? This would result in bots repopulating all companies again. (y/n): ')
         if confirmation.lower() != 'y':
@@ -157,10 +174,13 @@ if __name__ == '__main__':
         initialize_download_csv=args.initialize_download_csv,
         initialize_write_organizations=args.initialize_write_organizations,
         initialize_pending_force=args.initialize_pending_force,
+        initialize_pending_incremental=args.initialize_pending_incremental,
         crunchbase_run=args.crunchbase_run,
         crunchbase_force=args.crunchbase_force,
+        crunchbase_profile=args.crunchbase_profile,
         companieshouse_run=args.companieshouse_run,
         companieshouse_force=args.companieshouse_force,
+        companieshouse_build_index=args.companieshouse_build_index,
         linkedin_run=args.linkedin_run,
         linkedin_force=args.linkedin_force,
         linkedin_occupations_filter=args.linkedin_occupations_filter
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+# Define your downloader middlewares here
+#
+# Don't forget to add your middleware to the DOWNLOADER_MIDDLEWARES setting
+# See: https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+
+from urllib.parse import urlparse
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import reactor, task
+
+from bots.common import get_rate_limiter
+
+
+class RateLimitMiddleware(object):
+    '''
+    Delays requests to the domains of the RATE_LIMITS_PER_MINUTE setting. The token buckets are shared by all crawlers
+    and threads of the process, so concurrently running spiders together stay below the limit of a domain.
+    '''
+
+    def __init__(self, rate_limits_per_minute):
+        self.rate_limits_per_minute = rate_limits_per_minute
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getdict('RATE_LIMITS_PER_MINUTE'))
+
+    async def process_request(self, request, spider):
+        domain = urlparse(request.url).netloc
+        if domain in self.rate_limits_per_minute:
+            wait = get_rate_limiter(domain, self.rate_limits_per_minute[domain]).reserve()
+            if wait > 0:
+                await maybe_deferred_to_future(task.deferLater(reactor, wait, lambda: None))
+        return None
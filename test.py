@@ -2,10 +2,26 @@ import scrapy, os, json, pytesseract
 from scrapy.crawler import CrawlerProcess
 from scrapy.loader import ItemLoader
 from scrapy.utils.project import get_project_settings
-from bots.companieshouse_bot import CompaniesHouseBot
-from bots.config import POPPLER_PATH
+from bots.companieshouse_bot import CompaniesHouseBot, OcrEngine, get_page_ranges, rasterize_pages
+from bots.config import POPPLER_PATH, DB_NAME
 
 import unittest
+from datetime import datetime, timedelta
+import csv, io, sys, tarfile, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from bots.common import download_and_extract_tar, BULK_EXPORT_MEMBERS, TokenBucket, CrunchbaseColumnarStore, CrunchbaseInvertedIndex, ORGANIZATIONS_DICTIONARY_COLUMNS, BatchWriter, PendingStatus, close_connections, CopyStream, ConnectionPool, \
+    DataSource, copy_organizations_from_csv, write_organizations_pending, create_organizations_table, create_pending_table, create_data_table
+import bots.common, psycopg2
+from bots.crunchbase_bot import CrunchBaseBot
+from bots.companieshouse_index import build_companieshouse_index, CompaniesHouseIndex, normalize_company_name
+from bots.matching import get_ratios, get_company_name_score, get_company_name_scores, get_names_matching_score
+from fuzzywuzzy import fuzz
+from unittest import mock
+from lxml import etree
+from PIL import Image
+from twisted.internet import defer
+from middlewares import RateLimitMiddleware
 
 
 def test_companieshouse(data):
@@ -36,4 +52,802 @@ class TestMultiply(unittest.TestCase):
 
         company_id = '07101408'
         process.crawl(CompaniesHouseBot, company_id=company_id, poppler_path=POPPLER_PATH, write_enabled=False, callback_finish=test_companieshouse)
-        process.start()  # the script will block here until the crawling is finished
\ No newline at end of file
+        process.start()  # the script will block here until the crawling is finished
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # serves self.server.content, the first response without a Range header is cut off half way. if self.server.segment
+    # is set, every response is cut off after that many bytes, and the first self.server.unavailable Range requests are
+    # answered with 503
+    def do_GET(self):
+        content = self.server.content
+        range_header = self.headers.get('Range')
+        self.server.requests.append(range_header)
+        if range_header and self.server.unavailable > 0:
+            self.server.unavailable -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if range_header:
+            start = int(range_header.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+            self.send_header('Content-Length', str(len(content) - start))
+            end = len(content)
+        else:
+            start = 0
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            end = len(content) // 2
+        self.end_headers()
+        if self.server.segment:
+            end = start + self.server.segment
+        self.wfile.write(content[start:end])
+        self.wfile.flush()
+        if end < len(content):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadAndExtract(unittest.TestCase):
+    def setUp(self):
+        self.files = {name: os.urandom(1024 * 1024) for name in BULK_EXPORT_MEMBERS + ('ipos.csv', 'jobs.csv')}
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name, data in self.files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.content = archive.getvalue()
+        self.server.requests = []
+        self.server.segment = None
+        self.server.unavailable = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/bulk_export.tar.gz'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_resume_and_extract_members(self):
+        with tempfile.TemporaryDirectory() as extraction_path:
+            extracted = download_and_extract_tar(self.url, extraction_path, BULK_EXPORT_MEMBERS)
+
+            self.assertEqual(sorted(extracted), sorted(BULK_EXPORT_MEMBERS))
+            self.assertEqual(sorted(os.listdir(extraction_path)), sorted(BULK_EXPORT_MEMBERS))
+            for name in BULK_EXPORT_MEMBERS:
+                with open(os.path.join(extraction_path, name), 'rb') as file:
+                    self.assertEqual(file.read(), self.files[name])
+
+        # the interrupted download was resumed from where it stopped
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNone(self.server.requests[0])
+        start = int(self.server.requests[1].split('=')[1].rstrip('-'))
+        self.assertTrue(0 < start <= len(self.server.content) // 2)
+
+    def test_resume_after_server_errors_and_repeated_drops(self):
+        # the first Range request fails and the connection drops more often than max_retries during the download
+        self.server.unavailable = 1
+        self.server.segment = 3 * 1024 * 1024 // 2
+        with tempfile.TemporaryDirectory() as extraction_path, mock.patch('bots.common.time.sleep') as sleep:
+            extracted = download_and_extract_tar(self.url, extraction_path, BULK_EXPORT_MEMBERS, max_retries=2)
+
+            self.assertEqual(sorted(extracted), sorted(BULK_EXPORT_MEMBERS))
+            for name in BULK_EXPORT_MEMBERS:
+                with open(os.path.join(extraction_path, name), 'rb') as file:
+                    self.assertEqual(file.read(), self.files[name])
+
+        # the retries are reset after every resumed connection
+        self.assertIsNone(self.server.requests[0])
+        self.assertGreater(len(self.server.requests), 4)
+        self.assertGreater(sleep.call_count, 2)
+        self.assertTrue(all(call.args[0] <= 2 for call in sleep.call_args_list))
+
+    def test_extract_all_members(self):
+        with tempfile.TemporaryDirectory() as extraction_path:
+            extracted = download_and_extract_tar(self.url, extraction_path)
+            self.assertEqual(sorted(extracted), sorted(self.files))
+
+
+class TestCopyStream(unittest.TestCase):
+    def read_all(self, stream, size):
+        data = ''
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                return data
+            self.assertLessEqual(len(chunk), size)
+            data += chunk
+
+    def test_encode_rows(self):
+        rows = [{'uuid': 'u1', 'name': None, 'homepage_url': ''},
+                {'uuid': 'u2', 'name': 'Say "hi"\nLtd', 'homepage_url': '\\.'},
+                {'uuid': 'u3', 'name': 'No homepage'}]
+        stream = CopyStream(rows, ['uuid', 'name', 'homepage_url'])
+        data = self.read_all(stream, 7)
+
+        # None and missing keys are unquoted empty fields (NULL), every other value is quoted
+        self.assertEqual(data, '"u1",,""\n'
+                               '"u2","Say ""hi""\nLtd","\\."\n'
+                               '"u3","No homepage",\n')
+        self.assertEqual(stream.count, 3)
+        self.assertEqual(list(csv.reader(io.StringIO(data))), [['u1', '', ''], ['u2', 'Say "hi"\nLtd', '\\.'], ['u3', 'No homepage', '']])
+
+    def test_read_sizes(self):
+        rows = [{'uuid': f'u{i}', 'name': f'Organization, {i}'} for i in range(50)]
+        expected = CopyStream(rows, ['uuid', 'name']).read()
+        for size in (1, 2, 5, 17, len(expected), len(expected) + 1):
+            self.assertEqual(self.read_all(CopyStream(rows, ['uuid', 'name']), size), expected)
+        self.assertEqual(expected.count('\n'), 50)
+
+
+class MockCrunchbaseHandler(BaseHTTPRequestHandler):
+    # answers field_ids requests with properties and card_ids requests with cards after a short delay. cards have
+    # self.server.card_sizes items, the entity endpoint returns the first page and the card endpoint the pages after_id
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/').split('/')
+        card_id = path[-1] if path[-2] == 'cards' else None
+        uuid = path[-3] if card_id else path[-1]
+        query = parse_qs(url.query)
+
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            self.server.requests.append((time.monotonic(), uuid, 'card_ids' in query))
+        time.sleep(self.server.delay)
+
+        def get_page(card, after_id=None):
+            items = [{'identifier': {'uuid': f'{card}-{i}'}} for i in range(self.server.card_sizes.get(card, 0))]
+            start = 0 if after_id is None else [item['identifier']['uuid'] for item in items].index(after_id) + 1
+            return items[start:start + 100]
+
+        if card_id:
+            body = {'properties': {'identifier': {'uuid': uuid}}, 'cards': {card_id: get_page(card_id, query['after_id'][0])}}
+        elif 'card_ids' in query:
+            body = {'properties': {'identifier': {'uuid': uuid}}, 'cards': {card: get_page(card) for card in query['card_ids'][0].split(',')}}
+        else:
+            body = {'properties': {'identifier': {'uuid': uuid}, 'name': f'Organization {uuid}'}}
+        content = json.dumps(body).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestCrunchbaseInvertedIndex(unittest.TestCase):
+    def test_duplicate_values(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'organizations.csv')
+            with open(filename, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['uuid', 'name', 'country_code', 'category_groups_list', 'category_list', 'founded_on'])
+                writer.writerow(['00000000-0000-0000-0000-000000000000', 'A', 'GBR', 'Software, Software', 'SaaS', '2015-01-01'])
+                writer.writerow(['00000000-0000-0000-0000-000000000001', 'B', 'USA', 'Software', 'SaaS', '2015-01-01'])
+                writer.writerow(['00000000-0000-0000-0000-000000000002', 'C', 'GBR', 'Hardware, Software', 'SaaS', '2015-01-01'])
+
+            store = CrunchbaseColumnarStore.open(filename, ORGANIZATIONS_DICTIONARY_COLUMNS)
+            index = CrunchbaseInvertedIndex.open(filename, store)
+            # a category listed twice in a row is posted once
+            self.assertEqual(index.get_row_ids({'category_groups_list': ['Software']}).tolist(), [0, 1, 2])
+            self.assertEqual(index.get_row_ids({'category_groups_list': ['Software'], 'country_code': ['GBR']}).tolist(), [0, 2])
+            self.assertEqual(index.get_counts('category_groups_list', 'country_code')['Software'], {'GBR': 2, 'USA': 1})
+
+    def test_build_parallel(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'organizations.csv')
+            with open(filename, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['uuid', 'name', 'country_code', 'category_groups_list', 'category_list', 'founded_on'])
+                for i in range(200):
+                    # quoted line breaks must not be taken for record boundaries
+                    writer.writerow([f'00000000-0000-0000-0000-{i:012d}', f'Name {i}\nLtd', 'GBR' if i % 2 else 'USA', 'Software', 'SaaS', '2015-01-01'])
+
+            serial = CrunchbaseColumnarStore.build(filename, ORGANIZATIONS_DICTIONARY_COLUMNS, workers=1)
+            serial_rows = serial.get_rows(range(200))
+            # small ranges with fewer workers than ranges, so ranges are submitted while results are consumed
+            parallel = CrunchbaseColumnarStore.build(filename, ORGANIZATIONS_DICTIONARY_COLUMNS, workers=2, chunk_size=1024)
+            self.assertEqual(parallel.rows, 200)
+            self.assertEqual(parallel.get_rows(range(200)), serial_rows)
+            self.assertEqual(serial_rows[7]['name'], 'Name 7\nLtd')
+
+
+class TestCrunchbaseFetcher(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockCrunchbaseHandler)
+        self.server.lock = threading.Lock()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.requests = []
+        self.server.card_sizes = {}
+        self.server.delay = 0.2
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_url = f'http://127.0.0.1:{self.server.server_port}/api/v4'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        # the first token is available immediately, the next 10 arrive at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_get_rest_api(self):
+        bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=6000, concurrency=2, cache_dir=None, profile='analytics')
+        try:
+            data = bot.get_rest_api({'uuid': 'abc'})
+        finally:
+            bot.close()
+
+        self.assertEqual(data['properties']['name'], 'Organization abc')
+        self.assertIn('raised_investments', data['cards'])
+        self.assertEqual(data['source'], 'crunchbase')
+        # field and card requests were sent concurrently
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_iter_rest_api_concurrency(self):
+        rows = [{'uuid': f'org{i}'} for i in range(12)]
+        # the profile fetches cards, so every organization sends its field and card request at the same time
+        bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=60000, concurrency=4, cache_dir=None, profile='analytics')
+        start = time.monotonic()
+        try:
+            results = list(bot.iter_rest_api(rows))
+        finally:
+            bot.close()
+
+        self.assertEqual(sorted(row['uuid'] for row, _, _ in results), sorted(row['uuid'] for row in rows))
+        self.assertTrue(all(error is None for _, _, error in results))
+        self.assertEqual(self.server.max_in_flight, 8)
+        # 12 organizations with 4 in flight take 3 rounds of 0.2s instead of 12
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_iter_rest_api_rate_limit(self):
+        self.server.delay = 0
+        rows = [{'uuid': f'org{i}'} for i in range(5)]
+        bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=1200, concurrency=4, cache_dir=None, profile='analytics')
+        try:
+            list(bot.iter_rest_api(rows))
+        finally:
+            bot.close()
+
+        # 10 calls at 20 per second can not be spread over less than 9 intervals of 50ms
+        timestamps = sorted(timestamp for timestamp, _, _ in self.server.requests)
+        self.assertEqual(len(timestamps), 10)
+        self.assertGreaterEqual(timestamps[-1] - timestamps[0], 0.4)
+
+    def test_response_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=6000, concurrency=2, cache_dir=cache_dir, profile='analytics')
+            try:
+                data = bot.get_rest_api({'uuid': 'abc'})
+                self.assertEqual(len(self.server.requests), 2)
+
+                # unchanged organizations are served from disk
+                self.assertEqual(bot.get_rest_api({'uuid': 'abc', 'crunchbase_updated_at': datetime(2000, 1, 1)}), data)
+                self.assertEqual(len(self.server.requests), 2)
+
+                # a bulk export update after the cached response revalidates it
+                bot.get_rest_api({'uuid': 'abc', 'crunchbase_updated_at': datetime.utcnow() + timedelta(minutes=1)})
+                self.assertEqual(len(self.server.requests), 4)
+            finally:
+                bot.close()
+
+    def test_search_profile(self):
+        bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=6000, concurrency=2, cache_dir=None, profile='search')
+        try:
+            data = bot.get_rest_api({'uuid': 'abc'})
+        finally:
+            bot.close()
+
+        # profiles without cards only send the field request
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(data['cards'], {})
+        self.assertEqual(data['profile'], 'search')
+
+    def test_card_pagination(self):
+        self.server.card_sizes = {'raised_investments': 250, 'founders': 100}
+        bot = CrunchBaseBot(api_url=self.api_url, calls_per_minute=60000, concurrency=4, cache_dir=None, profile='analytics')
+        try:
+            data = bot.get_rest_api({'uuid': 'abc'})
+        finally:
+            bot.close()
+
+        for card, size in self.server.card_sizes.items():
+            self.assertEqual([item['identifier']['uuid'] for item in data['cards'][card]], [f'{card}-{i}' for i in range(size)])
+        # fields, cards, 2 more pages of raised_investments and 1 empty page of founders
+        self.assertEqual(len(self.server.requests), 5)
+
+
+class TestCompaniesHouseIndex(unittest.TestCase):
+    columns = ['CompanyName', ' CompanyNumber', 'CompanyStatus', 'IncorporationDate', 'PreviousName_1.CONDATE', ' PreviousName_1.CompanyName', 'PreviousName_2.CONDATE', ' PreviousName_2.CompanyName']
+    companies = [['MADE.COM DESIGN LTD', '07101408', 'Liquidation', '16/12/2009', '', '', '', ''],
+                 ['MADE DESIGN LIMITED', '01234567', 'Active', '01/02/1990', '', '', '', ''],
+                 ['MADE.COM DESIGN SERVICES LTD', '07654321', 'Active', '10/01/2011', '', '', '', ''],
+                 ['ANDFACTS LIMITED', '11111111', 'Active', '05/05/2015', '01/01/2018', 'FACTS AND FIGURES LTD', '01/01/2016', 'OLD FACTS LTD'],
+                 ['ANDFACTS LIMITED', '22222222', 'Dissolved', '05/05/2001', '', '', '', '']]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.directory.name, 'BasicCompanyData.csv')
+        with open(filename, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(self.columns)
+            writer.writerows(self.companies)
+        self.path = os.path.join(self.directory.name, 'index.sqlite3')
+        self.assertEqual(build_companieshouse_index(filename, self.path), len(self.companies))
+        self.index = CompaniesHouseIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def test_normalize_company_name(self):
+        self.assertEqual(normalize_company_name('MADE.COM DESIGN LTD'), 'made com design')
+        self.assertEqual(normalize_company_name('Made.com Design Limited'), 'made com design')
+        self.assertEqual(normalize_company_name('Smith & Sons PLC'), 'smith and sons')
+
+    def test_candidates(self):
+        candidates = self.index.get_candidates('Made.com Design', datetime(2010, 1, 1), limit=2)
+        self.assertEqual([c['company_number'] for c in candidates], ['07101408', '07654321'])
+        self.assertEqual(candidates[0]['incorporated_on'], datetime(2009, 12, 16))
+
+    def test_candidates_by_previous_name(self):
+        candidates = self.index.get_candidates('Facts and Figures', datetime(2015, 1, 1), limit=1)
+        self.assertEqual(candidates[0]['company_number'], '11111111')
+        self.assertEqual(sorted(candidates[0]['names_prev']), ['FACTS AND FIGURES LTD', 'OLD FACTS LTD'])
+
+    def test_candidates_by_trigrams(self):
+        # misspelled names do not share tokens and are found by trigrams
+        candidates = self.index.get_candidates('Andfcts', datetime(2015, 1, 1), limit=2)
+        self.assertEqual([c['company_number'] for c in candidates], ['11111111', '22222222'])
+
+    def test_search(self):
+        # without founders a strong name and date match is decided from the index alone
+        self.assertEqual(CompaniesHouseBot.search('Andfacts', [], '2015-03-01', index=self.index), ('11111111', 'https://find-and-update.company-information.service.gov.uk/company/11111111'))
+
+
+class TestNameMatching(unittest.TestCase):
+    names = ['made.com design ltd', 'made design limited', 'andfacts', 'andfacts ltd', 'Ning Li', 'Li Ning', 'Brent Hoberman', '', 'ab']
+
+    @unittest.skipUnless(fuzz.SequenceMatcher.__module__ == 'fuzzywuzzy.StringMatcher', 'fuzzywuzzy scores differ without python-Levenshtein')
+    def test_ratios_match_fuzzywuzzy(self):
+        ratios = get_ratios(self.names, self.names)
+        for i, name1 in enumerate(self.names):
+            for j, name2 in enumerate(self.names):
+                self.assertEqual(ratios[i, j], fuzz.ratio(name1, name2))
+
+    def test_company_name_score(self):
+        # the crunchbase name is also compared with ltd and limited suffixes
+        self.assertEqual(get_company_name_score(['ANDFACTS LTD'], 'Andfacts'), 1)
+        self.assertEqual(get_company_name_score(['MADE DESIGN LIMITED'], 'made design ltd'), 1)
+        # previous names are scored as well
+        self.assertEqual(get_company_name_score(['OTHER NAME LTD', 'ANDFACTS LIMITED'], 'andfacts'), 1)
+        self.assertEqual(get_company_name_scores([['ANDFACTS LTD'], [], ['XYZ']], 'andfacts'), [1, 0, get_company_name_score(['XYZ'], 'andfacts')])
+
+    def test_names_matching_score(self):
+        self.assertEqual(get_names_matching_score(['ning li', 'brent hoberman'], ['brent hoberman']), 1)
+        self.assertEqual(get_names_matching_score([], ['brent hoberman']), 0)
+        self.assertEqual(get_names_matching_score(['brent hobermann'], ['ning li', 'brent hoberman']), 0.97)
+
+
+class TestCompaniesHouseSearch(unittest.TestCase):
+    search_html = b'''<html><body><ul id="results">
+        <li class="type-company"><h3><a href="/company/00000001">UNRELATED TRADING LIMITED</a></h3>
+            <p class="meta crumbtrail">00000001 - Incorporated on 1 January 1990</p></li>
+        <li class="type-company"><h3><a href="/company/00000002">ANDFACTS LIMITED</a></h3>
+            <p class="meta crumbtrail">00000002 - Incorporated on 5 May 2001</p></li>
+        <li class="type-company"><h3><a href="/company/00000003">FACTS AND FIGURES LTD</a></h3>
+            <p class="meta crumbtrail">00000003 - Incorporated on 5 May 2015</p>
+            <p class="meta">Matching previous names: <span>ANDFACTS LTD</span></p></li>
+        <li class="type-company"><h3><a href="/company/00000004">ANDFACTS HOLDINGS LTD</a></h3>
+            <p class="meta crumbtrail">00000004 - Dissolved on 2 February 2020</p></li>
+    </ul></body></html>'''
+
+    def test_parse_search_results(self):
+        candidates = CompaniesHouseBot.parse_search_results(etree.HTML(self.search_html))
+        self.assertEqual([c['company_number'] for c in candidates], ['00000001', '00000002', '00000003', '00000004'])
+        # previous names belong to their own result only
+        self.assertEqual([c['names_prev'] for c in candidates], [[], [], ['ANDFACTS LTD'], []])
+        self.assertEqual(candidates[1]['incorporated_on'], datetime(2001, 5, 5))
+        self.assertIsNone(candidates[3]['incorporated_on'])
+
+    def test_search_ranked_without_detail_pages(self):
+        urls = []
+        def get(url):
+            urls.append(url)
+            return mock.Mock(content=self.search_html)
+
+        with mock.patch('bots.companieshouse_bot.session.get', side_effect=get):
+            match = CompaniesHouseBot.search('Andfacts', [], '2015-03-01')
+
+        # the previous name match incorporated close to the founding date is checked first, no detail page is needed
+        self.assertEqual(match[0], '00000003')
+        self.assertEqual(len(urls), 1)
+
+    def test_index_candidate_without_date(self):
+        index = mock.Mock()
+        index.get_candidates.return_value = [{'company_number': '00000005', 'name': 'ANDFACTS TECHNOLOGY LTD', 'names_prev': [], 'incorporated_on': None}]
+        company_html = b'<html><body><dd id="company-creation-date">1 March 2015</dd></body></html>'
+
+        # the incorporation date is read from the company page
+        with mock.patch('bots.companieshouse_bot.session.get', return_value=mock.Mock(content=company_html)) as get:
+            self.assertEqual(CompaniesHouseBot.search('Andfacts Technology', [], '2015-03-01', index=index)[0], '00000005')
+        self.assertTrue(get.call_args.kwargs['url'].endswith('/company/00000005'))
+
+        # a company page without a date does not match the founding date, the companies house search finds nothing either
+        with mock.patch('bots.companieshouse_bot.session.get', return_value=mock.Mock(content=b'<html><body></body></html>')):
+            self.assertIsNone(CompaniesHouseBot.search('Andfacts Technology', [], '2015-03-01', index=index))
+
+    def test_index_without_match_searches_companies_house(self):
+        # the index only knows an unrelated company with a similar name, the search finds the renamed company
+        index = mock.Mock()
+        index.get_candidates.return_value = [{'company_number': '00000002', 'name': 'ANDFACTS LIMITED', 'names_prev': [], 'incorporated_on': datetime(2001, 5, 5)}]
+        with mock.patch('bots.companieshouse_bot.session.get', return_value=mock.Mock(content=self.search_html)) as get:
+            match = CompaniesHouseBot.search('Andfacts', [], '2015-03-01', index=index)
+
+        self.assertEqual(match[0], '00000003')
+        self.assertIn('/search/companies?q=Andfacts', get.call_args_list[0].kwargs['url'])
+
+
+class TestRateLimitMiddleware(unittest.TestCase):
+    def test_process_request(self):
+        middleware = RateLimitMiddleware({'limited.test': 60})
+        other = RateLimitMiddleware({'limited.test': 60})
+
+        def process_request(middleware, url):
+            return defer.ensureDeferred(middleware.process_request(scrapy.Request(url), None))
+
+        results = []
+        process_request(middleware, 'http://limited.test/1').addCallback(results.append)
+        self.assertEqual(results, [None])
+        # the bucket is shared with other crawlers of the process, the next request has to wait about a second
+        deferred = process_request(other, 'http://limited.test/2')
+        self.assertFalse(deferred.called)
+        deferred.addErrback(lambda failure: failure.trap(defer.CancelledError))
+        deferred.cancel()
+
+        process_request(middleware, 'http://unlimited.test/1').addCallback(results.append)
+        self.assertEqual(results, [None, None])
+
+
+FAKE_TESSERACT = '#!' + sys.executable + '''
+import sys
+from PIL import Image
+if sys.argv[1] == '--version':
+    print('tesseract 5.3.0')
+    sys.exit()
+with Image.open(sys.argv[1]) as img, open(sys.argv[2] + '.txt', 'w') as file:
+    file.write(f'width {img.width} psm {sys.argv[sys.argv.index("--psm") + 1]}\\n')
+'''
+
+# prints the pdf content as text layer, pages are separated by | and scanned pages are empty
+FAKE_PDFTOTEXT = '#!' + sys.executable + '''
+import sys
+content = sys.stdin.buffer.read().decode('utf-8')
+sys.stdout.write(''.join(page + '\\f' for page in content.split('|')))
+'''
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake tesseract and pdftotext executables are python scripts with a shebang')
+class TestOcrEngine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.tesseract_cmd = os.path.join(self.dir.name, 'tesseract')
+        with open(self.tesseract_cmd, 'w') as file:
+            file.write(FAKE_TESSERACT)
+        os.chmod(self.tesseract_cmd, 0o755)
+        with open(os.path.join(self.dir.name, 'pdftotext'), 'w') as file:
+            file.write(FAKE_PDFTOTEXT)
+        os.chmod(os.path.join(self.dir.name, 'pdftotext'), 0o755)
+        self.engine = OcrEngine(workers=3, tesseract_cmd=self.tesseract_cmd, cache_dir=os.path.join(self.dir.name, 'cache'))
+
+    def tearDown(self):
+        self.engine.close()
+        self.dir.cleanup()
+
+    def test_image_to_string(self):
+        images = [Image.new('L', (width, 10), 255) for width in range(10, 80, 10)]
+        texts = self.engine.image_to_string(images, psm=6)
+        # pages are OCR'd in parallel and returned in page order
+        self.assertEqual([text.strip() for text in texts], [f'width {width} psm 6' for width in range(10, 80, 10)])
+        self.assertEqual(self.engine.image_to_string([], psm=4), [])
+
+    def convert_from_bytes(self, content, first_page, last_page, **kwargs):
+        # the rendered width tells the page number
+        return [Image.new('L', (10 * page_number, 10), 255) for page_number in range(first_page, last_page + 1)]
+
+    def test_rasterize_pages(self):
+        self.assertEqual(get_page_ranges([7, 1, 2, 3, 5, 6, 2]), [(1, 3), (5, 7)])
+        with mock.patch('bots.companieshouse_bot.convert_from_bytes', side_effect=self.convert_from_bytes) as convert:
+            images = rasterize_pages(b'%PDF filing', [4, 1, 2], dpi=150, thread_count=2)
+        self.assertEqual([image.width for image in images], [10, 20, 40])
+        self.assertEqual(convert.call_count, 2)
+        self.assertEqual(convert.call_args.kwargs['dpi'], 150)
+        self.assertTrue(convert.call_args.kwargs['grayscale'])
+        self.assertTrue(convert.call_args.kwargs['use_pdftocairo'])
+
+    def test_pdf_to_string_cache(self):
+        with mock.patch('bots.companieshouse_bot.convert_from_bytes', side_effect=self.convert_from_bytes) as convert, \
+                mock.patch('bots.companieshouse_bot.pdfinfo_from_bytes', return_value={'Pages': 2}):
+            texts = self.engine.pdf_to_string(b'%PDF filing', psm=4, use_text_layer=False)
+            self.assertEqual([text.strip() for text in texts], ['width 10 psm 4', 'width 20 psm 4'])
+            # a fresh engine finds the pages on disk and neither rasterizes nor OCRs them again
+            engine = OcrEngine(workers=1, tesseract_cmd=self.tesseract_cmd, cache_dir=os.path.join(self.dir.name, 'cache'))
+            with mock.patch('bots.companieshouse_bot.ocr_page') as ocr_page:
+                self.assertEqual(engine.pdf_to_string(b'%PDF filing', psm=4, use_text_layer=False), texts)
+                ocr_page.assert_not_called()
+            engine.close()
+            self.assertEqual(convert.call_count, 1)
+
+            # other psm values and other documents are OCR'd
+            self.engine.pdf_to_string(b'%PDF filing', psm=6, use_text_layer=False)
+            self.engine.pdf_to_string(b'%PDF other filing', psm=4, use_text_layer=False)
+            self.assertEqual(convert.call_count, 3)
+
+    def test_iter_pdf_pages_early_termination(self):
+        with mock.patch('bots.companieshouse_bot.convert_from_bytes', side_effect=self.convert_from_bytes) as convert, \
+                mock.patch('bots.companieshouse_bot.pdfinfo_from_bytes', return_value={'Pages': 12}):
+            texts = []
+            for page_number, text in self.engine.iter_pdf_pages(b'%PDF annual return', psm=4, use_text_layer=False, lookahead=4):
+                texts.append(text.strip())
+                if len(texts) == 3:
+                    break
+            self.assertEqual(texts, ['width 10 psm 4', 'width 20 psm 4', 'width 30 psm 4'])
+            # pages are rendered in batches at most lookahead pages ahead of the consumer
+            self.assertEqual([(call.kwargs['first_page'], call.kwargs['last_page']) for call in convert.call_args_list], [(1, 4), (5, 6)])
+
+            # the pages that were read are cached, the next pages are rendered and OCR'd on demand
+            texts = self.engine.pdf_to_string(b'%PDF annual return', psm=4, use_text_layer=False)
+            self.assertEqual([text.strip() for text in texts], [f'width {10 * page_number} psm 4' for page_number in range(1, 13)])
+            self.assertEqual(convert.call_args_list[2].kwargs['first_page'], 4)
+
+    def test_pdf_to_string_text_layer(self):
+        electronic = ['FULL DETAILS OF SHAREHOLDERS page one', 'AUTHORISATION electronically filed document']
+        with mock.patch('bots.companieshouse_bot.convert_from_bytes', side_effect=self.convert_from_bytes) as convert, \
+                mock.patch('bots.companieshouse_bot.pdfinfo_from_bytes', return_value={'Pages': 2}):
+            # electronically filed documents are not rasterized
+            self.assertEqual(self.engine.pdf_to_string('|'.join(electronic).encode(), psm=4, poppler_path=self.dir.name), electronic)
+            self.assertEqual(convert.call_count, 0)
+
+            # only scanned pages are rasterized and OCR'd, pages with a text layer keep it
+            texts = self.engine.pdf_to_string(f'{electronic[0]}| '.encode(), psm=4, poppler_path=self.dir.name)
+            self.assertEqual([text.strip() for text in texts], [electronic[0], 'width 20 psm 4'])
+            self.assertEqual((convert.call_args.kwargs['first_page'], convert.call_args.kwargs['last_page']), (2, 2))
+            texts = self.engine.pdf_to_string('|'.join(electronic).encode(), psm=6, poppler_path=self.dir.name, use_text_layer=False)
+            self.assertEqual([text.strip() for text in texts], ['width 10 psm 6', 'width 20 psm 6'])
+            self.assertEqual(convert.call_count, 2)
+
+    def test_iter_pdf_pages_retry(self):
+        with mock.patch('bots.companieshouse_bot.convert_from_bytes', side_effect=self.convert_from_bytes) as convert, \
+                mock.patch('bots.companieshouse_bot.pdfinfo_from_bytes', return_value={'Pages': 5}):
+            images = {}
+            list(self.engine.iter_pdf_pages(b'%PDF confirmation statement', psm=4, use_text_layer=False, images=images))
+            self.assertEqual(sorted(images), [1, 2, 3, 4, 5])
+            self.assertEqual(convert.call_count, 2)
+
+            # the retry reuses the rendered pages and only OCRs the requested ones
+            pages = self.engine.iter_pdf_pages(b'%PDF confirmation statement', psm=6, use_text_layer=False, images=images, page_numbers=[3, 4])
+            self.assertEqual([(page_number, text.strip()) for page_number, text in pages], [(3, 'width 30 psm 6'), (4, 'width 40 psm 6')])
+            self.assertEqual(convert.call_count, 2)
+
+
+class TestDocumentJobs(unittest.TestCase):
+    def test_failed_document_recorded(self):
+        spider = CompaniesHouseBot(company_id='1', crunchbase_company_name='X', uuid='u', poppler_path=None)
+        spider.is_filing_parsed = True
+
+        def run(function, parse, url, *args):
+            # document jobs complete synchronously instead of in the reactor thread pool
+            return defer.maybeDeferred(parse, url, *args)
+
+        def parse(url, dt, poppler_path):
+            if url.endswith('2'):
+                raise ValueError('unreadable')
+            return {'FULL DETAILS OF SHAREHOLDERS': [{'name': 'A', 'shares': 1}]}
+
+        with mock.patch('bots.companieshouse_bot.document_semaphore.run', run):
+            spider.start_document_job('Confirmation Statement', parse, ('doc1', '2020-12-16', None),
+                                      spider.set_confirmation_statement, 'doc1', '2020-12-17', '2020-12-16', False)
+            spider.start_document_job('Confirmation Statement', parse, ('doc2', '2019-12-16', None),
+                                      spider.set_confirmation_statement, 'doc2', '2019-12-17', '2019-12-16', False)
+
+        self.assertEqual(spider.document_jobs_count, 0)
+        self.assertEqual(list(spider.data['cards']['shareholding']), ['2020-12-17'])
+        self.assertEqual(spider.data['cards']['filing_error'], {'2019-12-17': {'source': 'Confirmation Statement', 'url': 'doc2',
+                                                                               'received_date': '2019-12-17', 'error': 'unreadable'}})
+
+
+class TestBatchWriter(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        self.error = None
+        connection = mock.MagicMock()
+        patchers = [mock.patch('bots.common.get_connection', return_value=connection),
+                    mock.patch('bots.common.execute_values', side_effect=self.execute_values)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def execute_values(self, cursor, sql, rows):
+        if self.error is not None and any(self.error[0] in str(row) for row in rows):
+            raise self.error[1]
+        self.written.append((sql.split()[0] + ' ' + sql.split()[2], list(rows)))
+
+    def get_writer(self, max_size=100, max_delay=60):
+        writer = BatchWriter(max_size=max_size, max_delay=max_delay)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_dedupe(self):
+        writer = self.get_writer()
+        writer.write_data('u1', 'u1', 'first', 'crunchbase', '1', {'a': 1})
+        writer.write_data('u1', 'u1', 'second', 'crunchbase', '1', {'a': 2})
+        writer.write_data('u1', 'u1', 'other source', 'companieshouse', '1', {})
+        writer.insert_pending('u2', 'u1', 'first', None, None, None, None, 'linkedin')
+        writer.insert_pending('u2', 'u1', 'second', None, None, None, None, 'linkedin')
+        writer.set_pending_status('u1', 'crunchbase', PendingStatus.pending)
+        writer.set_pending_status('u1', 'crunchbase', PendingStatus.completed)
+        self.assertEqual(len(writer), 4)
+
+        self.assertEqual(writer.flush(), 4)
+        written = dict(self.written)
+        # the last data upsert and status change win, the first pending insert wins
+        self.assertEqual([row[2] for row in written['INSERT data']], ['second', 'other source'])
+        self.assertEqual([row[2] for row in written['INSERT pending']], ['first'])
+        self.assertEqual([row[2] for row in written['UPDATE SET']], ['completed'])
+        self.assertEqual(writer.flush(), 0)
+
+    def test_flush_max_size(self):
+        writer = self.get_writer(max_size=3)
+        writer.set_pending_status('u1', 'crunchbase', PendingStatus.completed)
+        writer.set_pending_status('u2', 'crunchbase', PendingStatus.completed)
+        self.assertEqual(self.written, [])
+        writer.set_pending_status('u3', 'crunchbase', PendingStatus.completed)
+        self.assertEqual(len(self.written[0][1]), 3)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_max_delay(self):
+        writer = self.get_writer(max_delay=0.2)
+        writer.set_pending_status('u1', 'crunchbase', PendingStatus.completed)
+        self.assertEqual(self.written, [])
+        deadline = time.monotonic() + 5
+        while not self.written and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_error(self):
+        writer = self.get_writer()
+        for i in range(5):
+            writer.set_pending_status(f'u{i}', 'crunchbase', PendingStatus.completed)
+
+        # rows are kept while the database is not reachable
+        self.error = ('u', psycopg2.OperationalError('server closed the connection'))
+        with self.assertRaises(psycopg2.OperationalError):
+            writer.flush()
+        self.assertEqual(len(writer), 5)
+
+        # a row rejected by the database is dropped, the other rows are written
+        self.error = ("'u3'", psycopg2.DataError('invalid input syntax for type uuid'))
+        with self.assertLogs('companybot', level='ERROR'):
+            self.assertEqual(writer.flush(), 4)
+        self.assertEqual(sorted(row[0] for sql, rows in self.written for row in rows), ['u0', 'u1', 'u2', 'u4'])
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_on_close(self):
+        writer = self.get_writer()
+        writer.set_pending_status('u1', 'crunchbase', PendingStatus.completed)
+        writer.close()
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(len(writer), 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_broken_connections_fail_fast(self):
+        with mock.patch('bots.common.ThreadedConnectionPool') as pool_class, mock.patch('bots.common.time.sleep'):
+            pool = ConnectionPool(minconn=1, maxconn=3, health_check=0)
+            # the database closed every connection
+            pool_class.return_value.getconn.return_value.closed = True
+            with self.assertLogs('companybot', level='WARNING'), self.assertRaises(psycopg2.OperationalError):
+                pool.getconn()
+
+        # the first connection and one replacement per allowed attempt were tested, the checkout slot is released
+        self.assertEqual(pool_class.return_value.getconn.call_count, 4)
+        self.assertEqual(pool_class.return_value.putconn.call_count, 4)
+        for _ in range(3):
+            self.assertTrue(pool.semaphore.acquire(blocking=False))
+
+
+class TestIncrementalPending(unittest.TestCase):
+    # runs against a scratch database next to DB_NAME on the DB_HOST/DB_PORT server of bots.config
+    database = f'{DB_NAME}_test'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            with bots.common.get_connection(database='postgres') as conn:
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s', (cls.database,))
+                    if not cursor.fetchone():
+                        cursor.execute(f'CREATE DATABASE {cls.database}')
+        except psycopg2.OperationalError as ex:
+            raise unittest.SkipTest(f'PostgreSQL is not reachable: {str(ex)}')
+
+    def setUp(self):
+        get_connection = bots.common.get_connection
+        patcher = mock.patch('bots.common.get_connection', side_effect=lambda **kwargs: get_connection(**{'database': self.database, **kwargs}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_organizations_table(drop_existing=True)
+        create_pending_table(drop_existing=True)
+        create_data_table(drop_existing=True)
+
+    def get_organization(self, uuid, updated_at, name=None):
+        return {'uuid': uuid, 'name': name or f'Organization {uuid[-1]}', 'legal_name': None, 'country_code': 'GBR',
+                'category_groups_list': 'Software', 'founded_on': '2015-01-01', 'updated_at': updated_at}
+
+    def query(self, sql, args=None):
+        with bots.common.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                rows = cursor.fetchall() if cursor.description else None
+            conn.commit()
+        return rows
+
+    def test_update_changed_organizations(self):
+        u1, u2 = '00000000-0000-0000-0000-000000000001', '00000000-0000-0000-0000-000000000002'
+        copy_organizations_from_csv([self.get_organization(u1, '2024-01-01'), self.get_organization(u2, '2024-01-01')])
+
+        # without update existing organizations are kept, with update only organizations with a new updated_at are rewritten
+        copy_organizations_from_csv([self.get_organization(u1, '2024-02-01', name='Renamed')])
+        self.assertEqual(self.query('SELECT name FROM crunchbase_organizations WHERE uuid = %s', (u1,)), [('Organization 1',)])
+        copy_organizations_from_csv([self.get_organization(u1, '2024-01-01', name='Same updated_at'),
+                                     self.get_organization(u2, '2024-02-01', name='Renamed')], update=True)
+        self.assertEqual(self.query('SELECT uuid::text, name, updated_at::date::text FROM crunchbase_organizations ORDER BY uuid'),
+                         [(u1, 'Organization 1', '2024-01-01'), (u2, 'Renamed', '2024-02-01')])
+
+    def test_incremental_pending(self):
+        uuids = [f'00000000-0000-0000-0000-00000000000{i}' for i in range(1, 5)]
+        # 1 has no data, 2 was fetched after its last change, 3 changed after it was fetched and 4 has no updated_at
+        copy_organizations_from_csv([self.get_organization(uuids[0], '2024-03-01'), self.get_organization(uuids[1], '2024-01-01'),
+                                     self.get_organization(uuids[2], '2024-03-01'), self.get_organization(uuids[3], None)])
+        for uuid in uuids[1:]:
+            self.query("INSERT INTO data (uuid, uuid_parent, name, source, version, created_at, updated_at, data) "
+                       "VALUES (%s, %s, 'data', 'crunchbase', '', '2024-02-01', '2024-02-01', '{}')", (uuid, uuid))
+        write_organizations_pending('*', '*', '*', DataSource.crunchbase, status=PendingStatus.completed, force=True)
+
+        write_organizations_pending('*', '*', '*', DataSource.crunchbase, incremental=True)
+        self.assertEqual(self.query("SELECT uuid::text, status FROM pending WHERE source = 'crunchbase' ORDER BY uuid"),
+                         [(uuids[0], 'pending'), (uuids[1], 'completed'), (uuids[2], 'pending'), (uuids[3], 'completed')])
+
+
+class TestCloseConnections(unittest.TestCase):
+    def test_writer_flushed_before_pools_close(self):
+        calls = []
+        pool = mock.Mock()
+        pool.close.side_effect = lambda: calls.append('pool closed')
+        writer = BatchWriter(max_size=100, max_delay=60)
+        writer.set_pending_status('00000000-0000-0000-0000-000000000001', 'linkedin', PendingStatus.completed)
+        with mock.patch.object(writer, 'flush', side_effect=lambda: calls.append('writer flushed')), \
+                mock.patch.dict(bots.common.connection_pools, {'pool': pool}, clear=True):
+            # the writer was created before the pool, it is still flushed first
+            close_connections()
+        self.assertEqual(calls, ['writer flushed', 'pool closed'])